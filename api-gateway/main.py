@@ -1,19 +1,595 @@
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import FastAPI, HTTPException, Request, Response
 import httpx
 import os
 from dotenv import load_dotenv
 import logging
+import asyncio
+import time
+import json
+import hashlib
+import hmac
+import itertools
+import random
+import websockets
+import jwt
+import orjson
+import zlib
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from collections import OrderedDict
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+from urllib.parse import urlencode
 from fastapi.middleware.cors import CORSMiddleware
-from starlette.responses import StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import JSONResponse, StreamingResponse
+from fastapi.responses import ORJSONResponse
 from fastapi import WebSocket, WebSocketDisconnect
 
+try:
+    import brotli
+except ImportError:  # brotli es opcional: sin él solo se negocia gzip
+    brotli = None
+
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-app = FastAPI(title="API Gateway")
+# URLs de los servicios
+AUTH_SERVICE_URL = os.getenv("AUTH_SERVICE_URL", "http://auth-service:8001")
+USER_SERVICE_URL = os.getenv("USER_SERVICE_URL", "http://user-service:8000")
+POST_SERVICE_URL = os.getenv("POST_SERVICE_URL", "http://post-service:8000")
+FRIEND_SERVICE_URL = os.getenv("FRIEND_SERVICE_URL", "http://friend-service:8006")
+CHAT_SERVICE_URL = os.getenv("CHAT_SERVICE_URL", "http://chat-service:8007")
+BOOKMARK_SERVICE_URL = os.getenv("BOOKMARK_SERVICE_URL", "http://bookmark-service:8009")
+NOTIFICATION_SERVICE_URL = os.getenv("NOTIFICATION_SERVICE_URL", "http://notification-service:8008")
+
+SERVICE_URLS = {
+    "auth": AUTH_SERVICE_URL,
+    "user": USER_SERVICE_URL,
+    "post": POST_SERVICE_URL,
+    "friend": FRIEND_SERVICE_URL,
+    "chat": CHAT_SERVICE_URL,
+    "bookmark": BOOKMARK_SERVICE_URL,
+    "notification": NOTIFICATION_SERVICE_URL,
+}
+
+# Configuración del pool de conexiones hacia los servicios
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP_POOL_TIMEOUT = float(os.getenv("HTTP_POOL_TIMEOUT", "5"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "10"))
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "false").lower() == "true"
+
+# Verificación local de los JWT emitidos por auth-service
+JWT_SECRET = os.getenv("JWT_SECRET", "your_jwt_secret")
+JWT_ALGORITHM = "HS256"
+JWT_CACHE_SIZE = int(os.getenv("JWT_CACHE_SIZE", "10000"))
+
+# Rutas que no requieren token: login, registro, imágenes y documentación. /metrics es pública a
+# propósito para el scraping de Prometheus: solo expone contadores e histogramas agregados
+PUBLIC_ROUTES = {("POST", "/auth/login"), ("POST", "/users")}
+PUBLIC_PREFIXES = ("/uploads/", "/metrics", "/docs", "/redoc", "/openapi.json")
+# /internal/ (estado de pools, caché, breakers...) es solo para operación: pide el token de
+# INTERNAL_API_TOKEN en X-Internal-Token y, si no está configurado, no se sirve a nadie
+INTERNAL_PREFIX = "/internal/"
+INTERNAL_API_TOKEN = os.getenv("INTERNAL_API_TOKEN", "")
+
+# Verifica tokens HS256 y recuerda los ya verificados para no repetir la firma en cada petición
+class TokenVerifier:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._verified: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+
+    def verify(self, token: str) -> Optional[str]:
+        now = time.time()
+        entry = self._verified.get(token)
+        if entry is not None:
+            user_id, expires_at = entry
+            if expires_at > now:
+                self._verified.move_to_end(token)
+                self.hits += 1
+                return user_id
+            del self._verified[token]
+        self.misses += 1
+        try:
+            payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM], options={"require": ["exp"]})
+        except jwt.PyJWTError as e:
+            self.rejected += 1
+            logger.warning(f"Token rechazado: {str(e)}")
+            return None
+        user_id = payload.get("user_id")
+        if not user_id:
+            self.rejected += 1
+            return None
+        self._verified[token] = (user_id, float(payload["exp"]))
+        if len(self._verified) > self.max_entries:
+            self._verified.popitem(last=False)
+        return user_id
+
+    def stats(self) -> dict:
+        return {"cached_tokens": len(self._verified), "hits": self.hits, "misses": self.misses, "rejected": self.rejected}
+
+token_verifier = TokenVerifier(JWT_CACHE_SIZE)
+
+def bearer_token(authorization: Optional[str]) -> str:
+    if authorization and authorization.startswith("Bearer "):
+        return authorization[len("Bearer "):].strip()
+    return ""
+
+# Headers hacia los servicios: token original más la identidad ya verificada por el gateway
+def auth_headers(request: Request) -> dict:
+    headers = {"Authorization": request.headers.get("Authorization", "")}
+    user_id = getattr(request.state, "user_id", None)
+    if user_id:
+        headers["X-User-Id"] = user_id
+    return headers
+
+# Configuración de la caché de respuestas GET
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "true").lower() == "true"
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+CACHE_TTL = float(os.getenv("CACHE_TTL", "30"))
+# Las búsquedas de usuarios y el autocompletado caducan antes: el índice cambia con cada registro
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "10"))
+
+# Límites para la transmisión de formularios con archivos
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(10 * 1024 * 1024)))
+UPLOAD_TIMEOUT = float(os.getenv("UPLOAD_TIMEOUT", "60"))
+# Entradas del índice que recuerda qué servicio sirve cada imagen
+UPLOAD_INDEX_SIZE = int(os.getenv("UPLOAD_INDEX_SIZE", "50000"))
+
+# Feed agregado: tamaño de página y llamadas concurrentes a los servicios por petición
+FEED_PAGE_SIZE = int(os.getenv("FEED_PAGE_SIZE", "20"))
+FEED_MAX_PAGE_SIZE = int(os.getenv("FEED_MAX_PAGE_SIZE", "50"))
+FEED_FANOUT_CONCURRENCY = int(os.getenv("FEED_FANOUT_CONCURRENCY", "8"))
+
+# Resiliencia por servicio: concurrencia máxima, circuit breaker y presupuesto de reintentos
+UPSTREAM_MAX_CONCURRENCY = int(os.getenv("UPSTREAM_MAX_CONCURRENCY", str(HTTP_MAX_CONNECTIONS)))
+UPSTREAM_MAX_WAITING = int(os.getenv("UPSTREAM_MAX_WAITING", "50"))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", "10"))
+BREAKER_HALF_OPEN_PROBES = int(os.getenv("BREAKER_HALF_OPEN_PROBES", "1"))
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "2"))
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.1"))
+RETRY_BUDGET_MAX_TOKENS = float(os.getenv("RETRY_BUDGET_MAX_TOKENS", "10"))
+RETRY_BACKOFF_BASE = float(os.getenv("RETRY_BACKOFF_BASE", "0.05"))
+RETRYABLE_STATUS = {502, 503, 504}
+
+# Control de admisión: límites de peticiones en curso y retardo máximo del event loop
+ADMISSION_SOFT_LIMIT = int(os.getenv("ADMISSION_SOFT_LIMIT", "200"))
+ADMISSION_HARD_LIMIT = int(os.getenv("ADMISSION_HARD_LIMIT", "400"))
+ADMISSION_MAX_LOOP_LAG = float(os.getenv("ADMISSION_MAX_LOOP_LAG", "0.2"))
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "2"))
+# Límite por usuario verificado (o por IP en rutas públicas)
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMIT_RPS = float(os.getenv("RATE_LIMIT_RPS", "20"))
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "40"))
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+
+# Compresión de respuestas negociada con Accept-Encoding
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv("COMPRESSION_BROTLI_QUALITY", "4"))
+COMPRESSIBLE_TYPES = ("application/json", "text/")
+
+# Proxy WebSocket multiplexado: enlaces por servicio, cola por cliente y keepalive
+WS_MUX_LINKS = int(os.getenv("WS_MUX_LINKS", "2"))
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "64"))
+WS_PING_INTERVAL = float(os.getenv("WS_PING_INTERVAL", "20"))
+WS_PING_TIMEOUT = float(os.getenv("WS_PING_TIMEOUT", "20"))
+
+# Rutas GET cuyas llamadas idénticas y concurrentes comparten una sola petición al servicio
+COALESCE_ENABLED = os.getenv("COALESCE_ENABLED", "true").lower() == "true"
+COALESCE_ROUTES = {
+    route.strip()
+    for route in os.getenv("COALESCE_ROUTES", "get_user,get_post,get_followers,check_bookmark,search_autocomplete,get_trending").split(",")
+    if route.strip()
+}
+
+# El servicio está marcado como caído o saturado: se responde 503 sin llamarlo
+class UpstreamUnavailable(Exception):
+    def __init__(self, base_url: str, reason: str, retry_after: float):
+        super().__init__(f"{base_url} no disponible ({reason})")
+        self.base_url = base_url
+        self.reason = reason
+        self.retry_after = retry_after
+
+# Circuit breaker: tras varios fallos seguidos deja de llamar al servicio durante un tiempo
+# y después deja pasar unas pocas peticiones de prueba (half-open) antes de cerrarse.
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probes = 0
+        self.times_opened = 0
+        self.rejected = 0
+
+    # Devuelve True si la petición admitida es una prueba half-open
+    def allow(self) -> bool:
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < BREAKER_RESET_TIMEOUT:
+                self.rejected += 1
+                UPSTREAM_REJECTIONS.labels(self.base_url, "circuit_open").inc()
+                raise UpstreamUnavailable(self.base_url, "circuit_open", self.retry_after())
+            self.state = self.HALF_OPEN
+            self.probes = 0
+            logger.info(f"Circuit breaker de {self.base_url} en half-open")
+        if self.state == self.HALF_OPEN:
+            if self.probes >= BREAKER_HALF_OPEN_PROBES:
+                self.rejected += 1
+                UPSTREAM_REJECTIONS.labels(self.base_url, "circuit_half_open").inc()
+                raise UpstreamUnavailable(self.base_url, "circuit_half_open", self.retry_after())
+            self.probes += 1
+            return True
+        return False
+
+    # ok=None: la petición terminó sin resultado atribuible al servicio (cancelación, error local)
+    def record(self, probe: bool, ok: Optional[bool]):
+        if probe and self.state == self.HALF_OPEN:
+            self.probes -= 1
+            if ok:
+                self.state = self.CLOSED
+                self.failures = 0
+                logger.info(f"Circuit breaker de {self.base_url} cerrado")
+            elif ok is False:
+                self._open()
+            return
+        if ok:
+            self.failures = 0
+        elif ok is False and self.state == self.CLOSED:
+            self.failures += 1
+            if self.failures >= BREAKER_FAILURE_THRESHOLD:
+                self._open()
+
+    def _open(self):
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+        self.times_opened += 1
+        logger.warning(f"Circuit breaker de {self.base_url} abierto tras {self.failures} fallos")
+
+    def retry_after(self) -> float:
+        if self.state == self.OPEN:
+            return max(BREAKER_RESET_TIMEOUT - (time.monotonic() - self.opened_at), 0.0)
+        return BREAKER_RESET_TIMEOUT
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "times_opened": self.times_opened,
+            "rejected": self.rejected,
+        }
+
+# Presupuesto de reintentos: cada petición aporta una fracción de token y cada reintento
+# consume uno, de modo que los reintentos nunca superan un porcentaje del tráfico.
+class RetryBudget:
+    def __init__(self):
+        self.tokens = RETRY_BUDGET_MAX_TOKENS
+        self.retries = 0
+        self.exhausted = 0
+
+    def deposit(self):
+        self.tokens = min(self.tokens + RETRY_BUDGET_RATIO, RETRY_BUDGET_MAX_TOKENS)
+
+    def withdraw(self) -> bool:
+        if self.tokens < 1:
+            self.exhausted += 1
+            return False
+        self.tokens -= 1
+        self.retries += 1
+        return True
+
+    def stats(self) -> dict:
+        return {"tokens": round(self.tokens, 2), "retries": self.retries, "exhausted": self.exhausted}
+
+# Cliente HTTP persistente por servicio, con métricas de saturación del pool
+class UpstreamPool:
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(HTTP_TIMEOUT, pool=HTTP_POOL_TIMEOUT),
+            http2=HTTP2_ENABLED,
+        )
+        # El semáforo limita la concurrencia hacia el servicio y permite medir la espera por conexión
+        self._slots = asyncio.Semaphore(UPSTREAM_MAX_CONCURRENCY)
+        self.breaker = CircuitBreaker(base_url)
+        self.retry_budget = RetryBudget()
+        self.saturated = 0
+        self.in_use = 0
+        self.waiting = 0
+        self.requests = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    # Un error de red o una respuesta 5xx que salga del bloque cuenta como fallo del servicio
+    @asynccontextmanager
+    async def slot(self):
+        probe = self.breaker.allow()
+        if self.waiting >= UPSTREAM_MAX_WAITING:
+            self.breaker.record(probe, None)
+            self.saturated += 1
+            UPSTREAM_REJECTIONS.labels(self.base_url, "saturated").inc()
+            raise UpstreamUnavailable(self.base_url, "saturated", 1.0)
+        start = time.perf_counter()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=HTTP_POOL_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.breaker.record(probe, None)
+            raise httpx.PoolTimeout(f"Pool saturado hacia {self.base_url}")
+        except BaseException:
+            self.breaker.record(probe, None)
+            raise
+        finally:
+            self.waiting -= 1
+        waited = time.perf_counter() - start
+        self.requests += 1
+        self.wait_time_total += waited
+        self.wait_time_max = max(self.wait_time_max, waited)
+        self.in_use += 1
+        ok = None
+        try:
+            yield self.client
+            ok = True
+        except httpx.HTTPStatusError as e:
+            ok = e.response.status_code < 500
+            raise
+        except httpx.RequestError:
+            ok = False
+            raise
+        finally:
+            self.in_use -= 1
+            self._slots.release()
+            self.breaker.record(probe, ok)
+
+    def stats(self) -> dict:
+        return {
+            "base_url": self.base_url,
+            "max_connections": HTTP_MAX_CONNECTIONS,
+            "max_concurrency": UPSTREAM_MAX_CONCURRENCY,
+            "in_use": self.in_use,
+            "waiting": self.waiting,
+            "saturation": self.in_use / UPSTREAM_MAX_CONCURRENCY,
+            "saturated_rejections": self.saturated,
+            "breaker": self.breaker.stats(),
+            "retry_budget": self.retry_budget.stats(),
+            "requests": self.requests,
+            "avg_wait_ms": (self.wait_time_total / self.requests * 1000) if self.requests else 0.0,
+            "max_wait_ms": self.wait_time_max * 1000,
+        }
+
+    async def aclose(self):
+        await self.client.aclose()
+
+upstream_pools: Dict[str, UpstreamPool] = {}
+
+def _origin(url: str) -> str:
+    parsed = httpx.URL(url)
+    return f"{parsed.scheme}://{parsed.netloc.decode('ascii')}"
+
+# Obtener el pool del servicio al que pertenece una URL
+def get_upstream(url: str) -> UpstreamPool:
+    origin = _origin(url)
+    pool = upstream_pools.get(origin)
+    if pool is None:
+        pool = UpstreamPool(origin)
+        upstream_pools[origin] = pool
+    return pool
+
+# Prioridad de cada petición frente a la sobrecarga: las críticas nunca se descartan,
+# las de baja prioridad (listados e imágenes) son las primeras en descartarse.
+# "/alerts" es la ruta antigua del envío de mensajes; se mantiene como alias
+CRITICAL_ROUTES = {("POST", "/auth/login"), ("POST", "/posts"), ("POST", "/chat/messages"), ("POST", "/alerts")}
+EXEMPT_PREFIXES = ("/metrics", "/internal/")
+LOW_PRIORITY_ROUTES = {("GET", "/users"), ("GET", "/posts")}
+LOW_PRIORITY_PREFIXES = ("/uploads/",)
+
+def request_priority(method: str, path: str) -> str:
+    if (method, path) in CRITICAL_ROUTES or method == "OPTIONS" or path.startswith(EXEMPT_PREFIXES):
+        return "critical"
+    if (method, path) in LOW_PRIORITY_ROUTES or (method == "GET" and path.startswith(LOW_PRIORITY_PREFIXES)):
+        return "low"
+    return "normal"
+
+# Control de admisión adaptativo: con carga moderada descarta el tráfico de baja prioridad
+# y con carga alta todo salvo el crítico. La carga se mide por peticiones en curso y por
+# el retardo del event loop, que refleja cuánto esperan en cola las tareas ya admitidas.
+class AdmissionController:
+    def __init__(self):
+        self.in_flight = 0
+        self.loop_lag = 0.0
+        self.shed: Dict[str, int] = {"low": 0, "normal": 0}
+
+    def overload_level(self) -> int:
+        if self.in_flight >= ADMISSION_HARD_LIMIT:
+            return 2
+        if self.in_flight >= ADMISSION_SOFT_LIMIT or self.loop_lag >= ADMISSION_MAX_LOOP_LAG:
+            return 1
+        return 0
+
+    def admit(self, priority: str) -> bool:
+        level = self.overload_level()
+        if priority == "critical" or level == 0 or (priority == "normal" and level < 2):
+            return True
+        self.shed[priority] += 1
+        return False
+
+    # Mide cuánto se retrasa un sleep corto respecto a lo pedido (media móvil exponencial)
+    async def monitor_loop_lag(self, interval: float = 0.1):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            lag = max(loop.time() - start - interval, 0.0)
+            self.loop_lag = 0.8 * self.loop_lag + 0.2 * lag
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "loop_lag_ms": self.loop_lag * 1000,
+            "overload_level": self.overload_level(),
+            "shed": dict(self.shed),
+        }
+
+admission = AdmissionController()
+
+# Token bucket por clave: RATE_LIMIT_RPS tokens por segundo con ráfagas de hasta RATE_LIMIT_BURST
+class RateLimiter:
+    def __init__(self, rate: float, burst: float, max_keys: int):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        self.limited = 0
+
+    # Devuelve 0 si se admite la petición o los segundos hasta el siguiente token
+    def acquire(self, key: str) -> float:
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens >= 1:
+            wait = 0.0
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / self.rate
+            self.limited += 1
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return wait
+
+    def stats(self) -> dict:
+        return {"keys": len(self._buckets), "limited": self.limited, "rate": self.rate, "burst": self.burst}
+
+rate_limiter = RateLimiter(RATE_LIMIT_RPS, RATE_LIMIT_BURST, RATE_LIMIT_MAX_KEYS)
+
+def too_many_requests(detail: str, retry_after: float) -> JSONResponse:
+    return JSONResponse(
+        status_code=429,
+        content={"detail": detail},
+        headers={"Retry-After": str(max(1, int(retry_after + 0.999)))},
+    )
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    for service_url in SERVICE_URLS.values():
+        get_upstream(service_url)
+    logger.info(f"Pools HTTP creados para: {list(upstream_pools.keys())}")
+    ws_muxes["notification"] = WebSocketMux("notification", NOTIFICATION_SERVICE_URL)
+    ws_muxes["chat"] = WebSocketMux("chat", CHAT_SERVICE_URL)
+    lag_monitor = asyncio.create_task(admission.monitor_loop_lag())
+    yield
+    lag_monitor.cancel()
+    for mux in ws_muxes.values():
+        await mux.aclose()
+    ws_muxes.clear()
+    for pool in upstream_pools.values():
+        await pool.aclose()
+    upstream_pools.clear()
+    logger.info("Pools HTTP cerrados")
+
+app = FastAPI(title="API Gateway", lifespan=lifespan, default_response_class=ORJSONResponse)
+
+# Límite por usuario; se ejecuta después de la autenticación para usar la identidad verificada.
+# Las rutas críticas no se descartan por sobrecarga, pero sí se limitan, en un bucket aparte para
+# que el resto del tráfico no agote su cupo: el login es anónimo y queda limitado por IP, así que
+# no sirve para probar credenciales en masa
+@app.middleware("http")
+async def rate_limit(request: Request, call_next):
+    path = request.url.path
+    if not RATE_LIMIT_ENABLED or request.method == "OPTIONS" or path.startswith(EXEMPT_PREFIXES):
+        return await call_next(request)
+    priority = request_priority(request.method, path)
+    user_id = getattr(request.state, "user_id", None)
+    key = f"user:{user_id}" if user_id else f"ip:{request.client.host if request.client else 'unknown'}"
+    if priority == "critical":
+        key = f"critical:{key}"
+    wait = rate_limiter.acquire(key)
+    if wait > 0:
+        GATEWAY_REJECTIONS.labels("rate_limited", priority).inc()
+        logger.warning(f"Límite de peticiones superado para {key}")
+        return too_many_requests("Demasiadas peticiones, inténtalo más tarde", wait)
+    return await call_next(request)
+
+# Autenticación en el borde: los tokens inválidos no llegan a los servicios.
+# Se registra antes que CORS para que las respuestas 401 lleven sus headers.
+@app.middleware("http")
+async def authenticate(request: Request, call_next):
+    path = request.url.path
+    if request.method == "OPTIONS" or (request.method, path) in PUBLIC_ROUTES or path.startswith(PUBLIC_PREFIXES):
+        return await call_next(request)
+    if path.startswith(INTERNAL_PREFIX):
+        internal_token = request.headers.get("X-Internal-Token", "")
+        if not INTERNAL_API_TOKEN or not hmac.compare_digest(internal_token.encode(), INTERNAL_API_TOKEN.encode()):
+            return JSONResponse(status_code=403, content={"detail": "Endpoint interno"})
+        return await call_next(request)
+    token = bearer_token(request.headers.get("Authorization"))
+    if not token:
+        return JSONResponse(status_code=401, content={"detail": "Token de autorización requerido"})
+    user_id = token_verifier.verify(token)
+    if user_id is None:
+        return JSONResponse(status_code=401, content={"detail": "Token inválido o expirado"})
+    request.state.user_id = user_id
+    return await call_next(request)
+
+# Control de admisión: se ejecuta antes de la autenticación para descartar barato bajo sobrecarga
+@app.middleware("http")
+async def admission_control(request: Request, call_next):
+    priority = request_priority(request.method, request.url.path)
+    if not admission.admit(priority):
+        GATEWAY_REJECTIONS.labels("overloaded", priority).inc()
+        return too_many_requests("Servicio sobrecargado, inténtalo más tarde", ADMISSION_RETRY_AFTER)
+    admission.in_flight += 1
+    try:
+        return await call_next(request)
+    finally:
+        admission.in_flight -= 1
+
+# Métricas Prometheus
+REQUEST_LATENCY = Histogram("http_request_duration_seconds", "Latencia de las peticiones HTTP", ["method", "route", "status"])
+REQUESTS_IN_FLIGHT = Gauge("http_requests_in_flight", "Peticiones HTTP en curso")
+UPSTREAM_LATENCY = Histogram("upstream_request_duration_seconds", "Latencia de las llamadas a los servicios", ["upstream", "method", "status"])
+UPSTREAM_POOL_IN_USE = Gauge("upstream_pool_connections_in_use", "Conexiones del pool en uso", ["upstream"])
+UPSTREAM_POOL_WAITING = Gauge("upstream_pool_waiting_requests", "Peticiones esperando una conexión del pool", ["upstream"])
+UPSTREAM_BREAKER_OPEN = Gauge("upstream_circuit_breaker_open", "Estado del circuit breaker (0 cerrado, 0.5 half-open, 1 abierto)", ["upstream"])
+UPSTREAM_REJECTIONS = Counter("upstream_rejections_total", "Peticiones rechazadas sin llamar al servicio", ["upstream", "reason"])
+UPSTREAM_RETRIES = Counter("upstream_retries_total", "Reintentos de peticiones idempotentes", ["upstream"])
+CACHE_LOOKUPS = Counter("gateway_cache_lookups_total", "Consultas a la caché de respuestas", ["result"])
+COALESCED_REQUESTS = Counter("gateway_coalesced_requests_total", "Peticiones GET agrupadas por single-flight", ["role"])
+WEBSOCKET_CONNECTIONS = Gauge("websocket_connections", "Conexiones WebSocket activas", ["service"])
+GATEWAY_REJECTIONS = Counter("gateway_rejected_requests_total", "Peticiones rechazadas con 429 por el gateway", ["reason", "priority"])
+EVENT_LOOP_LAG = Gauge("gateway_event_loop_lag_seconds", "Retardo medio del event loop")
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    REQUESTS_IN_FLIGHT.inc()
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        REQUESTS_IN_FLIGHT.dec()
+        route = request.scope.get("route")
+        REQUEST_LATENCY.labels(request.method, route.path if route else "unmatched", str(status)).observe(time.perf_counter() - start)
 
 # Configurar CORS
 app.add_middleware(
@@ -24,59 +600,678 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# URLs de los servicios
-AUTH_SERVICE_URL = os.getenv("AUTH_SERVICE_URL", "http://auth-service:8001")
-USER_SERVICE_URL = os.getenv("USER_SERVICE_URL", "http://user-service:8000")
-POST_SERVICE_URL = os.getenv("POST_SERVICE_URL", "http://post-service:8000")
-FRIEND_SERVICE_URL = os.getenv("FRIEND_SERVICE_URL", "http://friend-service:8006")
-CHAT_SERVICE_URL = os.getenv("CHAT_SERVICE_URL", "http://chat-service:8007")
-BOOKMARK_SERVICE_URL = os.getenv("BOOKMARK_SERVICE_URL", "http://bookmark-service:8009")
-NOTIFICATION_SERVICE_URL = os.getenv("NOTIFICATION_SERVICE_URL", "http://notification-service:8008")
+# Elige br o gzip según Accept-Encoding (respetando q=0)
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    accepted: Dict[str, float] = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    for encoding in ("br", "gzip"):
+        if encoding == "br" and brotli is None:
+            continue
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
 
-# Helper function para manejar solicitudes HTTP
-async def forward_request(method: str, url: str, json=None, data=None, files=None, headers=None, timeout=10):
-    logger.info(f"Headers enviados a {url}: {headers}")
-    async with httpx.AsyncClient(timeout=timeout) as client:
+# Devuelve las funciones (comprimir, terminar) del codificador elegido
+def make_compressor(encoding: str) -> Tuple[Callable[[bytes], bytes], Callable[[], bytes]]:
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=COMPRESSION_BROTLI_QUALITY)
+        return compressor.process, compressor.finish
+    compressor = zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)
+    return compressor.compress, compressor.flush
+
+# Comprime respuestas JSON/texto por encima de COMPRESSION_MIN_SIZE. Las imágenes, las
+# respuestas parciales (Range) y las ya comprimidas pasan sin tocar. El cuerpo se acumula
+# hasta alcanzar el umbral y después se comprime en streaming.
+class CompressionMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        passthrough = False
+        compressor = None
+        finish = None
+        buffered: List[bytes] = []
+        buffered_size = 0
+
+        async def send_compressed(message):
+            nonlocal start_message, passthrough, compressor, finish, buffered_size
+            if message["type"] == "http.response.start":
+                headers = Headers(raw=message["headers"])
+                if (
+                    "content-encoding" in headers
+                    or "content-range" in headers
+                    or not headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES)
+                ):
+                    passthrough = True
+                    await send(message)
+                else:
+                    start_message = message
+                return
+            if passthrough or message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if compressor is None:
+                buffered.append(body)
+                buffered_size += len(body)
+                if buffered_size < COMPRESSION_MIN_SIZE:
+                    if more_body:
+                        return
+                    # Respuesta pequeña: no compensa comprimirla
+                    await send(start_message)
+                    await send({"type": "http.response.body", "body": b"".join(buffered)})
+                    return
+                compressor, finish = make_compressor(encoding)
+                headers = MutableHeaders(raw=list(start_message["headers"]))
+                headers["Content-Encoding"] = encoding
+                headers.add_vary_header("Accept-Encoding")
+                if "content-length" in headers:
+                    del headers["Content-Length"]
+                if not more_body:
+                    data = compressor(b"".join(buffered)) + finish()
+                    headers["Content-Length"] = str(len(data))
+                    start_message["headers"] = headers.raw
+                    await send(start_message)
+                    await send({"type": "http.response.body", "body": data})
+                    return
+                start_message["headers"] = headers.raw
+                await send(start_message)
+                body = b"".join(buffered)
+            data = compressor(body)
+            if not more_body:
+                data += finish()
+            if data or not more_body:
+                await send({"type": "http.response.body", "body": data, "more_body": more_body})
+
+        await self.app(scope, receive, send_compressed)
+
+app.add_middleware(CompressionMiddleware)
+
+# Huella del header Authorization, para no guardar tokens en claves internas
+def auth_fingerprint(authorization: Optional[str]) -> str:
+    return hashlib.sha256((authorization or "").encode("utf-8")).hexdigest()
+
+# Agrupa llamadas idénticas en vuelo: la primera hace la petición y el resto espera su resultado
+class SingleFlight:
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.leaders = 0
+        self.followers = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]):
+        future = self._inflight.get(key)
+        if future is not None:
+            self.followers += 1
+            COALESCED_REQUESTS.labels("follower").inc()
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if future.cancelled():  # El líder fue cancelado; hacer la llamada por cuenta propia
+                    return await fn()
+                raise
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        self.leaders += 1
+        COALESCED_REQUESTS.labels("leader").inc()
         try:
-            if method == "POST":
-                response = await client.post(url, json=json, data=data, files=files, headers=headers)
-            elif method == "GET":
-                response = await client.get(url, headers=headers)
-            elif method == "PUT":
-                response = await client.put(url, json=json, data=data, files=files, headers=headers)
-            elif method == "DELETE":
-                response = await client.delete(url, headers=headers)
-            else:
-                raise ValueError(f"Método no soportado: {method}")
-            response.raise_for_status()
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # Marcar como recuperada aunque no haya seguidores
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._inflight[key]
+
+    def stats(self) -> dict:
+        return {
+            "enabled": COALESCE_ENABLED,
+            "routes": sorted(COALESCE_ROUTES),
+            "in_flight": len(self._inflight),
+            "upstream_calls": self.leaders,
+            "coalesced": self.followers,
+        }
+
+single_flight = SingleFlight()
+
+def should_coalesce(route: str) -> bool:
+    return COALESCE_ENABLED and route in COALESCE_ROUTES
+
+# Helper function para manejar solicitudes HTTP
+async def forward_request(method: str, url: str, json=None, data=None, files=None, headers=None, timeout=HTTP_TIMEOUT, coalesce: bool = False, vary_on_auth: bool = False):
+    if method not in ("GET", "POST", "PUT", "DELETE"):
+        raise ValueError(f"Método no soportado: {method}")
+    if coalesce and method == "GET":
+        key = f"GET {url}"
+        if vary_on_auth:
+            key += "|" + auth_fingerprint((headers or {}).get("Authorization"))
+        return await single_flight.do(key, lambda: _send_request(method, url, headers=headers, timeout=timeout))
+    return await _send_request(method, url, json=json, data=data, files=files, headers=headers, timeout=timeout)
+
+# Respuesta rápida cuando el servicio está marcado como caído o saturado
+def upstream_unavailable(e: UpstreamUnavailable) -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail=f"Servicio temporalmente no disponible: {e.base_url}",
+        headers={"Retry-After": str(max(1, int(e.retry_after + 0.999)))},
+    )
+
+# Cuerpo JSON de un servicio reenviado tal cual, sin decodificarlo ni volver a serializarlo.
+# La misma instancia se comparte entre la caché y el single-flight, así que cada envío
+# usa su propia copia de los headers (los middlewares modifican la lista al vuelo).
+class RawJSONResponse(Response):
+    media_type = "application/json"
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": list(self.raw_headers)})
+        await send({"type": "http.response.body", "body": self.body})
+
+# Decodifica un resultado de forward_request cuando el gateway necesita sus datos
+def json_body(value):
+    if isinstance(value, RawJSONResponse):
+        return orjson.loads(value.body)
+    return value
+
+async def _send_request(method: str, url: str, json=None, data=None, files=None, headers=None, timeout=HTTP_TIMEOUT, content=None):
+    upstream = get_upstream(url)
+    upstream.retry_budget.deposit()
+    # Solo se reintentan las lecturas: repetir una escritura podría duplicarla
+    idempotent = method in ("GET", "HEAD") and content is None
+    attempt = 0
+    start = time.perf_counter()
+    status = "error"
+    try:
+        while True:
             try:
-                if "Content-Type" in response.headers and "image" in response.headers["Content-Type"]:
-                    return StreamingResponse(
-                        content=response.iter_bytes(),
-                        status_code=response.status_code,
-                        headers={"Content-Type": response.headers.get("Content-Type", "image/png")}
-                    )
-                return response.json()
-            except ValueError:
-                return response.text
-        except httpx.HTTPStatusError as e:
-            logger.error(f"Error en {method} a {url}: {e.response.status_code} - {e.response.text}")
-            raise HTTPException(status_code=e.response.status_code, detail=e.response.json())
-        except httpx.RequestError as e:
-            logger.error(f"Error de red en {method} a {url}: {str(e)}")
-            raise HTTPException(status_code=503, detail=f"No se pudo conectar al servicio en {url}")
-
-# WebSocket proxy
-async def forward_websocket(websocket: WebSocket, url: str):
-    async with httpx.AsyncClient() as client:
+                async with upstream.slot() as client:
+                    if content is not None:
+                        response = await client.request(method, url, content=content, headers=headers, timeout=timeout)
+                    elif method in ("POST", "PUT"):
+                        response = await client.request(method, url, json=json, data=data, files=files, headers=headers, timeout=timeout)
+                    else:
+                        response = await client.request(method, url, headers=headers, timeout=timeout)
+                    status = str(response.status_code)
+                    response.raise_for_status()
+                break
+            except (httpx.HTTPStatusError, httpx.TransportError) as e:
+                retryable = (
+                    e.response.status_code in RETRYABLE_STATUS
+                    if isinstance(e, httpx.HTTPStatusError)
+                    else not isinstance(e, httpx.PoolTimeout)
+                )
+                if not (idempotent and retryable and attempt < RETRY_MAX_ATTEMPTS and upstream.retry_budget.withdraw()):
+                    raise
+                attempt += 1
+                UPSTREAM_RETRIES.labels(upstream.base_url).inc()
+                # Backoff exponencial con jitter completo para no sincronizar los reintentos
+                delay = random.uniform(0, RETRY_BACKOFF_BASE * 2 ** attempt)
+                logger.warning(f"Reintento {attempt} de {method} a {url} en {delay:.3f}s: {str(e)}")
+                await asyncio.sleep(delay)
+        try:
+            if "Content-Type" in response.headers and "image" in response.headers["Content-Type"]:
+                return StreamingResponse(
+                    content=response.iter_bytes(),
+                    status_code=response.status_code,
+                    headers={"Content-Type": response.headers.get("Content-Type", "image/png")}
+                )
+            if response.headers.get("Content-Type", "").startswith("application/json"):
+                return RawJSONResponse(response.content)
+            return response.json()
+        except ValueError:
+            return response.text
+    except httpx.HTTPStatusError as e:
+        logger.error(f"Error en {method} a {url}: {e.response.status_code} - {e.response.text}")
+        raise HTTPException(status_code=e.response.status_code, detail=e.response.json())
+    except httpx.RequestError as e:
+        logger.error(f"Error de red en {method} a {url}: {str(e)}")
+        raise HTTPException(status_code=503, detail=f"No se pudo conectar al servicio en {url}")
+    except UpstreamUnavailable as e:
+        logger.warning(f"Petición {method} a {url} rechazada: {str(e)}")
+        raise upstream_unavailable(e)
+    finally:
+        UPSTREAM_LATENCY.labels(upstream.base_url, method, status).observe(time.perf_counter() - start)
+
+class UploadTooLarge(Exception):
+    pass
+
+# Estadísticas de subidas transmitidas por ruta
+class UploadStats:
+    def __init__(self):
+        self.uploads = 0
+        self.rejected = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def stats(self) -> dict:
+        return {
+            "uploads": self.uploads,
+            "rejected": self.rejected,
+            "bytes": self.bytes,
+            "avg_bytes": self.bytes / self.uploads if self.uploads else 0,
+            "throughput_mb_s": (self.bytes / self.seconds / (1024 * 1024)) if self.seconds else 0.0,
+        }
+
+upload_stats: Dict[str, UploadStats] = {}
+
+# Proxy de formularios multipart: el cuerpo se reenvía por trozos sin cargarlo entero en memoria
+async def forward_upload(method: str, url: str, request: Request, route: str):
+    stats = upload_stats.setdefault(route, UploadStats())
+    content_type = request.headers.get("Content-Type", "")
+    if not content_type.startswith("multipart/form-data"):
+        raise HTTPException(status_code=400, detail="Se esperaba un formulario multipart/form-data")
+
+    headers = {**auth_headers(request), "Content-Type": content_type}
+    content_length = request.headers.get("Content-Length")
+    if content_length is not None:
+        if not content_length.isdigit():
+            raise HTTPException(status_code=400, detail="Content-Length inválido")
+        if int(content_length) > UPLOAD_MAX_BYTES:
+            stats.rejected += 1
+            raise HTTPException(status_code=413, detail=f"El archivo excede el tamaño máximo de {UPLOAD_MAX_BYTES} bytes")
+        headers["Content-Length"] = content_length
+
+    received = 0
+
+    async def body():
+        nonlocal received
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > UPLOAD_MAX_BYTES:
+                raise UploadTooLarge()
+            yield chunk
+
+    start = time.perf_counter()
+    try:
+        result = await _send_request(method, url, headers=headers, timeout=UPLOAD_TIMEOUT, content=body())
+    except UploadTooLarge:
+        stats.rejected += 1
+        raise HTTPException(status_code=413, detail=f"El archivo excede el tamaño máximo de {UPLOAD_MAX_BYTES} bytes")
+    elapsed = time.perf_counter() - start
+    stats.uploads += 1
+    stats.bytes += received
+    stats.seconds += elapsed
+    logger.info(f"Subida transmitida a {url}: {received} bytes en {elapsed:.3f}s ({received / elapsed / (1024 * 1024) if elapsed else 0:.2f} MB/s)")
+    return result
+
+# Sesión de un cliente WebSocket transportada sobre un enlace multiplexado
+class ProxySession:
+    def __init__(self, websocket: WebSocket, conn_id: int, link: "MuxLink"):
+        self.websocket = websocket
+        self.conn_id = conn_id
+        self.link = link
+        # Cola acotada hacia el cliente: un cliente lento no puede acumular memoria sin límite
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=WS_SEND_QUEUE_SIZE)
+        self.closed = False
+
+    def deliver(self, data: str):
+        if self.closed:
+            return
+        try:
+            self.queue.put_nowait(data)
+        except asyncio.QueueFull:
+            self.link.mux.dropped += 1
+            logger.warning(f"Cola de envío llena para la conexión {self.conn_id}; cerrando cliente lento")
+            self.close(1013, "Cola de envío llena")
+
+    def close(self, code: int = 1000, reason: str = ""):
+        if self.closed:
+            return
+        self.closed = True
+        if self.queue.full():
+            while not self.queue.empty():
+                self.queue.get_nowait()
+        self.queue.put_nowait((code, reason))
+
+    # Backend -> cliente
+    async def run_writer(self):
+        while True:
+            item = await self.queue.get()
+            if isinstance(item, tuple):
+                code, reason = item
+                await self.websocket.close(code=code, reason=reason)
+                return
+            await self.websocket.send_text(item)
+
+    # Cliente -> backend; esperar al envío por el enlace aplica contrapresión sobre el cliente
+    async def run_reader(self):
+        while True:
+            message = await self.websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            data = message.get("text")
+            if data is None and message.get("bytes") is not None:
+                data = message["bytes"].decode("utf-8", errors="replace")
+            await self.link.send({"op": "data", "conn": self.conn_id, "data": data})
+
+# Conexión WebSocket persistente hacia el endpoint /ws/mux de un servicio
+class MuxLink:
+    def __init__(self, mux: "WebSocketMux", index: int):
+        self.mux = mux
+        self.index = index
+        self.ws = None
+        self.connected = False
+        self.sessions: Dict[int, ProxySession] = {}
+        self._lock = asyncio.Lock()
+        self._reader: Optional[asyncio.Task] = None
+
+    async def ensure_connected(self):
+        if self.connected:
+            return
+        async with self._lock:
+            if self.connected:
+                return
+            self.ws = await websockets.connect(
+                self.mux.url,
+                ping_interval=WS_PING_INTERVAL,
+                ping_timeout=WS_PING_TIMEOUT,
+            )
+            self.connected = True
+            self._reader = asyncio.create_task(self._read(self.ws))
+            logger.info(f"Enlace WebSocket {self.mux.name}#{self.index} conectado a {self.mux.url}")
+
+    async def send(self, frame: dict):
+        if not self.connected:
+            raise ConnectionError(f"Enlace WebSocket {self.mux.name}#{self.index} no disponible")
+        await self.ws.send(json.dumps(frame))
+
+    async def _read(self, ws):
         try:
-            async with client.stream("GET", url, timeout=None) as response:
-                await websocket.accept()
-                async for chunk in response.aiter_bytes():
-                    await websocket.send_bytes(chunk)
+            async for raw in ws:
+                frame = json.loads(raw)
+                conn_id = frame.get("conn")
+                if frame.get("op") == "data":
+                    session = self.sessions.get(conn_id)
+                    if session is not None:
+                        session.deliver(frame.get("data", ""))
+                elif frame.get("op") == "close":
+                    session = self.sessions.pop(conn_id, None)
+                    if session is not None:
+                        session.close(frame.get("code", 1000), frame.get("reason", ""))
+        except websockets.ConnectionClosed:
+            pass
         except Exception as e:
-            logger.error(f"Error en WebSocket proxy a {url}: {str(e)}")
-            await websocket.close()
+            logger.error(f"Error leyendo del enlace WebSocket {self.mux.name}#{self.index}: {str(e)}")
+        finally:
+            self.connected = False
+            if self.sessions:
+                logger.warning(f"Enlace WebSocket {self.mux.name}#{self.index} cerrado; cerrando {len(self.sessions)} sesiones")
+            for session in self.sessions.values():
+                session.close(1012, "Servicio no disponible, reconecte")
+            self.sessions.clear()
+
+    async def aclose(self):
+        if self.ws is not None:
+            await self.ws.close()
+        # El lector termina solo al cerrarse el socket; se cancela por si el cierre no llegó a completarse
+        if self._reader is not None:
+            self._reader.cancel()
+            await asyncio.gather(self._reader, return_exceptions=True)
+            self._reader = None
+
+# Multiplexa muchas conexiones de clientes sobre unos pocos enlaces por servicio
+class WebSocketMux:
+    def __init__(self, name: str, base_url: str):
+        self.name = name
+        self.url = "ws" + base_url[len("http"):] + "/ws/mux" if base_url.startswith("http") else base_url + "/ws/mux"
+        self.links = [MuxLink(self, index) for index in range(WS_MUX_LINKS)]
+        self._ids = itertools.count(1)
+        self.opened = 0
+        self.dropped = 0
+
+    async def open(self, websocket: WebSocket, user_id: str, verified_user_id: Optional[str] = None) -> ProxySession:
+        conn_id = next(self._ids)
+        link = self.links[conn_id % len(self.links)]
+        await link.ensure_connected()
+        session = ProxySession(websocket, conn_id, link)
+        link.sessions[conn_id] = session
+        await link.send({"op": "open", "conn": conn_id, "user_id": user_id, "verified_user_id": verified_user_id})
+        self.opened += 1
+        return session
+
+    async def release(self, session: ProxySession):
+        link = session.link
+        if link.sessions.pop(session.conn_id, None) is not None and link.connected:
+            try:
+                await link.send({"op": "close", "conn": session.conn_id})
+            except Exception as e:
+                logger.warning(f"No se pudo notificar el cierre de la conexión {session.conn_id}: {str(e)}")
+
+    def stats(self) -> dict:
+        return {
+            "url": self.url,
+            "links": len(self.links),
+            "links_connected": sum(1 for link in self.links if link.connected),
+            "active_sessions": sum(len(link.sessions) for link in self.links),
+            "opened": self.opened,
+            "dropped_slow_clients": self.dropped,
+        }
+
+    async def aclose(self):
+        for link in self.links:
+            await link.aclose()
+
+ws_muxes: Dict[str, WebSocketMux] = {}
+
+# Proxy WebSocket bidireccional a través del enlace multiplexado del servicio
+async def proxy_websocket(websocket: WebSocket, service: str, user_id: str, forward_handshake: bool = False):
+    mux = ws_muxes[service]
+    await websocket.accept()
+
+    # El primer mensaje es "Bearer <token>": se verifica aquí antes de abrir la sesión, porque el
+    # middleware de autenticación solo cubre HTTP. El chat lo recibe también (forward_handshake)
+    handshake = None
+    try:
+        handshake = await websocket.receive_text()
+    except WebSocketDisconnect:
+        return
+    verified_user_id = token_verifier.verify(bearer_token(handshake)) if bearer_token(handshake) else None
+    if verified_user_id != user_id:
+        logger.warning(f"Token WebSocket rechazado para user_id: {user_id}")
+        await websocket.close(code=1008, reason="Token inválido o expirado")
+        return
+
+    try:
+        session = await mux.open(websocket, user_id, verified_user_id)
+        if forward_handshake:
+            await session.link.send({"op": "data", "conn": session.conn_id, "data": handshake})
+    except Exception as e:
+        logger.error(f"Error conectando al backend WebSocket {mux.url}: {str(e)}")
+        await websocket.close(code=1011)
+        return
+
+    reader = asyncio.create_task(session.run_reader())
+    writer = asyncio.create_task(session.run_writer())
+    WEBSOCKET_CONNECTIONS.labels(service).inc()
+    try:
+        done, _ = await asyncio.wait({reader, writer}, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if not task.cancelled() and task.exception() is not None and not isinstance(task.exception(), WebSocketDisconnect):
+                logger.error(f"Error en WebSocket {service} para user_id: {user_id}: {str(task.exception())}")
+    finally:
+        WEBSOCKET_CONNECTIONS.labels(service).dec()
+        reader.cancel()
+        writer.cancel()
+        await mux.release(session)
+    logger.info(f"Cliente WebSocket {service} desconectado para user_id: {user_id}")
+
+# Interfaz del almacén de la caché, para poder sustituir la memoria local por uno compartido
+class CacheBackend:
+    async def get(self, key: str) -> Tuple[bool, Any]:
+        raise NotImplementedError
+
+    async def set(self, key: str, value: Any, ttl: float, tags: Iterable[str]):
+        raise NotImplementedError
+
+    async def invalidate_tags(self, tags: Iterable[str]) -> int:
+        raise NotImplementedError
+
+    def size(self) -> int:
+        raise NotImplementedError
+
+# Caché LRU en memoria con expiración por TTL e índice de etiquetas para invalidar
+class MemoryCacheBackend(CacheBackend):
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, Any, Tuple[str, ...]]]" = OrderedDict()
+        self._tags: Dict[str, Set[str]] = {}
+        self.evictions = 0
+
+    def _remove(self, key: str):
+        _, _, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    async def get(self, key: str) -> Tuple[bool, Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+        expires_at, value, _ = entry
+        if expires_at < time.monotonic():
+            self._remove(key)
+            return False, None
+        self._entries.move_to_end(key)
+        return True, value
+
+    async def set(self, key: str, value: Any, ttl: float, tags: Iterable[str]):
+        if key in self._entries:
+            self._remove(key)
+        tags = tuple(tags)
+        self._entries[key] = (time.monotonic() + ttl, value, tags)
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(key)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    async def invalidate_tags(self, tags: Iterable[str]) -> int:
+        removed = 0
+        for tag in tags:
+            for key in list(self._tags.get(tag, ())):
+                self._remove(key)
+                removed += 1
+        return removed
+
+    def size(self) -> int:
+        return len(self._entries)
+
+# Caché de lectura para rutas GET seleccionadas
+class ResponseCache:
+    def __init__(self, backend: CacheBackend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        # Versión por etiqueta: evita guardar una respuesta obtenida antes de una escritura concurrente
+        self._tag_versions: Dict[str, int] = {}
+
+    async def get_or_fetch(self, key: str, tags: Iterable[str], fetch: Callable[[], Awaitable[Any]], ttl: float = CACHE_TTL):
+        if not CACHE_ENABLED:
+            return await fetch()
+        found, value = await self.backend.get(key)
+        if found:
+            self.hits += 1
+            CACHE_LOOKUPS.labels("hit").inc()
+            return value
+        self.misses += 1
+        CACHE_LOOKUPS.labels("miss").inc()
+        tags = tuple(tags)
+        versions = [self._tag_versions.get(tag, 0) for tag in tags]
+        value = await fetch()
+        if isinstance(value, (dict, list, RawJSONResponse)) and versions == [self._tag_versions.get(tag, 0) for tag in tags]:
+            await self.backend.set(key, value, ttl, tags)
+        return value
+
+    async def invalidate(self, *tags: str):
+        for tag in tags:
+            self._tag_versions[tag] = self._tag_versions.get(tag, 0) + 1
+        removed = await self.backend.invalidate_tags(tags)
+        self.invalidations += removed
+        logger.info(f"Caché invalidada para {list(tags)}: {removed} entradas")
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": CACHE_ENABLED,
+            "entries": self.backend.size(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "evictions": getattr(self.backend, "evictions", 0),
+        }
+
+response_cache = ResponseCache(MemoryCacheBackend(CACHE_MAX_ENTRIES))
+
+# Clave de caché; incluye la identidad del llamante en rutas cuya respuesta depende de ella
+def cache_key(request: Request, vary_on_auth: bool = False) -> str:
+    key = f"{request.url.path}?{request.url.query}"
+    if vary_on_auth:
+        key += "|" + auth_fingerprint(request.headers.get("Authorization", ""))
+    return key
+
+# Perfil de usuario a través de la caché y el single-flight
+async def fetch_user(user_id: str, headers: dict):
+    return await response_cache.get_or_fetch(
+        f"/users/{user_id}?",
+        [f"user:{user_id.lower()}"],
+        lambda: forward_request("GET", f"{USER_SERVICE_URL}/users/{user_id}", headers=headers, coalesce=should_coalesce("get_user")),
+    )
+
+# Estado de bookmark de un post para un usuario a través de la caché y el single-flight
+async def fetch_bookmark_state(user_id: str, post_id: str, headers: dict):
+    return await response_cache.get_or_fetch(
+        f"/bookmarks/check?user_id={user_id}&post_id={post_id}|{auth_fingerprint(headers.get('Authorization'))}",
+        [f"bookmark:{user_id}:{post_id}"],
+        lambda: forward_request("GET", f"{BOOKMARK_SERVICE_URL}/bookmarks/check?user_id={user_id}&post_id={post_id}", headers=headers, coalesce=should_coalesce("check_bookmark"), vary_on_auth=True),
+    )
+
+# Estado de bookmark de varios posts en una sola llamada; la entrada se invalida con cualquiera de ellos
+async def fetch_bookmark_states(user_id: str, post_ids: List[str], headers: dict):
+    query = urlencode({"user_id": user_id, "post_ids": ",".join(post_ids)})
+    return await response_cache.get_or_fetch(
+        f"/bookmarks/check-batch?{query}|{auth_fingerprint(headers.get('Authorization'))}",
+        [f"bookmark:{user_id}:{post_id}" for post_id in post_ids],
+        lambda: forward_request("GET", f"{BOOKMARK_SERVICE_URL}/bookmarks/check-batch?{query}", headers=headers),
+    )
+
+# Likes de un usuario en varios posts en una sola llamada; la entrada se invalida con cualquiera de ellos
+async def fetch_like_states(user_id: str, post_ids: List[str], headers: dict):
+    query = urlencode({"user_id": user_id, "post_ids": ",".join(post_ids)})
+    return await response_cache.get_or_fetch(
+        f"/likes/check-batch?{query}|{auth_fingerprint(headers.get('Authorization'))}",
+        [f"like:{user_id}:{post_id}" for post_id in post_ids],
+        lambda: forward_request("GET", f"{POST_SERVICE_URL}/likes/check-batch?{query}", headers=headers),
+    )
 
 # Auth Service
 @app.post("/auth/login")
@@ -90,233 +1285,475 @@ async def login(request: Request):
 async def create_user(request: Request):
     logger.info(f"Enviando solicitud de registro a {USER_SERVICE_URL}/users")
     data = await request.json()
-    return await forward_request("POST", f"{USER_SERVICE_URL}/users", json=data)
+    result = await forward_request("POST", f"{USER_SERVICE_URL}/users", json=data)
+    await response_cache.invalidate("search:users")
+    return result
 
 @app.get("/users/{user_id}")
 async def get_user(user_id: str, request: Request):
-    headers = {"Authorization": request.headers.get("Authorization", "")}
+    headers = auth_headers(request)
     logger.info(f"Enviando solicitud de usuario a {USER_SERVICE_URL}/users/{user_id}")
-    return await forward_request("GET", f"{USER_SERVICE_URL}/users/{user_id}", headers=headers)
+    return await fetch_user(user_id, headers)
 
 @app.get("/users")
 async def get_all_users(request: Request):
-    headers = {"Authorization": request.headers.get("Authorization", "")}
+    headers = auth_headers(request)
     logger.info(f"Enviando solicitud de todos los usuarios a {USER_SERVICE_URL}/users")
     return await forward_request("GET", f"{USER_SERVICE_URL}/users", headers=headers)
 
 @app.put("/users/{user_id}")
 async def update_user(user_id: str, request: Request):
-    headers = {"Authorization": request.headers.get("Authorization", "")}
-    form_data = await request.form()
-    files = {}
-    data = {}
-
-    # Manejar archivos (profile_image y cover_image)
-    if "profile_image" in form_data and form_data["profile_image"] and form_data["profile_image"].filename:
-        file_content = await form_data["profile_image"].read()
-        if file_content:
-            files["profile_image"] = (
-                form_data["profile_image"].filename,
-                file_content,
-                form_data["profile_image"].content_type
-            )
-    if "cover_image" in form_data and form_data["cover_image"] and form_data["cover_image"].filename:
-        file_content = await form_data["cover_image"].read()
-        if file_content:
-            files["cover_image"] = (
-                form_data["cover_image"].filename,
-                file_content,
-                form_data["cover_image"].content_type
-            )
-
-    # Manejar campos de texto (bio y name)
-    if "bio" in form_data and form_data["bio"] is not None:
-        data["bio"] = form_data["bio"]
-    if "name" in form_data and form_data["name"] is not None:
-        data["name"] = form_data["name"]
-
-    if not files and not data:
-        raise HTTPException(status_code=400, detail="No se proporcionaron datos ni archivos para actualizar")
-
-    logger.info(f"Enviando solicitud de actualización de usuario a {USER_SERVICE_URL}/users/{user_id} con data: {data}, files: {list(files.keys())}")
-    return await forward_request("PUT", f"{USER_SERVICE_URL}/users/{user_id}", data=data, files=files, headers=headers)
+    logger.info(f"Transmitiendo actualización de usuario a {USER_SERVICE_URL}/users/{user_id}")
+    result = await forward_upload("PUT", f"{USER_SERVICE_URL}/users/{user_id}", request, "update_user")
+    await response_cache.invalidate(f"user:{user_id.lower()}", "search:users")
+    return result
 
 @app.put("/users/{user_id}/update-follow-count")
 async def update_follow_count(user_id: str, request: Request):
-    headers = {"Authorization": request.headers.get("Authorization", "")}
+    headers = auth_headers(request)
     logger.info(f"Enviando solicitud de actualización de contador a {USER_SERVICE_URL}/users/{user_id}/update-follow-count")
-    return await forward_request("PUT", f"{USER_SERVICE_URL}/users/{user_id}/update-follow-count", headers=headers, json=await request.json())
+    result = await forward_request("PUT", f"{USER_SERVICE_URL}/users/{user_id}/update-follow-count", headers=headers, json=await request.json())
+    await response_cache.invalidate(f"user:{user_id.lower()}")
+    return result
 
 # Post Service
 @app.post("/posts")
 async def create_post(request: Request):
-    form_data = await request.form()
-    files = {"image": (form_data["image"].filename, await form_data["image"].read(), form_data["image"].content_type)} if "image" in form_data and form_data["image"] and form_data["image"].filename else None
-    data = {key: form_data[key] for key in form_data if key != "image"}
-    headers = {"Authorization": request.headers.get("Authorization", "")}
-    logger.info(f"Enviando solicitud de creación de post a {POST_SERVICE_URL}/posts")
-    return await forward_request("POST", f"{POST_SERVICE_URL}/posts", data=data, files=files, headers=headers)
+    logger.info(f"Transmitiendo creación de post a {POST_SERVICE_URL}/posts")
+    return await forward_upload("POST", f"{POST_SERVICE_URL}/posts", request, "create_post")
+
+# Página de un listado paginado por cursor; los parámetros se pasan tal cual al post-service
+def page_url(url: str, **params) -> str:
+    params = {name: value for name, value in params.items() if value is not None}
+    return f"{url}?{urlencode(params)}" if params else url
 
 @app.get("/posts")
-async def get_all_posts(request: Request):
-    headers = {"Authorization": request.headers.get("Authorization", "")}
-    logger.info(f"Enviando solicitud de todos los posts a {POST_SERVICE_URL}/posts")
-    return await forward_request("GET", f"{POST_SERVICE_URL}/posts", headers=headers)
+async def get_all_posts(request: Request, limit: Optional[int] = None, cursor: Optional[str] = None, user_id: Optional[str] = None):
+    headers = auth_headers(request)
+    url = page_url(f"{POST_SERVICE_URL}/posts", limit=limit, cursor=cursor, user_id=user_id)
+    logger.info(f"Enviando solicitud de posts a {url}")
+    return await forward_request("GET", url, headers=headers)
 
+# Timeline de inicio materializado (posts de los usuarios seguidos y propios)
+@app.get("/timeline/{user_id}")
+async def get_timeline(user_id: str, request: Request, limit: Optional[int] = None, cursor: Optional[str] = None):
+    headers = auth_headers(request)
+    url = page_url(f"{POST_SERVICE_URL}/timeline/{user_id}", limit=limit, cursor=cursor)
+    logger.info(f"Enviando solicitud de timeline a {url}")
+    return await forward_request("GET", url, headers=headers)
+
+# Posts en tendencia; la respuesta incluye el like del llamante, así que solo se agrupa por credenciales
+@app.get("/posts/trending")
+async def get_trending_posts(request: Request, limit: Optional[int] = None):
+    headers = auth_headers(request)
+    url = page_url(f"{POST_SERVICE_URL}/posts/trending", limit=limit)
+    logger.info(f"Enviando solicitud de trending a {url}")
+    return await forward_request("GET", url, headers=headers, coalesce=should_coalesce("get_trending"), vary_on_auth=True)
+
+# El resumen lleva liked_by_me del llamante: la entrada de caché es por usuario y
+# cualquier like o comentario del post invalida las de todos con la etiqueta post:{post_id}
 @app.get("/posts/{post_id}")
 async def get_post(post_id: str, request: Request):
-    headers = {"Authorization": request.headers.get("Authorization", "")}
+    headers = auth_headers(request)
     logger.info(f"Enviando solicitud de post a {POST_SERVICE_URL}/posts/{post_id}")
-    return await forward_request("GET", f"{POST_SERVICE_URL}/posts/{post_id}", headers=headers)
+    return await response_cache.get_or_fetch(
+        cache_key(request, vary_on_auth=True),
+        [f"post:{post_id}"],
+        lambda: forward_request("GET", f"{POST_SERVICE_URL}/posts/{post_id}", headers=headers, coalesce=should_coalesce("get_post"), vary_on_auth=True),
+    )
+
+# Solo el autor puede borrar un post; el post-service lo comprueba con X-User-Id
+@app.delete("/posts/{post_id}")
+async def delete_post(post_id: str, request: Request):
+    headers = auth_headers(request)
+    logger.info(f"Enviando borrado de post a {POST_SERVICE_URL}/posts/{post_id}")
+    result = await forward_request("DELETE", f"{POST_SERVICE_URL}/posts/{post_id}", headers=headers)
+    await response_cache.invalidate(f"post:{post_id}")
+    return result
 
 @app.post("/posts/{post_id}/likes")
 async def toggle_like(post_id: str, request: Request):
     data = await request.form()
-    headers = {"Authorization": request.headers.get("Authorization", "")}
+    headers = auth_headers(request)
     logger.info(f"Enviando solicitud de like a {POST_SERVICE_URL}/posts/{post_id}/likes")
-    return await forward_request("POST", f"{POST_SERVICE_URL}/posts/{post_id}/likes", data=data, headers=headers)
+    result = await forward_request("POST", f"{POST_SERVICE_URL}/posts/{post_id}/likes", data=data, headers=headers)
+    await response_cache.invalidate(f"post:{post_id}", f"like:{data.get('user_id')}:{post_id}")
+    return result
+
+@app.get("/likes/check-batch")
+async def check_likes_batch(user_id: str, post_ids: str, request: Request):
+    headers = auth_headers(request)
+    ids = [post_id.strip() for post_id in post_ids.split(",") if post_id.strip()]
+    logger.info(f"Enviando verificación de {len(ids)} likes a {POST_SERVICE_URL}/likes/check-batch")
+    return await fetch_like_states(user_id, ids, headers)
 
 @app.post("/posts/{post_id}/comments")
 async def add_comment(post_id: str, request: Request):
     data = await request.json()
-    headers = {"Authorization": request.headers.get("Authorization", "")}
+    headers = auth_headers(request)
     logger.info(f"Enviando solicitud de comentario a {POST_SERVICE_URL}/posts/{post_id}/comments")
-    return await forward_request("POST", f"{POST_SERVICE_URL}/posts/{post_id}/comments", json=data, headers=headers)
+    result = await forward_request("POST", f"{POST_SERVICE_URL}/posts/{post_id}/comments", json=data, headers=headers)
+    await response_cache.invalidate(f"post:{post_id}")
+    return result
+
+# Comentarios paginados por cursor; llevan el like del llamante, así que no se cachean
+@app.get("/posts/{post_id}/comments")
+async def get_comments(post_id: str, request: Request, limit: Optional[int] = None, cursor: Optional[str] = None):
+    headers = auth_headers(request)
+    url = page_url(f"{POST_SERVICE_URL}/posts/{post_id}/comments", limit=limit, cursor=cursor)
+    logger.info(f"Enviando solicitud de comentarios a {url}")
+    return await forward_request("GET", url, headers=headers)
 
-@app.post("/posts/{post_id}/comments/{comment_index}/likes")
-async def toggle_comment_like(post_id: str, comment_index: int, request: Request):
+@app.post("/posts/{post_id}/comments/{comment_id}/likes")
+async def toggle_comment_like(post_id: str, comment_id: str, request: Request):
     data = await request.form()
-    headers = {"Authorization": request.headers.get("Authorization", "")}
-    logger.info(f"Enviando solicitud de like a comentario a {POST_SERVICE_URL}/posts/{post_id}/comments/{comment_index}/likes")
-    return await forward_request("POST", f"{POST_SERVICE_URL}/posts/{post_id}/comments/{comment_index}/likes", data=data, headers=headers)
+    headers = auth_headers(request)
+    logger.info(f"Enviando solicitud de like a comentario a {POST_SERVICE_URL}/posts/{post_id}/comments/{comment_id}/likes")
+    result = await forward_request("POST", f"{POST_SERVICE_URL}/posts/{post_id}/comments/{comment_id}/likes", data=data, headers=headers)
+    await response_cache.invalidate(f"post:{post_id}")
+    return result
 
 # Friend Service
+# Seguir o dejar de seguir cambia los seguidores y los contadores de ambos perfiles
+async def invalidate_follow(user_id: str, follow_id: str):
+    user_id = user_id.lower().strip()
+    follow_id = follow_id.lower().strip()
+    await response_cache.invalidate(f"followers:{follow_id}", f"user:{user_id}", f"user:{follow_id}")
+
 @app.post("/friends/follow/{follow_id}")
 async def follow_user(follow_id: str, request: Request):
     data = await request.json()
-    headers = {"Authorization": request.headers.get("Authorization", "")}
+    headers = auth_headers(request)
     logger.info(f"Enviando solicitud de seguir a {FRIEND_SERVICE_URL}/friends/follow/{follow_id}")
-    return await forward_request("POST", f"{FRIEND_SERVICE_URL}/friends/follow/{follow_id}", json=data, headers=headers)
+    result = await forward_request("POST", f"{FRIEND_SERVICE_URL}/friends/follow/{follow_id}", json=data, headers=headers)
+    await invalidate_follow(data.get("user_id", ""), follow_id)
+    return result
 
 @app.post("/friends/unfollow/{follow_id}")
 async def unfollow_user(follow_id: str, request: Request):
     data = await request.json()
-    headers = {"Authorization": request.headers.get("Authorization", "")}
+    headers = auth_headers(request)
     logger.info(f"Enviando solicitud de dejar de seguir a {FRIEND_SERVICE_URL}/friends/unfollow/{follow_id}")
-    return await forward_request("POST", f"{FRIEND_SERVICE_URL}/friends/unfollow/{follow_id}", json=data, headers=headers)
+    result = await forward_request("POST", f"{FRIEND_SERVICE_URL}/friends/unfollow/{follow_id}", json=data, headers=headers)
+    await invalidate_follow(data.get("user_id", ""), follow_id)
+    return result
 
 @app.get("/friends/following/{user_id}")
 async def get_following(user_id: str, request: Request):
-    headers = {"Authorization": request.headers.get("Authorization", "")}
+    headers = auth_headers(request)
     logger.info(f"Enviando solicitud de usuarios seguidos a {FRIEND_SERVICE_URL}/friends/following/{user_id}")
     return await forward_request("GET", f"{FRIEND_SERVICE_URL}/friends/following/{user_id}", headers=headers)
 
 @app.get("/friends/followers/{user_id}")
 async def get_followers(user_id: str, request: Request):
-    headers = {"Authorization": request.headers.get("Authorization", "")}
+    headers = auth_headers(request)
     logger.info(f"Enviando solicitud de seguidores a {FRIEND_SERVICE_URL}/friends/followers/{user_id}")
-    return await forward_request("GET", f"{FRIEND_SERVICE_URL}/friends/followers/{user_id}", headers=headers)
+    return await response_cache.get_or_fetch(
+        cache_key(request, vary_on_auth=True),
+        [f"followers:{user_id.lower().strip()}"],
+        lambda: forward_request("GET", f"{FRIEND_SERVICE_URL}/friends/followers/{user_id}", headers=headers, coalesce=should_coalesce("get_followers"), vary_on_auth=True),
+    )
 
 @app.get("/friends/{user_id}")
 async def get_friends(user_id: str, request: Request):
-    headers = {"Authorization": request.headers.get("Authorization", "")}
+    headers = auth_headers(request)
     logger.info(f"Enviando solicitud de amigos a {FRIEND_SERVICE_URL}/friends/{user_id}")
     return await forward_request("GET", f"{FRIEND_SERVICE_URL}/friends/{user_id}", headers=headers)
 
 # Chat Service
 @app.get("/chat/messages/{user_id}/{receiver_id}")
 async def get_messages(user_id: str, receiver_id: str, request: Request):
-    headers = {"Authorization": request.headers.get("Authorization", "")}
+    headers = auth_headers(request)
     logger.info(f"Enviando solicitud de mensajes a {CHAT_SERVICE_URL}/chat/messages/{user_id}/{receiver_id}")
     return await forward_request("GET", f"{CHAT_SERVICE_URL}/chat/messages/{user_id}/{receiver_id}", headers=headers)
 
+@app.post("/chat/messages")
 @app.post("/alerts")
 async def send_message(request: Request):
     data = await request.json()
-    headers = {"Authorization": request.headers.get("Authorization", "")}
+    headers = auth_headers(request)
     logger.info(f"Enviando solicitud de envío de mensaje a {CHAT_SERVICE_URL}/chat/messages")
     return await forward_request("POST", f"{CHAT_SERVICE_URL}/chat/messages", json=data, headers=headers)
 
 # Notification Service
 @app.get("/notifications/{user_id}")
 async def get_notifications(user_id: str, request: Request):
-    headers = {"Authorization": request.headers.get("Authorization", "")}
+    headers = auth_headers(request)
     logger.info(f"Enviando solicitud de notificaciones a {NOTIFICATION_SERVICE_URL}/notifications/{user_id}")
     return await forward_request("GET", f"{NOTIFICATION_SERVICE_URL}/notifications/{user_id}", headers=headers)
 
 @app.websocket("/ws/notifications/{user_id}")
 async def websocket_notifications(websocket: WebSocket, user_id: str):
-    async with httpx.AsyncClient() as client:
-        ws_url = f"ws://{NOTIFICATION_SERVICE_URL.split('http://')[1]}/ws/notifications/{user_id}"
-        logger.info(f"Conectando WebSocket a {ws_url}")
-        try:
-            async with client.websocket(ws_url) as backend_ws:
-                await websocket.accept()
-                try:
-                    while True:
-                        data = await backend_ws.receive_json()
-                        await websocket.send_json(data)
-                except WebSocketDisconnect:
-                    logger.info(f"Cliente WebSocket desconectado para user_id: {user_id}")
-                except Exception as e:
-                    logger.error(f"Error en WebSocket para user_id: {user_id}: {str(e)}")
-                    await websocket.close()
-        except Exception as e:
-            logger.error(f"Error conectando al backend WebSocket {ws_url}: {str(e)}")
-            await websocket.close()
+    await proxy_websocket(websocket, "notification", user_id)
+
+# Chat en tiempo real
+@app.websocket("/ws/chat/{user_id}")
+async def websocket_chat(websocket: WebSocket, user_id: str):
+    await proxy_websocket(websocket, "chat", user_id, forward_handshake=True)
+
+# Servicio dueño de cada imagen según el prefijo del nombre (post-<uuid>_..., user-<uuid>_...)
+UPLOAD_OWNERS = {"post-": POST_SERVICE_URL, "user-": USER_SERVICE_URL}
+# Headers de la petición y de la respuesta que se transmiten tal cual en el proxy de imágenes
+UPLOAD_REQUEST_HEADERS = ("Range", "If-Range", "If-None-Match", "If-Modified-Since")
+UPLOAD_RESPONSE_HEADERS = ("Content-Type", "Content-Length", "Content-Range", "Accept-Ranges", "ETag", "Last-Modified", "Cache-Control")
+
+# Índice LRU de imágenes ya servidas: path (con la variante pedida) -> (servicio dueño, headers de caché).
+# Evita probar post-service y user-service para los nombres antiguos sin prefijo y
+# permite responder 304 sin llamar al servicio, ya que los archivos son inmutables.
+class UploadIndex:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[str, Dict[str, str]]]" = OrderedDict()
+        self.not_modified = 0
+        self.probes = 0
 
-# Proxy para servir imágenes desde el post-service o user-service
+    def get(self, path: str) -> Optional[Tuple[str, Dict[str, str]]]:
+        entry = self._entries.get(path)
+        if entry is not None:
+            self._entries.move_to_end(path)
+        return entry
+
+    def set(self, path: str, service_url: str, validators: Dict[str, str]):
+        self._entries[path] = (service_url, validators)
+        self._entries.move_to_end(path)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def owners(self, path: str) -> List[str]:
+        for prefix, service_url in UPLOAD_OWNERS.items():
+            if path.startswith(prefix):
+                return [service_url]
+        entry = self.get(path)
+        if entry is not None:
+            return [entry[0]]
+        self.probes += 1
+        return [POST_SERVICE_URL, USER_SERVICE_URL]
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "not_modified": self.not_modified, "probes": self.probes}
+
+upload_index = UploadIndex(UPLOAD_INDEX_SIZE)
+
+# Proxy para servir imágenes desde el post-service o user-service; size elige la variante
+# redimensionada (thumb, medium, full), que tiene su propio ETag
 @app.get("/uploads/{path:path}")
-async def serve_uploaded_file(path: str):
+async def serve_uploaded_file(path: str, request: Request, size: Optional[str] = None):
     logger.info(f"Intentando proxificar imagen: {path}")
-    async with httpx.AsyncClient() as client:
+    key = page_url(path, size=size)
+
+    # Revalidación resuelta en el gateway con el ETag ya conocido
+    entry = upload_index.get(key)
+    if_none_match = request.headers.get("If-None-Match")
+    if entry is not None and if_none_match and "Range" not in request.headers:
+        etag = entry[1].get("ETag")
+        if etag and any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(",")):
+            upload_index.not_modified += 1
+            return Response(status_code=304, headers=entry[1])
+
+    forward_headers = {name: request.headers[name] for name in UPLOAD_REQUEST_HEADERS if name in request.headers}
+    owners = upload_index.owners(key)
+    for position, service_url in enumerate(owners):
+        # El slot y la respuesta se liberan cuando termina de enviarse el cuerpo al cliente
+        stack = AsyncExitStack()
         try:
-            response = await client.get(f"{POST_SERVICE_URL}/uploads/{path}")
-            response.raise_for_status()
-            logger.info(f"Imagen obtenida de post-service: {path}")
-            return StreamingResponse(
-                content=response.iter_bytes(),
-                status_code=response.status_code,
-                headers={"Content-Type": response.headers.get("Content-Type", "image/png")}
-            )
-        except httpx.HTTPStatusError as e:
-            logger.warning(f"Imagen no encontrada en post-service: {path}, intentando con user-service")
-            try:
-                response = await client.get(f"{USER_SERVICE_URL}/uploads/{path}")
+            client = await stack.enter_async_context(get_upstream(service_url).slot())
+            upstream_request = client.build_request("GET", f"{service_url}/uploads/{key}", headers=forward_headers)
+            response = await client.send(upstream_request, stream=True)
+            stack.push_async_callback(response.aclose)
+            if response.status_code >= 500:
                 response.raise_for_status()
-                logger.info(f"Imagen obtenida de user-service: {path}")
-                return StreamingResponse(
-                    content=response.iter_bytes(),
-                    status_code=response.status_code,
-                    headers={"Content-Type": response.headers.get("Content-Type", "image/png")}
-                )
-            except httpx.HTTPStatusError as e2:
-                logger.error(f"Error al obtener imagen de user-service: {e2.response.status_code} - {e2.response.text}")
-                raise HTTPException(status_code=e2.response.status_code, detail="No se pudo obtener la imagen")
-        except httpx.RequestError as e:
-            logger.error(f"Error de red al obtener imagen: {str(e)}")
+        except UpstreamUnavailable as e:
+            logger.warning(f"Imagen {path} rechazada: {str(e)}")
+            raise upstream_unavailable(e)
+        except (httpx.RequestError, httpx.HTTPStatusError) as e:
+            # Cerrar la pila con la excepción para que el circuit breaker la cuente como fallo
+            await stack.__aexit__(type(e), e, e.__traceback__)
+            logger.error(f"Error al obtener imagen de {service_url}: {str(e)}")
+            if isinstance(e, httpx.HTTPStatusError):
+                raise HTTPException(status_code=e.response.status_code, detail="No se pudo obtener la imagen")
             raise HTTPException(status_code=503, detail="No se pudo conectar al servicio")
 
+        if response.status_code == 404 and position < len(owners) - 1:
+            await stack.aclose()
+            logger.warning(f"Imagen no encontrada en {service_url}: {path}, intentando con el siguiente servicio")
+            continue
+        if response.status_code >= 400 and response.status_code != 416:
+            await stack.aclose()
+            logger.error(f"Error al obtener imagen de {service_url}: {response.status_code}")
+            raise HTTPException(status_code=response.status_code, detail="No se pudo obtener la imagen")
+
+        headers = {name: response.headers[name] for name in UPLOAD_RESPONSE_HEADERS if name in response.headers}
+        if "ETag" in headers:
+            upload_index.set(key, service_url, {name: headers[name] for name in ("ETag", "Last-Modified", "Cache-Control") if name in headers})
+        logger.info(f"Imagen obtenida de {service_url}: {path} ({response.status_code})")
+        if response.status_code == 304:
+            await stack.aclose()
+            return Response(status_code=304, headers=headers)
+        return StreamingResponse(
+            content=response.aiter_raw(),
+            status_code=response.status_code,
+            headers=headers,
+            background=BackgroundTask(stack.aclose),
+        )
+
 # Bookmark Service
 @app.post("/bookmarks")
 async def toggle_bookmark(request: Request):
     data = await request.json()
-    headers = {"Authorization": request.headers.get("Authorization", "")}
+    headers = auth_headers(request)
     logger.info(f"Enviando solicitud de bookmark a {BOOKMARK_SERVICE_URL}/bookmarks")
-    return await forward_request("POST", f"{BOOKMARK_SERVICE_URL}/bookmarks", json=data, headers=headers)
+    result = await forward_request("POST", f"{BOOKMARK_SERVICE_URL}/bookmarks", json=data, headers=headers)
+    await response_cache.invalidate(f"bookmark:{data.get('user_id')}:{data.get('post_id')}")
+    return result
 
 @app.get("/bookmarks/user/{user_id}")
 async def get_bookmarks(user_id: str, request: Request):
-    headers = {"Authorization": request.headers.get("Authorization", "")}
+    headers = auth_headers(request)
     logger.info(f"Enviando solicitud de bookmarks a {BOOKMARK_SERVICE_URL}/bookmarks/user/{user_id}")
     return await forward_request("GET", f"{BOOKMARK_SERVICE_URL}/bookmarks/user/{user_id}", headers=headers)
 
 @app.get("/bookmarks/check")
 async def check_bookmark(user_id: str, post_id: str, request: Request):
-    headers = {"Authorization": request.headers.get("Authorization", "")}
+    headers = auth_headers(request)
     logger.info(f"Enviando solicitud de verificación de bookmark a {BOOKMARK_SERVICE_URL}/bookmarks/check?user_id={user_id}&post_id={post_id}")
-    return await forward_request("GET", f"{BOOKMARK_SERVICE_URL}/bookmarks/check?user_id={user_id}&post_id={post_id}", headers=headers)
+    return await fetch_bookmark_state(user_id, post_id, headers)
+
+@app.get("/bookmarks/check-batch")
+async def check_bookmarks_batch(user_id: str, post_ids: str, request: Request):
+    headers = auth_headers(request)
+    ids = [post_id.strip() for post_id in post_ids.split(",") if post_id.strip()]
+    logger.info(f"Enviando verificación de {len(ids)} bookmarks a {BOOKMARK_SERVICE_URL}/bookmarks/check-batch")
+    return await fetch_bookmark_states(user_id, ids, headers)
+
+# Búsqueda (Explore): usuarios y posts en paralelo; si una fuente falla su campo queda en null.
+# Los resultados de usuarios no dependen del llamante y se cachean; los de posts llevan liked_by_me
+SEARCH_TYPES = ("users", "posts", "all")
+
+@app.get("/search")
+async def search(q: str, request: Request, type: str = "all", limit: Optional[int] = None, offset: int = 0):
+    if type not in SEARCH_TYPES:
+        raise HTTPException(status_code=400, detail=f"type debe ser uno de {', '.join(SEARCH_TYPES)}")
+    headers = auth_headers(request)
+    query = urlencode({name: value for name, value in (("q", q), ("limit", limit), ("offset", offset)) if value is not None})
+    errors = []
+
+    async def optional(source: str, fetch: Callable[[], Awaitable[Any]]):
+        try:
+            return json_body(await fetch())
+        except HTTPException as e:
+            logger.warning(f"Búsqueda '{q}': fallo en {source}: {e.status_code}")
+            errors.append({"source": source, "status": e.status_code})
+            return None
+
+    sources = {}
+    if type in ("users", "all"):
+        sources["users"] = lambda: response_cache.get_or_fetch(
+            f"/users/search?{query}",
+            ["search:users"],
+            lambda: forward_request("GET", f"{USER_SERVICE_URL}/users/search?{query}", headers=headers),
+            ttl=SEARCH_CACHE_TTL,
+        )
+    if type in ("posts", "all"):
+        sources["posts"] = lambda: forward_request("GET", f"{POST_SERVICE_URL}/posts/search?{query}", headers=headers)
+    logger.info(f"Búsqueda '{q}' en {list(sources)}")
+    results = await asyncio.gather(*(optional(source, fetch) for source, fetch in sources.items()))
+    return {**dict(zip(sources, results)), "partial": bool(errors), "errors": errors}
+
+# Autocompletado de usuarios mientras se escribe; prefijos repetidos salen de la caché
+@app.get("/search/autocomplete")
+async def search_autocomplete(q: str, request: Request, limit: Optional[int] = None):
+    headers = auth_headers(request)
+    query = urlencode({name: value for name, value in (("q", q.strip().lower()), ("limit", limit)) if value is not None})
+    return await response_cache.get_or_fetch(
+        f"/users/autocomplete?{query}",
+        ["search:users"],
+        lambda: forward_request("GET", f"{USER_SERVICE_URL}/users/autocomplete?{query}", headers=headers, coalesce=should_coalesce("search_autocomplete")),
+        ttl=SEARCH_CACHE_TTL,
+    )
+
+# Feed agregado (backend-for-frontend): una página del timeline con autor, bookmark y like en una sola llamada
+@app.get("/feed/{user_id}")
+async def get_feed(user_id: str, request: Request, limit: int = FEED_PAGE_SIZE, cursor: Optional[str] = None):
+    headers = auth_headers(request)
+    limit = max(1, min(limit, FEED_MAX_PAGE_SIZE))
+    semaphore = asyncio.Semaphore(FEED_FANOUT_CONCURRENCY)
+    errors = []
+
+    # Las fuentes secundarias pueden fallar sin romper el feed: su campo queda en null
+    async def optional(source: str, fetch: Callable[[], Awaitable[Any]]):
+        async with semaphore:
+            try:
+                return await fetch()
+            except HTTPException as e:
+                logger.warning(f"Feed de {user_id}: fallo parcial en {source}: {e.status_code}")
+                errors.append({"source": source, "status": e.status_code})
+                return None
+
+    logger.info(f"Construyendo feed para user_id: {user_id} (limit={limit}, cursor={cursor})")
+    posts, following = await asyncio.gather(
+        forward_request("GET", page_url(f"{POST_SERVICE_URL}/timeline/{user_id}", limit=limit, cursor=cursor), headers=headers),
+        optional("friends", lambda: forward_request("GET", f"{FRIEND_SERVICE_URL}/friends/following/{user_id}", headers=headers)),
+    )
+    posts = json_body(posts)
+    following = json_body(following)
+    page = posts["posts"]
+
+    author_ids = list(dict.fromkeys(post["user_id"] for post in page))
+    if page:
+        authors, bookmarks = await asyncio.gather(
+            asyncio.gather(*[optional(f"users/{author_id}", lambda author_id=author_id: fetch_user(author_id, headers)) for author_id in author_ids]),
+            optional("bookmarks", lambda: fetch_bookmark_states(user_id, [post["_id"] for post in page], headers)),
+        )
+        bookmarks = json_body(bookmarks)
+    else:
+        # Página vacía: no hay autores ni bookmarks que consultar
+        authors, bookmarks = [], {"bookmarks": {}}
+    authors_by_id = dict(zip(author_ids, [json_body(author) for author in authors]))
+    followed_ids = {item["followed_id"] for item in following} if following is not None else None
+    bookmarked = bookmarks["bookmarks"] if bookmarks is not None else None
+
+    items = []
+    for post in page:
+        items.append({
+            **post,
+            "author": authors_by_id.get(post["user_id"]),
+            "author_followed": post["user_id"].lower() in followed_ids if followed_ids is not None else None,
+            "is_liked": post["liked_by_me"],
+            "is_bookmarked": bookmarked.get(post["_id"], False) if bookmarked is not None else None,
+        })
+
+    return {
+        "posts": items,
+        "next_cursor": posts["next_cursor"],
+        "partial": bool(errors),
+        "errors": errors,
+    }
+
+# Estadísticas internas del gateway
+@app.get("/internal/stats")
+async def gateway_stats():
+    return {
+        "upstreams": {origin: pool.stats() for origin, pool in upstream_pools.items()},
+        "cache": response_cache.stats(),
+        "coalescing": single_flight.stats(),
+        "uploads": {route: stats.stats() for route, stats in upload_stats.items()},
+        "websockets": {name: mux.stats() for name, mux in ws_muxes.items()},
+        "auth": token_verifier.stats(),
+        "upload_index": upload_index.stats(),
+        "admission": admission.stats(),
+        "rate_limit": rate_limiter.stats(),
+    }
+
+# Métricas en formato Prometheus
+@app.get("/metrics")
+async def metrics():
+    for origin, pool in upstream_pools.items():
+        UPSTREAM_POOL_IN_USE.labels(origin).set(pool.in_use)
+        UPSTREAM_POOL_WAITING.labels(origin).set(pool.waiting)
+        UPSTREAM_BREAKER_OPEN.labels(origin).set({"closed": 0, "half_open": 0.5, "open": 1}[pool.breaker.state])
+    EVENT_LOOP_LAG.set(admission.loop_lag)
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=8000, ws_ping_interval=WS_PING_INTERVAL, ws_ping_timeout=WS_PING_TIMEOUT)
\ No newline at end of file
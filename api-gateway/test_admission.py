@@ -0,0 +1,51 @@
+import time
+
+import jwt
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+
+@pytest.fixture
+def overloaded():
+    main.admission.in_flight = main.ADMISSION_HARD_LIMIT
+    yield
+    main.admission.in_flight = 0
+
+
+def bearer(user_id: str = "ana") -> dict:
+    token = jwt.encode({"user_id": user_id, "exp": int(time.time()) + 600}, main.JWT_SECRET, algorithm=main.JWT_ALGORITHM)
+    return {"Authorization": f"Bearer {token}"}
+
+
+def test_critical_routes_survive_overload(overloaded):
+    with TestClient(main.app) as client:
+        assert main.admission.overload_level() == 2
+        login = client.post("/auth/login", json={"email": "ana@example.com", "password": "x"})
+        post = client.post("/posts", data={"content": "hola"}, headers=bearer())
+        chat = client.post("/chat/messages", json={"receiver_id": "bob", "content": "hola"}, headers=bearer())
+        legacy_chat = client.post("/alerts", json={"receiver_id": "bob", "content": "hola"}, headers=bearer())
+        feed = client.get("/posts", headers=bearer())
+        search = client.get("/search", params={"q": "hola"}, headers=bearer())
+    for response in (login, post, chat, legacy_chat):
+        assert response.status_code != 429
+    assert feed.status_code == 429
+    assert search.status_code == 429
+
+
+def test_request_priority():
+    assert main.request_priority("POST", "/chat/messages") == "critical"
+    assert main.request_priority("POST", "/alerts") == "critical"
+    assert main.request_priority("GET", "/posts") == "low"
+    assert main.request_priority("GET", "/search") == "normal"
+
+
+def test_login_is_rate_limited_per_ip(monkeypatch):
+    monkeypatch.setattr(main, "rate_limiter", main.RateLimiter(rate=0.001, burst=2, max_keys=100))
+    with TestClient(main.app) as client:
+        statuses = [client.post("/auth/login", json={"email": "ana@example.com", "password": "x"}).status_code for _ in range(3)]
+        feed = client.get("/posts", headers=bearer())
+    assert 429 not in statuses[:2]
+    assert statuses[2] == 429
+    assert feed.status_code != 429
@@ -1,5 +1,9 @@
-from fastapi import FastAPI, HTTPException
-from pymongo import MongoClient
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import JSONResponse
+from bson import ObjectId
+import orjson
+from pymongo import MongoClient, monitoring
+from prometheus_client import Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 from pydantic import BaseModel
 import os
 from dotenv import load_dotenv
@@ -7,6 +11,10 @@ import logging
 import time
 import jwt
 import bcrypt
+import asyncio
+import functools
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
@@ -14,7 +22,78 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-app = FastAPI(title="Auth Service")
+# Respuestas JSON con orjson: ObjectId y datetime se codifican sin pasar por jsonable_encoder
+def orjson_default(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError(f"Tipo no serializable: {type(obj).__name__}")
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=orjson_default, option=orjson.OPT_NON_STR_KEYS)
+
+# Monitor del bucle de eventos y cierre del pool de hilos de MongoDB
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    monitor = asyncio.create_task(monitor_event_loop())
+    yield
+    monitor.cancel()
+    mongo_executor.shutdown(wait=False)
+
+app = FastAPI(title="Auth Service", lifespan=lifespan, default_response_class=FastJSONResponse)
+
+# Métricas Prometheus
+REQUEST_LATENCY = Histogram("http_request_duration_seconds", "Latencia de las peticiones HTTP", ["method", "route", "status"])
+REQUESTS_IN_FLIGHT = Gauge("http_requests_in_flight", "Peticiones HTTP en curso")
+MONGO_LATENCY = Histogram("mongo_command_duration_seconds", "Duración de los comandos de MongoDB", ["command", "status"])
+EVENT_LOOP_LAG = Histogram(
+    "event_loop_lag_seconds",
+    "Retraso del bucle de eventos al despertar una tarea periódica",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    REQUESTS_IN_FLIGHT.inc()
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        REQUESTS_IN_FLIGHT.dec()
+        route = request.scope.get("route")
+        REQUEST_LATENCY.labels(request.method, route.path if route else "unmatched", str(status)).observe(time.perf_counter() - start)
+
+# Registrar la duración de cada comando enviado a MongoDB
+class MongoCommandTimer(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_LATENCY.labels(event.command_name, "ok").observe(event.duration_micros / 1_000_000)
+
+    def failed(self, event):
+        MONGO_LATENCY.labels(event.command_name, "error").observe(event.duration_micros / 1_000_000)
+
+# Mide cuánto tarda el bucle en despertar una tarea que duerme un intervalo fijo: el exceso es
+# tiempo en que el bucle estuvo bloqueado por código síncrono
+EVENT_LOOP_LAG_INTERVAL = float(os.getenv("EVENT_LOOP_LAG_INTERVAL", "0.1"))
+
+async def monitor_event_loop():
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        EVENT_LOOP_LAG.observe(max(0.0, time.perf_counter() - start - EVENT_LOOP_LAG_INTERVAL))
+
+# pymongo es síncrono: las operaciones se ejecutan en un pool de hilos acotado, del mismo tamaño
+# que el pool de conexiones del cliente, para no bloquear el bucle de eventos
+MONGO_POOL_SIZE = int(os.getenv("MONGO_POOL_SIZE", "16"))
+mongo_executor = ThreadPoolExecutor(max_workers=MONGO_POOL_SIZE, thread_name_prefix="mongo")
+
+async def run_db(fn, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(mongo_executor, functools.partial(fn, *args, **kwargs))
 
 # Configuración de MongoDB con reintentos
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://mongo:27017/user_db")  # Cambiar a user_db
@@ -22,7 +101,7 @@ JWT_SECRET = os.getenv("JWT_SECRET", "your_jwt_secret")  # Asegúrate de que sea
 
 for attempt in range(10):
     try:
-        client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000)
+        client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000, maxPoolSize=MONGO_POOL_SIZE, event_listeners=[MongoCommandTimer()])
         client.server_info()  # Verifica la conexión
         logger.info("Conexión a MongoDB establecida correctamente")
         break
@@ -49,13 +128,13 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
 @app.post("/auth/login")
 async def login(login_data: LoginData):
     logger.info(f"Buscando usuario con email: {login_data.email}")
-    user = users_collection.find_one({"email": login_data.email})
+    user = await run_db(users_collection.find_one, {"email": login_data.email})
     if not user:
         logger.warning(f"Usuario no encontrado: {login_data.email}")
         raise HTTPException(status_code=401, detail="Invalid email or password")
     
-    # Verificar la contraseña con bcrypt
-    if "password" not in user or not verify_password(login_data.password, user["password"]):
+    # Verificar la contraseña con bcrypt; es costoso en CPU, así que también va fuera del bucle
+    if "password" not in user or not await asyncio.get_running_loop().run_in_executor(None, verify_password, login_data.password, user["password"]):
         logger.warning(f"Contraseña incorrecta para: {login_data.email}")
         raise HTTPException(status_code=401, detail="Invalid email or password")
     
@@ -74,6 +153,11 @@ async def login(login_data: LoginData):
         "name": user["name"]
     }
 
+# Métricas en formato Prometheus
+@app.get("/metrics")
+async def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
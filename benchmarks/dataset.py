@@ -0,0 +1,301 @@
+# Generación de un dataset sintético y reproducible para los benchmarks.
+# Con la misma semilla y parámetros se obtienen exactamente los mismos documentos.
+import json
+import os
+import random
+import re
+import struct
+import unicodedata
+import zlib
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+import bcrypt
+from bson import ObjectId, json_util
+
+# Contraseña común de los usuarios sintéticos: se hashea una sola vez
+BENCH_PASSWORD = "bench-password"
+BASE_DATE = datetime(2024, 1, 1)
+# Temas de los posts: dan al corpus términos con distinta selectividad para la búsqueda
+TOPICS = ["fútbol", "música", "cine", "viajes", "cocina", "tecnología", "python", "fotografía", "libros", "montaña", "playa", "café"]
+BIOS = ["Cuenta sintética de benchmark", "Fan del cine y la música", "Desarrolladora python", "Viajes y fotografía", "Cocina de montaña"]
+
+
+@dataclass
+class DatasetConfig:
+    users: int = 1000
+    # Exponente de la ley de potencias de popularidad (Zipf) del grafo de seguidores
+    follow_alpha: float = 1.1
+    avg_following: int = 30
+    avg_posts: float = 5.0
+    avg_likes: float = 8.0
+    avg_comments: float = 1.5
+    summary_comments: int = 3
+    image_ratio: float = 0.2
+    chat_threads: int = 500
+    messages_per_thread: int = 10
+    bookmark_ratio: float = 0.05
+    # Umbral de seguidores a partir del cual los posts no se copian en los timelines
+    celebrity_followers: int = 100
+    seed: int = 42
+
+
+# PNG sólido mínimo, suficiente para ejercitar el proxy y el servido de imágenes
+def make_png(width: int, height: int, rgb: tuple) -> bytes:
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+    row = b"\x00" + bytes(rgb) * width
+    raw = zlib.compress(row * height)
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", raw) + chunk(b"IEND", b"")
+
+
+def _object_id(rng: random.Random, created_at: datetime) -> ObjectId:
+    # El timestamp del ObjectId coincide con created_at para que el orden natural sea coherente
+    return ObjectId(struct.pack(">I", int(created_at.timestamp())) + rng.getrandbits(64).to_bytes(8, "big"))
+
+
+# Misma normalización que el índice de búsqueda de user-service y post-service
+def search_tokens(*texts) -> List[str]:
+    words = []
+    for text in texts:
+        if text:
+            normalized = unicodedata.normalize("NFKD", text.lower())
+            words.extend(re.findall(r"\w+", "".join(char for char in normalized if not unicodedata.combining(char))))
+    return list(dict.fromkeys(words))
+
+
+def _poisson_like(rng: random.Random, mean: float, alpha: float = 2.5) -> int:
+    # Cola larga: la mayoría cerca de la media y unos pocos muy por encima
+    if mean <= 0:
+        return 0
+    return int(rng.paretovariate(alpha) * mean * (alpha - 1) / alpha)
+
+
+def generate(config: DatasetConfig) -> dict:
+    rng = random.Random(config.seed)
+    password_hash = bcrypt.hashpw(BENCH_PASSWORD.encode("utf-8"), bcrypt.gensalt(rounds=4)).decode("utf-8")
+
+    user_ids = [f"bench{i:06d}" for i in range(config.users)]
+    # Popularidad por rango (Zipf): bench000000 es el usuario más seguido
+    weights = [1.0 / (rank + 1) ** config.follow_alpha for rank in range(config.users)]
+    cum_weights = []
+    total = 0.0
+    for weight in weights:
+        total += weight
+        cum_weights.append(total)
+
+    friends = []
+    following: Dict[str, set] = {user_id: set() for user_id in user_ids}
+    for user_id in user_ids:
+        wanted = min(_poisson_like(rng, config.avg_following), config.users - 1)
+        targets = set()
+        attempts = 0
+        while len(targets) < wanted and attempts < wanted * 4:
+            attempts += 1
+            target = rng.choices(user_ids, cum_weights=cum_weights)[0]
+            if target != user_id:
+                targets.add(target)
+        following[user_id] = targets
+        for target in sorted(targets):
+            friends.append({
+                "user_id": user_id,
+                "followed_id": target,
+                "created_at": BASE_DATE + timedelta(minutes=rng.randrange(60 * 24 * 30)),
+            })
+
+    followers: Dict[str, List[str]] = {user_id: [] for user_id in user_ids}
+    for user_id, targets in following.items():
+        for target in targets:
+            followers[target].append(user_id)
+    followers_count = {user_id: len(followers[user_id]) for user_id in user_ids}
+
+    images = {}
+    users = []
+    for index, user_id in enumerate(user_ids):
+        user = {
+            "email": f"{user_id}@vox.bench",
+            "password": password_hash,
+            "name": f"Usuario {index}",
+            "bio": BIOS[index % len(BIOS)],
+            "user_id": user_id,
+            "created_at": (BASE_DATE + timedelta(minutes=index)).isoformat(),
+            "followers_count": followers_count[user_id],
+            "following_count": len(following[user_id]),
+        }
+        user["search_terms"] = search_tokens(user["user_id"], user["name"], user["bio"])
+        if rng.random() < config.image_ratio:
+            filename = f"user-{rng.getrandbits(128):032x}_avatar.png"
+            images[filename] = make_png(48, 48, (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+            user["profile_image_url"] = f"/uploads/{filename}"
+        users.append(user)
+
+    posts = []
+    comments = []
+    likes_by_post: Dict[ObjectId, List[str]] = {}
+    for user_id in user_ids:
+        # Los usuarios populares publican más
+        count = _poisson_like(rng, config.avg_posts * (1 + followers_count[user_id] / max(config.avg_following, 1)))
+        for _ in range(count):
+            created_at = BASE_DATE + timedelta(seconds=rng.randrange(60 * 60 * 24 * 60))
+            # Likes y comentarios vienen sobre todo de los seguidores del autor
+            audience = followers[user_id] or [u for u in rng.sample(user_ids, min(config.users, 16)) if u != user_id]
+            likes = rng.sample(audience, min(len(audience), _poisson_like(rng, config.avg_likes)))
+            post_id = _object_id(rng, created_at)
+            # Comentarios en su colección; el post solo guarda los ids de los últimos
+            post_comments = []
+            for _ in range(_poisson_like(rng, config.avg_comments)):
+                commenter = rng.choice(audience) if audience else user_id
+                commented_at = created_at + timedelta(minutes=rng.randrange(1, 600))
+                post_comments.append({
+                    "_id": _object_id(rng, commented_at),
+                    "post_id": post_id,
+                    "user_id": commenter,
+                    "user_name": f"Usuario {int(commenter[5:])}",
+                    "content": f"Comentario sintético {rng.getrandbits(32):08x}",
+                    "created_at": commented_at,
+                    "like_count": 0,
+                })
+            post_comments.sort(key=lambda comment: comment["created_at"])
+            comments.extend(post_comments)
+            topics = " ".join(rng.sample(TOPICS, rng.randrange(1, 3)))
+            post = {
+                "_id": post_id,
+                "content": f"Post sintético de {user_id} sobre {topics} " + "lorem ipsum " * rng.randrange(1, 12),
+                "user_id": user_id,
+                "like_count": len(likes),
+                "comment_count": len(post_comments),
+                "recent_comment_ids": [comment["_id"] for comment in post_comments[-config.summary_comments:]],
+                "created_at": created_at,
+            }
+            post["search_terms"] = search_tokens(post["content"])
+            likes_by_post[post["_id"]] = likes
+            if rng.random() < config.image_ratio:
+                filename = f"post-{rng.getrandbits(128):032x}_image.png"
+                images[filename] = make_png(128, 96, (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+                post["image_url"] = f"/uploads/{filename}"
+            posts.append(post)
+    posts.sort(key=lambda post: post["created_at"])
+    # Likes en su colección, como los deja el post-service: uno por (post, usuario)
+    likes = [
+        {"post_id": post["_id"], "user_id": liker, "created_at": post["created_at"] + timedelta(minutes=rng.randrange(1, 600))}
+        for post in posts
+        for liker in likes_by_post[post["_id"]]
+    ]
+
+    messages = []
+    for _ in range(config.chat_threads):
+        sender, receiver = rng.sample(user_ids, 2)
+        started = BASE_DATE + timedelta(minutes=rng.randrange(60 * 24 * 60))
+        for index in range(config.messages_per_thread):
+            a, b = (sender, receiver) if index % 2 == 0 else (receiver, sender)
+            messages.append({
+                "sender_id": a,
+                "receiver_id": b,
+                "content": f"Mensaje {index} del hilo",
+                "created_at": started + timedelta(seconds=30 * index),
+            })
+
+    # Timelines materializados como los dejaría el fan-out del post-service
+    timelines = []
+    timeline_authors = []
+    for user_id in user_ids:
+        celebrity = followers_count[user_id] >= config.celebrity_followers
+        timeline_authors.append({"_id": user_id, "user_id": user_id, "followers_count": followers_count[user_id], "celebrity": celebrity})
+    celebrities = {author["_id"] for author in timeline_authors if author["celebrity"]}
+    for post in posts:
+        if post["user_id"] in celebrities:
+            continue
+        for follower_id in followers[post["user_id"]]:
+            timelines.append({"user_id": follower_id, "post_id": post["_id"], "author_id": post["user_id"], "created_at": post["created_at"]})
+    # Copia local de los seguidos, recién sincronizada para que las lecturas no vayan al friend-service
+    timeline_follows = [
+        {"user_id": user_id, "author_id": target, "celebrity": target in celebrities}
+        for user_id in user_ids
+        for target in sorted(following[user_id])
+    ]
+    synced_at = datetime.utcnow()
+    timeline_follow_sync = [{"_id": user_id, "synced_at": synced_at} for user_id in user_ids]
+
+    bookmarks = []
+    post_ids = [str(post["_id"]) for post in posts]
+    if post_ids:
+        for user_id in user_ids:
+            for post_id in rng.sample(post_ids, min(len(post_ids), _poisson_like(rng, config.bookmark_ratio * 20))):
+                bookmarks.append({"user_id": user_id, "post_id": post_id, "created_at": BASE_DATE})
+
+    notifications = []
+    for post in posts[-min(len(posts), config.users * 2):]:
+        for liker in likes_by_post[post["_id"]][:3]:
+            notifications.append({
+                "user_id": post["user_id"],
+                "message": f"A {liker} le gustó tu post",
+                "type": "like",
+                "related_post_id": str(post["_id"]),
+                "created_at": post["created_at"] + timedelta(minutes=5),
+            })
+
+    # Posts más gustados: objetivos de las "tormentas" de likes
+    hot_posts = [str(post["_id"]) for post in sorted(posts, key=lambda post: post["like_count"], reverse=True)[:10]]
+
+    return {
+        "config": asdict(config),
+        "databases": {
+            "user_db": {"users": users},
+            "friend_db": {"friends": friends},
+            "post_db": {"posts": posts, "likes": likes, "comments": comments, "timelines": timelines, "timeline_authors": timeline_authors,
+                        "timeline_follows": timeline_follows, "timeline_follow_sync": timeline_follow_sync},
+            "chat_db": {"messages": messages},
+            "bookmark_db": {"bookmarks": bookmarks},
+            "notification_db": {"notifications": notifications},
+        },
+        "images": images,
+        "manifest": {
+            "password": BENCH_PASSWORD,
+            "user_ids": user_ids,
+            "hot_posts": hot_posts,
+            "chat_pairs": sorted({tuple(sorted((m["sender_id"], m["receiver_id"]))) for m in messages}),
+        },
+    }
+
+
+def save(dataset: dict, directory: str):
+    os.makedirs(os.path.join(directory, "uploads"), exist_ok=True)
+    for db_name, collections in dataset["databases"].items():
+        os.makedirs(os.path.join(directory, db_name), exist_ok=True)
+        for collection, docs in collections.items():
+            with open(os.path.join(directory, db_name, f"{collection}.jsonl"), "w", encoding="utf-8") as f:
+                for doc in docs:
+                    f.write(json_util.dumps(doc, json_options=json_util.CANONICAL_JSON_OPTIONS) + "\n")
+    for filename, data in dataset["images"].items():
+        with open(os.path.join(directory, "uploads", filename), "wb") as f:
+            f.write(data)
+    with open(os.path.join(directory, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump({"config": dataset["config"], **dataset["manifest"]}, f, indent=2)
+
+
+def load_manifest(directory: str) -> dict:
+    with open(os.path.join(directory, "manifest.json"), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def load_collections(directory: str, db_name: str) -> Dict[str, List[dict]]:
+    collections = {}
+    db_dir = os.path.join(directory, db_name)
+    if not os.path.isdir(db_dir):
+        return collections
+    for filename in sorted(os.listdir(db_dir)):
+        if filename.endswith(".jsonl"):
+            with open(os.path.join(db_dir, filename), encoding="utf-8") as f:
+                collections[filename[:-len(".jsonl")]] = [json_util.loads(line) for line in f if line.strip()]
+    return collections
+
+
+def insert_collections(db, collections: Dict[str, List[dict]], reset: bool = True):
+    for collection, docs in collections.items():
+        if reset:
+            db[collection].drop()
+        for start in range(0, len(docs), 1000):
+            db[collection].insert_many(docs[start:start + 1000], ordered=False)
@@ -0,0 +1,301 @@
+# Generador de carga por escenarios contra el API Gateway.
+# Cada escenario ejecuta varios workers concurrentes durante la duración indicada y
+# registra la latencia de cada petición por ruta (plantilla, no URL concreta).
+import asyncio
+import json
+import random
+import time
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import httpx
+import websockets
+
+from benchmarks.dataset import TOPICS, make_png
+
+DEFAULT_WORKERS = {"feed": 16, "post": 2, "like": 8, "chat": 4, "notifications": 50, "search": 4, "trending": 4, "probe": 1}
+
+
+@dataclass
+class Session:
+    user_id: str
+    token: str
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        return {"Authorization": f"Bearer {self.token}"}
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(q / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.statuses: Dict[str, Counter] = defaultdict(Counter)
+        self.counters: Counter = Counter()
+        self.recording = False
+
+    def record(self, route: str, seconds: float, status):
+        if not self.recording:
+            return
+        self.latencies[route].append(seconds)
+        self.statuses[route][str(status)] += 1
+
+    def summary(self, elapsed: float) -> dict:
+        routes = {}
+        for route, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            statuses = self.statuses[route]
+            # 101 es el handshake WebSocket correcto; los nombres de excepción también cuentan como error
+            errors = sum(count for status, count in statuses.items() if not (status.isdigit() and int(status) < 400))
+            routes[route] = {
+                "count": len(values),
+                "errors": errors,
+                "throughput_rps": len(values) / elapsed if elapsed else 0.0,
+                "p50_ms": percentile(values, 50) * 1000,
+                "p95_ms": percentile(values, 95) * 1000,
+                "p99_ms": percentile(values, 99) * 1000,
+                "statuses": dict(statuses),
+            }
+        return {"elapsed_s": elapsed, "routes": routes, "counters": dict(self.counters)}
+
+
+@dataclass
+class Context:
+    client: httpx.AsyncClient
+    gateway: str
+    sessions: List[Session]
+    manifest: dict
+    recorder: Recorder
+    deadline: float
+    rng: random.Random
+    post_ids: List[str] = field(default_factory=list)
+    # Servicio -> URL directa, solo cuando los servicios se levantan en local
+    services: Dict[str, str] = field(default_factory=dict)
+
+    def running(self) -> bool:
+        return time.monotonic() < self.deadline
+
+    async def request(self, route: str, method: str, url: str, **kwargs) -> Optional[httpx.Response]:
+        start = time.perf_counter()
+        try:
+            response = await self.client.request(method, url, **kwargs)
+        except httpx.HTTPError as e:
+            self.recorder.record(route, time.perf_counter() - start, type(e).__name__)
+            return None
+        self.recorder.record(route, time.perf_counter() - start, response.status_code)
+        return response
+
+    def ws_url(self, path: str) -> str:
+        return self.gateway.replace("http://", "ws://").replace("https://", "wss://") + path
+
+
+# Lectura del feed y de una imagen de la página en tamaño medio, como haría el frontend
+async def feed_worker(ctx: Context):
+    while ctx.running():
+        session = ctx.rng.choice(ctx.sessions)
+        response = await ctx.request("GET /feed/{user_id}", "GET", f"/feed/{session.user_id}", params={"limit": 20}, headers=session.headers)
+        if response is None or response.status_code != 200:
+            continue
+        images = [post["image_url"] for post in response.json().get("posts", []) if post.get("image_url")]
+        if images:
+            image = await ctx.request("GET /uploads/{path}", "GET", ctx.rng.choice(images), params={"size": "medium"})
+            if image is not None and image.status_code == 200:
+                ctx.recorder.counters["image_bytes"] += len(image.content)
+
+
+# Publicación con imagen ocasional; el post-service notifica a todos los seguidores
+async def post_worker(ctx: Context):
+    image = make_png(320, 240, (30, 144, 255))
+    while ctx.running():
+        session = ctx.rng.choice(ctx.sessions)
+        # Siempre multipart, como el FormData del frontend
+        files = {"content": (None, f"Post de carga {ctx.rng.getrandbits(32):08x}"), "user_id": (None, session.user_id)}
+        if ctx.rng.random() < 0.2:
+            files["image"] = ("bench.png", image, "image/png")
+        response = await ctx.request("POST /posts", "POST", "/posts", files=files, headers=session.headers)
+        if response is not None and response.status_code == 200:
+            post_id = response.json().get("post_id")
+            if post_id:
+                ctx.post_ids.append(post_id)
+
+
+# Muchos usuarios dando like a la vez a los mismos posts populares
+async def like_worker(ctx: Context):
+    hot_posts = ctx.manifest["hot_posts"] or ctx.post_ids
+    while ctx.running() and hot_posts:
+        session = ctx.rng.choice(ctx.sessions)
+        post_id = ctx.rng.choice(hot_posts[:3])
+        await ctx.request("POST /posts/{post_id}/likes", "POST", f"/posts/{post_id}/likes", data={"user_id": session.user_id}, headers=session.headers)
+
+
+# Ráfagas de mensajes de chat: se mide desde el envío hasta la confirmación del servidor
+async def chat_worker(ctx: Context):
+    while ctx.running():
+        session, peer = ctx.rng.sample(ctx.sessions, 2)
+        start = time.perf_counter()
+        try:
+            async with websockets.connect(ctx.ws_url(f"/ws/chat/{session.user_id}"), open_timeout=10) as ws:
+                await ws.send(f"Bearer {session.token}")
+                await asyncio.wait_for(ws.recv(), timeout=10)
+                ctx.recorder.record("WS /ws/chat/{user_id}", time.perf_counter() - start, 101)
+                for index in range(20):
+                    if not ctx.running():
+                        break
+                    sent = time.perf_counter()
+                    await ws.send(json.dumps({"sender_id": session.user_id, "receiver_id": peer.user_id, "content": f"ráfaga {index}"}))
+                    # Antes de la confirmación llega el eco del propio mensaje; los textos planos son errores
+                    while True:
+                        reply = await asyncio.wait_for(ws.recv(), timeout=10)
+                        if not reply.startswith("{"):
+                            raise RuntimeError(reply)
+                        if json.loads(reply).get("status") == "Mensaje enviado":
+                            break
+                    ctx.recorder.record("WS chat message", time.perf_counter() - sent, 200)
+        except (OSError, asyncio.TimeoutError, RuntimeError, websockets.WebSocketException) as e:
+            ctx.recorder.record("WS /ws/chat/{user_id}", time.perf_counter() - start, type(e).__name__)
+            await asyncio.sleep(0.5)
+
+
+# Sockets de notificaciones abiertos durante toda la prueba; cuenta los mensajes recibidos
+async def notification_worker(ctx: Context):
+    session = ctx.rng.choice(ctx.sessions)
+    start = time.perf_counter()
+    try:
+        async with websockets.connect(ctx.ws_url(f"/ws/notifications/{session.user_id}"), open_timeout=10) as ws:
+            await ws.send(f"Bearer {session.token}")
+            ctx.recorder.record("WS /ws/notifications/{user_id}", time.perf_counter() - start, 101)
+            while ctx.running():
+                try:
+                    await asyncio.wait_for(ws.recv(), timeout=max(0.1, ctx.deadline - time.monotonic()))
+                    if ctx.recorder.recording:
+                        ctx.recorder.counters["notifications_received"] += 1
+                except asyncio.TimeoutError:
+                    break
+    except (OSError, asyncio.TimeoutError, websockets.WebSocketException) as e:
+        ctx.recorder.record("WS /ws/notifications/{user_id}", time.perf_counter() - start, type(e).__name__)
+
+
+# Explore: autocompletado mientras se escribe un usuario y búsquedas de posts por tema
+async def search_worker(ctx: Context):
+    user_ids = ctx.manifest["user_ids"]
+    while ctx.running():
+        session = ctx.rng.choice(ctx.sessions)
+        target = ctx.rng.choice(user_ids)
+        for length in range(6, len(target) + 1, 2):
+            await ctx.request("GET /search/autocomplete", "GET", "/search/autocomplete", params={"q": target[:length]}, headers=session.headers)
+        query = " ".join(ctx.rng.sample(TOPICS, ctx.rng.randrange(1, 3)))
+        await ctx.request("GET /search", "GET", "/search", params={"q": query, "type": "all"}, headers=session.headers)
+
+
+# Lectura de los posts en tendencia mientras los likes y publicaciones los actualizan
+async def trending_worker(ctx: Context):
+    while ctx.running():
+        session = ctx.rng.choice(ctx.sessions)
+        await ctx.request("GET /posts/trending", "GET", "/posts/trending", params={"limit": 20}, headers=session.headers)
+
+
+# Sonda del bucle de eventos: GET /metrics directo a cada servicio, que no toca MongoDB.
+# Su latencia bajo carga es el tiempo que el bucle tarda en atenderla (consultas síncronas incluidas)
+async def probe_worker(ctx: Context):
+    async def probe(service: str, url: str):
+        while ctx.running():
+            await ctx.request(f"probe {service}", "GET", f"{url}/metrics")
+            await asyncio.sleep(0.05)
+
+    await asyncio.gather(*(probe(service, url) for service, url in ctx.services.items()))
+
+
+SCENARIOS = {
+    "feed": feed_worker,
+    "post": post_worker,
+    "like": like_worker,
+    "chat": chat_worker,
+    "notifications": notification_worker,
+    "search": search_worker,
+    "trending": trending_worker,
+    "probe": probe_worker,
+}
+
+
+async def login_sessions(client: httpx.AsyncClient, manifest: dict, count: int, rng: random.Random) -> List[Session]:
+    # Se eligen sobre todo usuarios populares: sus posts y sus seguidores generan más trabajo
+    user_ids = manifest["user_ids"]
+    chosen = rng.sample(user_ids[: max(count * 4, 1)], min(count, len(user_ids)))
+    sessions = []
+    for user_id in chosen:
+        response = await client.post("/auth/login", json={"email": f"{user_id}@vox.bench", "password": manifest["password"]})
+        response.raise_for_status()
+        body = response.json()
+        sessions.append(Session(body["user_id"], body["token"]))
+    return sessions
+
+
+async def run_load(gateway: str, manifest: dict, duration: float, warmup: float, workers: Dict[str, int], sessions: int = 50, seed: int = 1, services: Optional[Dict[str, str]] = None) -> dict:
+    rng = random.Random(seed)
+    recorder = Recorder()
+    limits = httpx.Limits(max_connections=256, max_keepalive_connections=256)
+    async with httpx.AsyncClient(base_url=gateway, limits=limits, timeout=30.0) as client:
+        logged_in = await login_sessions(client, manifest, sessions, rng)
+        ctx = Context(client, gateway, logged_in, manifest, recorder, time.monotonic() + warmup + duration, rng, services=services or {})
+        tasks = [
+            asyncio.create_task(SCENARIOS[name](ctx))
+            for name, count in workers.items()
+            for _ in range(count)
+        ]
+        await asyncio.sleep(warmup)
+        recorder.recording = True
+        started = time.monotonic()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        elapsed = time.monotonic() - started
+    result = recorder.summary(elapsed)
+    result["workers"] = workers
+    result["sessions"] = len(logged_in)
+    return result
+
+
+# Compara p95 y throughput por ruta con la línea base; devuelve las regresiones encontradas
+def compare(result: dict, baseline: dict, tolerance: float) -> List[str]:
+    regressions = []
+    for route, current in result["routes"].items():
+        previous = baseline.get("routes", {}).get(route)
+        if not previous:
+            continue
+        if previous["p95_ms"] and current["p95_ms"] > previous["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{route}: p95 {previous['p95_ms']:.1f}ms -> {current['p95_ms']:.1f}ms")
+        if previous["throughput_rps"] and current["throughput_rps"] < previous["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{route}: throughput {previous['throughput_rps']:.1f} -> {current['throughput_rps']:.1f} req/s")
+        previous_error_rate = previous["errors"] / previous["count"] if previous["count"] else 0.0
+        current_error_rate = current["errors"] / current["count"] if current["count"] else 0.0
+        if current_error_rate > previous_error_rate + 0.01:
+            regressions.append(f"{route}: errores {previous_error_rate:.1%} -> {current_error_rate:.1%}")
+    return regressions
+
+
+def format_report(result: dict) -> str:
+    lines = [f"{'ruta':40} {'n':>7} {'req/s':>8} {'err':>5} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"]
+    for route, stats in result["routes"].items():
+        lines.append(
+            f"{route:40} {stats['count']:>7} {stats['throughput_rps']:>8.1f} {stats['errors']:>5} "
+            f"{stats['p50_ms']:>8.1f} {stats['p95_ms']:>8.1f} {stats['p99_ms']:>8.1f}"
+        )
+    for name, value in result.get("counters", {}).items():
+        lines.append(f"{name}: {value}")
+    return "\n".join(lines)
+
+
+def parse_workers(spec: Optional[str]) -> Dict[str, int]:
+    workers = dict(DEFAULT_WORKERS)
+    if spec:
+        for part in spec.split(","):
+            name, _, count = part.partition("=")
+            if name.strip() not in SCENARIOS:
+                raise ValueError(f"Escenario desconocido: {name}")
+            workers[name.strip()] = int(count)
+    return {name: count for name, count in workers.items() if count > 0}
@@ -0,0 +1,120 @@
+# Punto de entrada de los benchmarks: genera el dataset, levanta los servicios,
+# ejecuta la carga e informa de las regresiones frente a una línea base guardada.
+#
+#   python -m benchmarks.run --users 1000 --duration 30
+#   python -m benchmarks.run --mongo-uri mongodb://localhost:27017 --baseline benchmarks/baseline.json
+#   python -m benchmarks.run --baseline benchmarks/baseline.json --save-baseline
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.dataset import DatasetConfig, generate, insert_collections, load_collections, load_manifest, save
+from benchmarks.loadtest import compare, format_report, parse_workers, run_load
+from benchmarks.stack import SERVICES, Stack, gateway_url, service_url
+
+
+def seed_mongo(mongo_uri: str, dataset_dir: str, dataset: dict):
+    from pymongo import MongoClient
+
+    client = MongoClient(mongo_uri)
+    for db_name in dataset["databases"]:
+        insert_collections(client[db_name], load_collections(dataset_dir, db_name))
+    client.close()
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "desconocida"
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark de extremo a extremo de Vox")
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "vox-bench"), help="Directorio del dataset, logs y resultados")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--avg-following", type=int, default=30)
+    parser.add_argument("--avg-posts", type=float, default=5.0)
+    parser.add_argument("--chat-threads", type=int, default=500)
+    parser.add_argument("--celebrity-followers", type=int, default=100, help="Seguidores a partir de los cuales un autor se lee al vuelo en los timelines")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--mongo-uri", help="MongoDB local; sin él se usa el sustituto en memoria (mongomock)")
+    parser.add_argument("--gateway", help="Usar un gateway ya levantado (p. ej. docker compose) en lugar de arrancar los servicios")
+    parser.add_argument("--seed-only", action="store_true", help="Solo generar el dataset y cargarlo en --mongo-uri")
+    parser.add_argument("--gateway-env", action="append", default=[], help="Variable KEY=VALUE para el gateway levantado")
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--warmup", type=float, default=5.0)
+    parser.add_argument("--sessions", type=int, default=50)
+    parser.add_argument("--workers", help="Workers por escenario, p. ej. feed=32,post=4,like=16,chat=8,notifications=100")
+    parser.add_argument("--output", help="Fichero JSON de resultados (por defecto en --workdir)")
+    parser.add_argument("--baseline", help="Línea base JSON con la que comparar")
+    parser.add_argument("--save-baseline", action="store_true", help="Guardar los resultados como nueva línea base")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Empeoramiento relativo tolerado de p95 y throughput")
+    args = parser.parse_args()
+
+    config = DatasetConfig(
+        users=args.users,
+        avg_following=args.avg_following,
+        avg_posts=args.avg_posts,
+        chat_threads=args.chat_threads,
+        celebrity_followers=args.celebrity_followers,
+        seed=args.seed,
+    )
+    dataset_dir = os.path.join(args.workdir, f"dataset-{args.users}-{args.seed}")
+    started = time.monotonic()
+    dataset = generate(config)
+    save(dataset, dataset_dir)
+    print(f"Dataset generado en {dataset_dir} ({time.monotonic() - started:.1f}s): "
+          + ", ".join(f"{name}={len(docs)}" for collections in dataset["databases"].values() for name, docs in collections.items()))
+    if args.mongo_uri:
+        seed_mongo(args.mongo_uri, dataset_dir, dataset)
+        print(f"Dataset cargado en {args.mongo_uri}")
+    if args.seed_only:
+        return 0
+
+    manifest = load_manifest(dataset_dir)
+    workers = parse_workers(args.workers)
+    if args.gateway:
+        result = asyncio.run(run_load(args.gateway, manifest, args.duration, args.warmup, workers, args.sessions, args.seed))
+    else:
+        gateway_env = dict(item.split("=", 1) for item in args.gateway_env)
+        with Stack(dataset_dir, args.mongo_uri, gateway_env=gateway_env):
+            services = {service: service_url(service) for service in SERVICES}
+            result = asyncio.run(run_load(gateway_url(), manifest, args.duration, args.warmup, workers, args.sessions, args.seed, services))
+
+    result["meta"] = {
+        "revision": git_revision(),
+        "dataset": config.__dict__,
+        "mongo": "mongodb" if args.mongo_uri else "mongomock",
+        "python": sys.version.split()[0],
+    }
+    print(format_report(result))
+    output = args.output or os.path.join(args.workdir, "results.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2)
+    print(f"Resultados guardados en {output}")
+
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+        print(f"Línea base actualizada: {args.baseline}")
+        return 0
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        if regressions:
+            print("Regresiones frente a la línea base:")
+            for regression in regressions:
+                print(f"  - {regression}")
+            return 1
+        print("Sin regresiones frente a la línea base")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,42 @@
+# Arranca un servicio del repositorio para los benchmarks.
+# Con --standin sustituye MongoDB por mongomock dentro del proceso y carga el dataset
+# sintético en la base de datos del servicio, de modo que no hace falta un mongod.
+import argparse
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Servicio de Vox para benchmarks")
+    parser.add_argument("--service", required=True, help="Directorio del servicio, p. ej. post-service")
+    parser.add_argument("--port", type=int, required=True)
+    parser.add_argument("--standin", action="store_true", help="Usar mongomock en lugar de MongoDB")
+    parser.add_argument("--dataset", help="Directorio del dataset a cargar con --standin")
+    args = parser.parse_args()
+
+    if args.standin:
+        import mongomock
+        import pymongo
+
+        pymongo.MongoClient = mongomock.MongoClient
+
+    service_dir = os.path.join(ROOT, args.service)
+    os.chdir(service_dir)
+    sys.path.insert(0, service_dir)
+    sys.path.insert(1, ROOT)
+    import main as service
+
+    if args.standin and args.dataset and hasattr(service, "db"):
+        from benchmarks.dataset import insert_collections, load_collections
+
+        insert_collections(service.db, load_collections(args.dataset, service.db.name))
+
+    import uvicorn
+
+    uvicorn.run(service.app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
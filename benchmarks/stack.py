@@ -0,0 +1,130 @@
+# Levanta todos los servicios en local (un proceso por servicio) para los benchmarks,
+# contra un MongoDB local o contra el sustituto en memoria de serve.py.
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Servicio -> (puerto local, base de datos)
+SERVICES = {
+    "auth-service": (8101, "user_db"),
+    "user-service": (8102, "user_db"),
+    "post-service": (8103, "post_db"),
+    "friend-service": (8106, "friend_db"),
+    "chat-service": (8107, "chat_db"),
+    "notification-service": (8108, "notification_db"),
+    "bookmark-service": (8109, "bookmark_db"),
+}
+GATEWAY_PORT = 8100
+JWT_SECRET = "bench-secret-key-0123456789abcdef"
+INTERNAL_API_TOKEN = "bench-internal-token"
+
+
+def service_url(service: str) -> str:
+    return f"http://127.0.0.1:{SERVICES[service][0]}"
+
+
+def gateway_url() -> str:
+    return f"http://127.0.0.1:{GATEWAY_PORT}"
+
+
+def _environment(mongo_uri: Optional[str], dataset_dir: str, gateway_env: Dict[str, str]) -> Dict[str, Dict[str, str]]:
+    with open(os.path.join(dataset_dir, "manifest.json"), encoding="utf-8") as f:
+        config = json.load(f)["config"]
+    common = {
+        **os.environ,
+        "JWT_SECRET": JWT_SECRET,
+        "INTERNAL_API_TOKEN": INTERNAL_API_TOKEN,
+        "UPLOADS_DIR": os.path.join(dataset_dir, "uploads"),
+        # Mismo umbral de celebridad con el que se generaron los timelines
+        "TIMELINE_CELEBRITY_FOLLOWERS": str(config["celebrity_followers"]),
+        "PYTHONUNBUFFERED": "1",
+    }
+    envs = {}
+    for service, (_, db_name) in SERVICES.items():
+        env = dict(common)
+        if mongo_uri:
+            env["MONGO_URI"] = f"{mongo_uri.rstrip('/')}/{db_name}"
+        env.update({
+            "USER_SERVICE_URL": service_url("user-service"),
+            "FRIEND_SERVICE_URL": service_url("friend-service"),
+            "NOTIFICATION_SERVICE_URL": service_url("notification-service"),
+            "POST_SERVICE_URL": service_url("post-service"),
+            "API_GATEWAY_URL": gateway_url(),
+        })
+        envs[service] = env
+    envs["api-gateway"] = {
+        **common,
+        "AUTH_SERVICE_URL": service_url("auth-service"),
+        "USER_SERVICE_URL": service_url("user-service"),
+        "POST_SERVICE_URL": service_url("post-service"),
+        "FRIEND_SERVICE_URL": service_url("friend-service"),
+        "CHAT_SERVICE_URL": service_url("chat-service"),
+        "BOOKMARK_SERVICE_URL": service_url("bookmark-service"),
+        "NOTIFICATION_SERVICE_URL": service_url("notification-service"),
+        **gateway_env,
+    }
+    return envs
+
+
+class Stack:
+    def __init__(self, dataset_dir: str, mongo_uri: Optional[str] = None, log_dir: Optional[str] = None, gateway_env: Optional[Dict[str, str]] = None):
+        self.dataset_dir = os.path.abspath(dataset_dir)
+        self.mongo_uri = mongo_uri
+        self.log_dir = log_dir or os.path.join(self.dataset_dir, "logs")
+        self.gateway_env = gateway_env or {}
+        self.processes: List[subprocess.Popen] = []
+
+    def _spawn(self, service: str, port: int, env: Dict[str, str]):
+        command = [sys.executable, "-m", "benchmarks.serve", "--service", service, "--port", str(port)]
+        if not self.mongo_uri:
+            command += ["--standin", "--dataset", self.dataset_dir]
+        log = open(os.path.join(self.log_dir, f"{service}.log"), "w")
+        self.processes.append(subprocess.Popen(command, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT))
+
+    def start(self, timeout: float = 60.0):
+        os.makedirs(self.log_dir, exist_ok=True)
+        envs = _environment(self.mongo_uri, self.dataset_dir, self.gateway_env)
+        for service, (port, _) in SERVICES.items():
+            self._spawn(service, port, envs[service])
+        self._spawn("api-gateway", GATEWAY_PORT, envs["api-gateway"])
+        urls = [service_url(service) for service in SERVICES] + [gateway_url()]
+        deadline = time.monotonic() + timeout
+        for url in urls:
+            while True:
+                try:
+                    if httpx.get(f"{url}/metrics", timeout=1.0).status_code == 200:
+                        break
+                except httpx.HTTPError:
+                    pass
+                if any(process.poll() is not None for process in self.processes):
+                    self.stop()
+                    raise RuntimeError(f"Un servicio terminó durante el arranque; revisa los logs en {self.log_dir}")
+                if time.monotonic() > deadline:
+                    self.stop()
+                    raise RuntimeError(f"{url} no respondió en {timeout}s; revisa los logs en {self.log_dir}")
+                time.sleep(0.2)
+
+    def stop(self):
+        for process in self.processes:
+            if process.poll() is None:
+                process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        self.processes.clear()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
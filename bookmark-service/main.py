@@ -1,5 +1,8 @@
-from fastapi import FastAPI, HTTPException, Header
-from pymongo import MongoClient
+from fastapi import FastAPI, HTTPException, Header, Query, Request, Response
+from fastapi.responses import JSONResponse
+import orjson
+from pymongo import MongoClient, monitoring, ASCENDING
+from prometheus_client import Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 from pydantic import BaseModel
 from datetime import datetime
 import os
@@ -7,6 +10,10 @@ from dotenv import load_dotenv
 import logging
 from bson import ObjectId
 import time
+import asyncio
+import functools
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
@@ -14,13 +21,84 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-app = FastAPI(title="Bookmark Service")
+# Respuestas JSON con orjson: ObjectId y datetime se codifican sin pasar por jsonable_encoder
+def orjson_default(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError(f"Tipo no serializable: {type(obj).__name__}")
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=orjson_default, option=orjson.OPT_NON_STR_KEYS)
+
+# Monitor del bucle de eventos y cierre del pool de hilos de MongoDB
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    monitor = asyncio.create_task(monitor_event_loop())
+    yield
+    monitor.cancel()
+    mongo_executor.shutdown(wait=False)
+
+app = FastAPI(title="Bookmark Service", lifespan=lifespan, default_response_class=FastJSONResponse)
+
+# Métricas Prometheus
+REQUEST_LATENCY = Histogram("http_request_duration_seconds", "Latencia de las peticiones HTTP", ["method", "route", "status"])
+REQUESTS_IN_FLIGHT = Gauge("http_requests_in_flight", "Peticiones HTTP en curso")
+MONGO_LATENCY = Histogram("mongo_command_duration_seconds", "Duración de los comandos de MongoDB", ["command", "status"])
+EVENT_LOOP_LAG = Histogram(
+    "event_loop_lag_seconds",
+    "Retraso del bucle de eventos al despertar una tarea periódica",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    REQUESTS_IN_FLIGHT.inc()
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        REQUESTS_IN_FLIGHT.dec()
+        route = request.scope.get("route")
+        REQUEST_LATENCY.labels(request.method, route.path if route else "unmatched", str(status)).observe(time.perf_counter() - start)
+
+# Registrar la duración de cada comando enviado a MongoDB
+class MongoCommandTimer(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_LATENCY.labels(event.command_name, "ok").observe(event.duration_micros / 1_000_000)
+
+    def failed(self, event):
+        MONGO_LATENCY.labels(event.command_name, "error").observe(event.duration_micros / 1_000_000)
+
+# Mide cuánto tarda el bucle en despertar una tarea que duerme un intervalo fijo: el exceso es
+# tiempo en que el bucle estuvo bloqueado por código síncrono
+EVENT_LOOP_LAG_INTERVAL = float(os.getenv("EVENT_LOOP_LAG_INTERVAL", "0.1"))
+
+async def monitor_event_loop():
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        EVENT_LOOP_LAG.observe(max(0.0, time.perf_counter() - start - EVENT_LOOP_LAG_INTERVAL))
+
+# pymongo es síncrono: las operaciones se ejecutan en un pool de hilos acotado, del mismo tamaño
+# que el pool de conexiones del cliente, para no bloquear el bucle de eventos
+MONGO_POOL_SIZE = int(os.getenv("MONGO_POOL_SIZE", "16"))
+mongo_executor = ThreadPoolExecutor(max_workers=MONGO_POOL_SIZE, thread_name_prefix="mongo")
+
+async def run_db(fn, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(mongo_executor, functools.partial(fn, *args, **kwargs))
 
 # Configuración de MongoDB con reintentos
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://mongo:27017/bookmark_db")
 for attempt in range(10):
     try:
-        client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000)
+        client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000, maxPoolSize=MONGO_POOL_SIZE, event_listeners=[MongoCommandTimer()])
         client.server_info()
         logger.info(f"Conexión a MongoDB establecida correctamente (intento {attempt + 1})")
         break
@@ -33,6 +111,10 @@ for attempt in range(10):
 
 db = client["bookmark_db"]
 bookmarks_collection = db["bookmarks"]
+bookmarks_collection.create_index([("user_id", ASCENDING), ("post_id", ASCENDING)])
+
+# Máximo de posts por consulta de bookmarks en lote
+BOOKMARK_BATCH_MAX = int(os.getenv("BOOKMARK_BATCH_MAX", "100"))
 
 # Modelo Pydantic
 class BookmarkData(BaseModel):
@@ -58,14 +140,14 @@ async def toggle_bookmark(bookmark_data: BookmarkData, authorization: str = Head
 
     try:
         # Verificar si ya existe el bookmark
-        existing_bookmark = bookmarks_collection.find_one({
+        existing_bookmark = await run_db(bookmarks_collection.find_one, {
             "user_id": bookmark_data.user_id,
             "post_id": bookmark_data.post_id
         })
 
         if existing_bookmark:
             # Si existe, eliminar
-            result = bookmarks_collection.delete_one({
+            result = await run_db(bookmarks_collection.delete_one, {
                 "user_id": bookmark_data.user_id,
                 "post_id": bookmark_data.post_id
             })
@@ -77,7 +159,7 @@ async def toggle_bookmark(bookmark_data: BookmarkData, authorization: str = Head
             # Si no existe, crear
             bookmark_dict = bookmark_data.dict()
             bookmark_dict["created_at"] = datetime.utcnow()
-            result = bookmarks_collection.insert_one(bookmark_dict)
+            result = await run_db(bookmarks_collection.insert_one, bookmark_dict)
             if not result.inserted_id:
                 raise HTTPException(status_code=500, detail="Failed to add bookmark")
             logger.info(f"Bookmark añadido para post_id: {bookmark_data.post_id}, user_id: {bookmark_data.user_id}")
@@ -93,12 +175,9 @@ async def get_user_bookmarks(user_id: str, authorization: str = Header(...)):
         raise HTTPException(status_code=401, detail="Invalid token format")
 
     try:
-        bookmarks = list(bookmarks_collection.find({"user_id": user_id}))
-        # Convertir ObjectId a string para serialización JSON
-        for bookmark in bookmarks:
-            bookmark["_id"] = str(bookmark["_id"])
+        bookmarks = await run_db(lambda: list(bookmarks_collection.find({"user_id": user_id})))
         logger.info(f"Obtenidos {len(bookmarks)} bookmarks para user_id: {user_id}")
-        return bookmarks
+        return FastJSONResponse(bookmarks)
     except Exception as e:
         logger.error(f"Error al obtener bookmarks: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error fetching bookmarks: {str(e)}")
@@ -113,7 +192,7 @@ async def check_bookmark(user_id: str, post_id: str, authorization: str = Header
         raise HTTPException(status_code=400, detail="Invalid post_id format")
 
     try:
-        bookmark = bookmarks_collection.find_one({
+        bookmark = await run_db(bookmarks_collection.find_one, {
             "user_id": user_id,
             "post_id": post_id
         })
@@ -124,6 +203,38 @@ async def check_bookmark(user_id: str, post_id: str, authorization: str = Header
         logger.error(f"Error al verificar bookmark: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error checking bookmark: {str(e)}")
 
+# Ruta para verificar en lote qué posts tiene guardados un usuario
+@app.get("/bookmarks/check-batch")
+async def check_bookmarks_batch(user_id: str, post_ids: str = Query(..., description="IDs de posts separados por comas"), authorization: str = Header(...)):
+    if not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="Invalid token format")
+
+    ids = list(dict.fromkeys(post_id.strip() for post_id in post_ids.split(",") if post_id.strip()))
+    if len(ids) > BOOKMARK_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"Too many post_ids (max {BOOKMARK_BATCH_MAX})")
+    invalid = [post_id for post_id in ids if not is_valid_objectid(post_id)]
+    if invalid:
+        raise HTTPException(status_code=400, detail=f"Invalid post_id format: {', '.join(invalid)}")
+
+    try:
+        saved = await run_db(lambda: {
+            bookmark["post_id"]
+            for bookmark in bookmarks_collection.find(
+                {"user_id": user_id, "post_id": {"$in": ids}},
+                {"post_id": 1, "_id": 0}
+            )
+        })
+        logger.info(f"Check bookmark en lote para user_id: {user_id}: {len(saved)}/{len(ids)} guardados")
+        return {"user_id": user_id, "bookmarks": {post_id: post_id in saved for post_id in ids}}
+    except Exception as e:
+        logger.error(f"Error al verificar bookmarks en lote: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error checking bookmarks: {str(e)}")
+
+# Métricas en formato Prometheus
+@app.get("/metrics")
+async def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8009)
\ No newline at end of file
@@ -1,16 +1,27 @@
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, Depends
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, Depends, Header, Request, Response
+from fastapi.responses import JSONResponse
+from bson import ObjectId
+import orjson
 from fastapi.security import OAuth2PasswordBearer
 from fastapi.middleware.cors import CORSMiddleware
-from pymongo import MongoClient
+from pymongo import MongoClient, monitoring
+from prometheus_client import Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 from pydantic import BaseModel
 from datetime import datetime
 import httpx
 import json
 import asyncio
+import hashlib
 from dotenv import load_dotenv
 import os
 import time
 import logging
+from typing import Dict, Optional, Tuple
+import functools
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from shared.mux import serve_mux
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
@@ -18,7 +29,61 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-app = FastAPI(title="Chat Service")
+# Respuestas JSON con orjson: ObjectId y datetime se codifican sin pasar por jsonable_encoder
+def orjson_default(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError(f"Tipo no serializable: {type(obj).__name__}")
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=orjson_default, option=orjson.OPT_NON_STR_KEYS)
+
+# Monitor del bucle de eventos y cierre del pool de hilos de MongoDB
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    monitor = asyncio.create_task(monitor_event_loop())
+    yield
+    monitor.cancel()
+    mongo_executor.shutdown(wait=False)
+
+app = FastAPI(title="Chat Service", lifespan=lifespan, default_response_class=FastJSONResponse)
+
+# Métricas Prometheus
+REQUEST_LATENCY = Histogram("http_request_duration_seconds", "Latencia de las peticiones HTTP", ["method", "route", "status"])
+REQUESTS_IN_FLIGHT = Gauge("http_requests_in_flight", "Peticiones HTTP en curso")
+MONGO_LATENCY = Histogram("mongo_command_duration_seconds", "Duración de los comandos de MongoDB", ["command", "status"])
+EVENT_LOOP_LAG = Histogram(
+    "event_loop_lag_seconds",
+    "Retraso del bucle de eventos al despertar una tarea periódica",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+WEBSOCKET_CONNECTIONS = Gauge("websocket_connections", "Conexiones WebSocket activas", ["transport"])
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    REQUESTS_IN_FLIGHT.inc()
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        REQUESTS_IN_FLIGHT.dec()
+        route = request.scope.get("route")
+        REQUEST_LATENCY.labels(request.method, route.path if route else "unmatched", str(status)).observe(time.perf_counter() - start)
+
+# Registrar la duración de cada comando enviado a MongoDB
+class MongoCommandTimer(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_LATENCY.labels(event.command_name, "ok").observe(event.duration_micros / 1_000_000)
+
+    def failed(self, event):
+        MONGO_LATENCY.labels(event.command_name, "error").observe(event.duration_micros / 1_000_000)
 
 # Configurar CORS
 app.add_middleware(
@@ -29,11 +94,29 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Mide cuánto tarda el bucle en despertar una tarea que duerme un intervalo fijo: el exceso es
+# tiempo en que el bucle estuvo bloqueado por código síncrono
+EVENT_LOOP_LAG_INTERVAL = float(os.getenv("EVENT_LOOP_LAG_INTERVAL", "0.1"))
+
+async def monitor_event_loop():
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        EVENT_LOOP_LAG.observe(max(0.0, time.perf_counter() - start - EVENT_LOOP_LAG_INTERVAL))
+
+# pymongo es síncrono: las operaciones se ejecutan en un pool de hilos acotado, del mismo tamaño
+# que el pool de conexiones del cliente, para no bloquear el bucle de eventos
+MONGO_POOL_SIZE = int(os.getenv("MONGO_POOL_SIZE", "16"))
+mongo_executor = ThreadPoolExecutor(max_workers=MONGO_POOL_SIZE, thread_name_prefix="mongo")
+
+async def run_db(fn, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(mongo_executor, functools.partial(fn, *args, **kwargs))
+
 # Configuración de MongoDB con reintentos
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://mongo:27017/chat_db")
 for attempt in range(10):
     try:
-        client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000)
+        client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000, maxPoolSize=MONGO_POOL_SIZE, event_listeners=[MongoCommandTimer()])
         client.server_info()
         logger.info(f"Conexión a MongoDB establecida correctamente (intento {attempt + 1})")
         break
@@ -50,6 +133,10 @@ messages_collection = db["messages"]
 # URL del API Gateway para validar usuarios
 API_GATEWAY_URL = os.getenv("API_GATEWAY_URL", "http://api-gateway:8000")
 
+# Tiempo durante el que un usuario ya validado no se vuelve a consultar al API Gateway
+VALIDATED_USER_TTL = float(os.getenv("VALIDATED_USER_TTL", "300"))
+VALIDATED_USER_MAX_ENTRIES = int(os.getenv("VALIDATED_USER_MAX_ENTRIES", "10000"))
+
 # OAuth2 para validar tokens
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/login")
 
@@ -65,7 +152,6 @@ class ConnectionManager:
         self.active_connections: dict[str, WebSocket] = {}
 
     async def connect(self, websocket: WebSocket, user_id: str):
-        await websocket.accept()
         self.active_connections[user_id] = websocket
         await websocket.send_json({"status": "connected", "user_id": user_id})
         logger.info(f"Usuario {user_id} conectado vía WebSocket")
@@ -78,7 +164,7 @@ class ConnectionManager:
     async def send_personal_message(self, message: dict, user_id: str):
         if user_id in self.active_connections:
             try:
-                await self.active_connections[user_id].send_json(message)
+                await self.active_connections[user_id].send_text(json.dumps(message, default=str))
                 logger.debug(f"Mensaje enviado a {user_id}: {message}")
             except Exception as e:
                 logger.error(f"Error enviando mensaje a {user_id}: {str(e)}")
@@ -86,8 +172,27 @@ class ConnectionManager:
 
 manager = ConnectionManager()
 
+# Validaciones recientes: (user_id, hash del token) -> instante de expiración. La clave incluye el
+# token para que una validación no sirva para cualquier otro token del mismo usuario
+_validated_users: Dict[Tuple[str, str], float] = {}
+
+def validation_key(user_id: str, token: str) -> Tuple[str, str]:
+    return user_id, hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+def remember_validation(key: Tuple[str, str]):
+    now = time.monotonic()
+    if len(_validated_users) >= VALIDATED_USER_MAX_ENTRIES:
+        for expired in [k for k, expires_at in _validated_users.items() if expires_at <= now]:
+            del _validated_users[expired]
+        if len(_validated_users) >= VALIDATED_USER_MAX_ENTRIES:
+            _validated_users.pop(next(iter(_validated_users)))
+    _validated_users[key] = now + VALIDATED_USER_TTL
+
 # Validar user_id con reintentos y backoff exponencial
 async def validate_user(user_id: str, token: str):
+    key = validation_key(user_id, token)
+    if _validated_users.get(key, 0) > time.monotonic():
+        return
     async with httpx.AsyncClient() as client:
         for attempt in range(5):
             try:
@@ -96,6 +201,7 @@ async def validate_user(user_id: str, token: str):
                     headers={"Authorization": f"Bearer {token}"}
                 )
                 response.raise_for_status()
+                remember_validation(key)
                 logger.debug(f"Usuario {user_id} validado correctamente")
                 return response.json()
             except httpx.HTTPStatusError as e:
@@ -108,18 +214,27 @@ async def validate_user(user_id: str, token: str):
                 else:
                     raise HTTPException(status_code=503, detail=f"No se pudo conectar al API Gateway: {str(e)}")
 
+# Identidad del usuario que hace la petición. Si el API Gateway ya verificó el token
+# envía X-User-Id y no hace falta consultar de nuevo al user-service.
+async def validate_caller(user_id: str, x_user_id: Optional[str], token: str):
+    if x_user_id is None:
+        await validate_user(user_id, token)
+    elif x_user_id != user_id:
+        logger.warning(f"El usuario autenticado {x_user_id} no coincide con {user_id}")
+        raise HTTPException(status_code=403, detail="No autorizado para actuar en nombre de otro usuario")
+
 # Rutas HTTP
 @app.post("/chat/messages")
-async def send_message(message: Message, token: str = Depends(oauth2_scheme)):
+async def send_message(message: Message, token: str = Depends(oauth2_scheme), x_user_id: Optional[str] = Header(None)):
     if message.sender_id == message.receiver_id:
         raise HTTPException(status_code=400, detail="No puedes enviarte un mensaje a ti mismo")
 
-    await validate_user(message.sender_id, token)
+    await validate_caller(message.sender_id, x_user_id, token)
     await validate_user(message.receiver_id, token)
 
     message_dict = message.dict()
     message_dict["created_at"] = datetime.utcnow()
-    result = messages_collection.insert_one(message_dict)
+    result = await run_db(messages_collection.insert_one, message_dict)
     message_id = str(result.inserted_id)
     message_dict["_id"] = message_id
 
@@ -130,26 +245,35 @@ async def send_message(message: Message, token: str = Depends(oauth2_scheme)):
     return {"message": "Mensaje enviado correctamente", "message_id": message_id}
 
 @app.get("/chat/messages/{user_id}/{receiver_id}")
-async def get_messages(user_id: str, receiver_id: str, token: str = Depends(oauth2_scheme)):
-    await validate_user(user_id, token)
+async def get_messages(user_id: str, receiver_id: str, token: str = Depends(oauth2_scheme), x_user_id: Optional[str] = Header(None)):
+    await validate_caller(user_id, x_user_id, token)
     await validate_user(receiver_id, token)
 
-    messages = list(messages_collection.find({
+    messages = await run_db(lambda: list(messages_collection.find({
         "$or": [
             {"sender_id": user_id, "receiver_id": receiver_id},
             {"sender_id": receiver_id, "receiver_id": user_id}
         ]
-    }).sort("created_at", 1))
-    for msg in messages:
-        msg["_id"] = str(msg["_id"])
+    }).sort("created_at", 1)))
     logger.info(f"Obtenidos {len(messages)} mensajes entre {user_id} y {receiver_id}")
-    return messages
+    return FastJSONResponse(messages)
 
 # Ruta WebSocket
 @app.websocket("/ws/chat/{user_id}")
 async def websocket_endpoint(websocket: WebSocket, user_id: str):
     await websocket.accept()
+    WEBSOCKET_CONNECTIONS.labels("direct").inc()
+    try:
+        await handle_chat_session(websocket, user_id)
+    finally:
+        WEBSOCKET_CONNECTIONS.labels("direct").dec()
+
+# Conexión multiplexada del API Gateway: transporta muchas sesiones de chat sobre un solo socket
+@app.websocket("/ws/mux")
+async def websocket_mux(websocket: WebSocket):
+    await serve_mux(websocket, handle_chat_session, WEBSOCKET_CONNECTIONS)
 
+async def handle_chat_session(websocket, user_id: str):
     try:
         token_message = await websocket.receive_text()
         if not token_message.startswith("Bearer "):
@@ -165,7 +289,8 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
         return
 
     try:
-        await validate_user(user_id, token)
+        if getattr(websocket, "verified_user_id", None) != user_id:
+            await validate_user(user_id, token)
     except HTTPException as e:
         logger.error(f"Validación de usuario fallida para {user_id}: {str(e)}")
         await websocket.close(code=1008, reason=str(e.detail))
@@ -208,7 +333,7 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
                 "content": message["content"],
                 "created_at": datetime.utcnow()
             }
-            result = messages_collection.insert_one(message_dict)
+            result = await run_db(messages_collection.insert_one, message_dict)
             message_dict["_id"] = str(result.inserted_id)
 
             await manager.send_personal_message(message_dict, message["receiver_id"])
@@ -217,10 +342,19 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
             logger.info(f"Mensaje WebSocket procesado: {message_dict['_id']}")
     except WebSocketDisconnect:
         manager.disconnect(user_id)
+    except asyncio.CancelledError:
+        # Sesión multiplexada cancelada al cerrarse la conexión del API Gateway
+        manager.disconnect(user_id)
+        raise
     except Exception as e:
         logger.error(f"Error en WebSocket para {user_id}: {str(e)}")
         await websocket.close(code=1008, reason="Error interno del servidor")
 
+# Métricas en formato Prometheus
+@app.get("/metrics")
+async def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8007)
\ No newline at end of file
@@ -1,12 +1,12 @@
-from fastapi import FastAPI, HTTPException, Header
-from pymongo import MongoClient
-from pydantic import BaseModel
-from datetime import datetime
+from fastapi import FastAPI, HTTPException, Request, Response
+from prometheus_client import Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 import os
 from dotenv import load_dotenv
 import logging
-from bson import ObjectId
 import time
+import asyncio
+import httpx
+from contextlib import asynccontextmanager
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
@@ -14,68 +14,103 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-app = FastAPI(title="Comment Service")
+# Los comentarios son del post-service, dueño de las colecciones de comentarios y de sus contadores
+# en los posts (y del trending). Este servicio solo reenvía las peticiones, con el mismo contrato
+POST_SERVICE_URL = os.getenv("POST_SERVICE_URL", "http://post-service:8000")
 
-# Configuración de MongoDB con reintentos
-MONGO_URI = os.getenv("MONGO_URI", "mongodb://mongo:27017/post_db")
-for attempt in range(10):
+# Cliente HTTP compartido: reutiliza conexiones en lugar de abrir un cliente por llamada
+http_client = httpx.AsyncClient(timeout=10.0)
+
+# Monitor del bucle de eventos y cierre del cliente HTTP
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    monitor = asyncio.create_task(monitor_event_loop())
+    yield
+    monitor.cancel()
+    await http_client.aclose()
+
+app = FastAPI(title="Comment Service", lifespan=lifespan)
+
+# Métricas Prometheus
+REQUEST_LATENCY = Histogram("http_request_duration_seconds", "Latencia de las peticiones HTTP", ["method", "route", "status"])
+REQUESTS_IN_FLIGHT = Gauge("http_requests_in_flight", "Peticiones HTTP en curso")
+UPSTREAM_LATENCY = Histogram("upstream_request_duration_seconds", "Latencia de las llamadas al post-service", ["method", "status"])
+EVENT_LOOP_LAG = Histogram(
+    "event_loop_lag_seconds",
+    "Retraso del bucle de eventos al despertar una tarea periódica",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    REQUESTS_IN_FLIGHT.inc()
+    start = time.perf_counter()
+    status = 500
     try:
-        client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000)
-        client.server_info()
-        logger.info(f"Conexión a MongoDB establecida correctamente (intento {attempt + 1})")
-        break
-    except Exception as e:
-        logger.error(f"Intento {attempt + 1} fallido: {str(e)}")
-        if attempt < 9:
-            time.sleep(5)
-        else:
-            raise Exception(f"No se pudo conectar a MongoDB tras 10 intentos: {str(e)}")
-
-db = client["post_db"]
-posts_collection = db["posts"]
-
-# Modelo Pydantic
-class Comment(BaseModel):
-    user_id: str
-    user_name: str
-    content: str
-
-# Ruta para añadir comentario
-@app.post("/posts/{post_id}/comments")
-async def add_comment(post_id: str, comment: Comment, authorization: str = Header(...)):
-    if not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Invalid token format")
-    
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        REQUESTS_IN_FLIGHT.dec()
+        route = request.scope.get("route")
+        REQUEST_LATENCY.labels(request.method, route.path if route else "unmatched", str(status)).observe(time.perf_counter() - start)
+
+# Mide cuánto tarda el bucle en despertar una tarea que duerme un intervalo fijo: el exceso es
+# tiempo en que el bucle estuvo bloqueado por código síncrono
+EVENT_LOOP_LAG_INTERVAL = float(os.getenv("EVENT_LOOP_LAG_INTERVAL", "0.1"))
+
+async def monitor_event_loop():
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        EVENT_LOOP_LAG.observe(max(0.0, time.perf_counter() - start - EVENT_LOOP_LAG_INTERVAL))
+
+# Reenvía la petición tal cual (cuerpo, tipo de contenido, query y headers de identidad) y
+# devuelve la respuesta del post-service sin decodificarla
+FORWARDED_HEADERS = ("authorization", "x-user-id", "content-type")
+
+async def forward(request: Request, path: str) -> Response:
+    headers = {name: value for name, value in request.headers.items() if name in FORWARDED_HEADERS}
+    start = time.perf_counter()
+    status = "error"
     try:
-        comment_dict = comment.dict()
-        comment_dict["created_at"] = datetime.utcnow()
-        result = posts_collection.update_one(
-            {"_id": ObjectId(post_id)},
-            {"$push": {"comments": comment_dict}}
+        response = await http_client.request(
+            request.method,
+            f"{POST_SERVICE_URL}{path}",
+            params=request.query_params,
+            content=await request.body(),
+            headers=headers
         )
-        if result.matched_count == 0:
-            raise HTTPException(status_code=404, detail="Post not found")
-        
-        logger.info(f"Comentario añadido para post_id: {post_id}, user_id: {comment.user_id}")
-        return comment_dict
-    except Exception as e:
-        logger.error(f"Error al añadir comentario: {str(e)}")
-        raise HTTPException(status_code=400, detail=f"Invalid post_id format: {str(e)}")
-
-# Ruta opcional para obtener comentarios de un post (si la necesitas)
+        status = str(response.status_code)
+    except httpx.HTTPError as e:
+        logger.error(f"Error al reenviar {request.method} {path} al post-service: {str(e)}")
+        raise HTTPException(status_code=503, detail="Post service no disponible")
+    finally:
+        UPSTREAM_LATENCY.labels(request.method, status).observe(time.perf_counter() - start)
+    return Response(content=response.content, status_code=response.status_code, media_type=response.headers.get("content-type"))
+
+# Rutas: las mismas que el post-service, con el mismo contrato
+@app.post("/posts/{post_id}/comments")
+async def add_comment(post_id: str, request: Request):
+    logger.info(f"Reenviando comentario del post_id: {post_id} al post-service")
+    return await forward(request, f"/posts/{post_id}/comments")
+
+# Comentarios de un post paginados por cursor (?limit=&cursor=), del más reciente al más antiguo
 @app.get("/posts/{post_id}/comments")
-async def get_comments(post_id: str, authorization: str = Header(...)):
-    if not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Invalid token format")
-    
-    try:
-        post = posts_collection.find_one({"_id": ObjectId(post_id)})
-        if not post:
-            raise HTTPException(status_code=404, detail="Post not found")
-        return {"post_id": post_id, "comments": post.get("comments", [])}
-    except Exception as e:
-        logger.error(f"Error al obtener comentarios: {str(e)}")
-        raise HTTPException(status_code=400, detail=f"Invalid post_id format: {str(e)}")
+async def get_comments(post_id: str, request: Request):
+    logger.info(f"Reenviando lectura de comentarios del post_id: {post_id} al post-service")
+    return await forward(request, f"/posts/{post_id}/comments")
+
+# Like en un comentario: formulario con user_id, como en el post-service
+@app.post("/posts/{post_id}/comments/{comment_id}/likes")
+async def toggle_comment_like(post_id: str, comment_id: str, request: Request):
+    logger.info(f"Reenviando like del comentario {comment_id} del post_id: {post_id} al post-service")
+    return await forward(request, f"/posts/{post_id}/comments/{comment_id}/likes")
+
+# Métricas en formato Prometheus
+@app.get("/metrics")
+async def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 if __name__ == "__main__":
     import uvicorn
@@ -1,5 +1,7 @@
-from fastapi import FastAPI, HTTPException, BackgroundTasks, Header, Body
-from pymongo import MongoClient
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Header, Body, Request, Response
+import orjson
+from pymongo import MongoClient, monitoring, ASCENDING
+from prometheus_client import Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 from pydantic import BaseModel
 from dotenv import load_dotenv
 import os
@@ -7,21 +9,97 @@ from bson import ObjectId
 import time
 import logging
 import httpx
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse
 from datetime import datetime
+from typing import Optional
+import asyncio
+import functools
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 load_dotenv()
 
-app = FastAPI(title="Friend Service")
+# Respuestas JSON con orjson: ObjectId y datetime se codifican sin pasar por jsonable_encoder
+def orjson_default(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError(f"Tipo no serializable: {type(obj).__name__}")
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=orjson_default, option=orjson.OPT_NON_STR_KEYS)
+
+# Monitor del bucle de eventos y cierre del pool de hilos de MongoDB
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    monitor = asyncio.create_task(monitor_event_loop())
+    yield
+    monitor.cancel()
+    mongo_executor.shutdown(wait=False)
+
+app = FastAPI(title="Friend Service", lifespan=lifespan, default_response_class=FastJSONResponse)
+
+# Métricas Prometheus
+REQUEST_LATENCY = Histogram("http_request_duration_seconds", "Latencia de las peticiones HTTP", ["method", "route", "status"])
+REQUESTS_IN_FLIGHT = Gauge("http_requests_in_flight", "Peticiones HTTP en curso")
+MONGO_LATENCY = Histogram("mongo_command_duration_seconds", "Duración de los comandos de MongoDB", ["command", "status"])
+EVENT_LOOP_LAG = Histogram(
+    "event_loop_lag_seconds",
+    "Retraso del bucle de eventos al despertar una tarea periódica",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    REQUESTS_IN_FLIGHT.inc()
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        REQUESTS_IN_FLIGHT.dec()
+        route = request.scope.get("route")
+        REQUEST_LATENCY.labels(request.method, route.path if route else "unmatched", str(status)).observe(time.perf_counter() - start)
+
+# Registrar la duración de cada comando enviado a MongoDB
+class MongoCommandTimer(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_LATENCY.labels(event.command_name, "ok").observe(event.duration_micros / 1_000_000)
+
+    def failed(self, event):
+        MONGO_LATENCY.labels(event.command_name, "error").observe(event.duration_micros / 1_000_000)
+
+# Mide cuánto tarda el bucle en despertar una tarea que duerme un intervalo fijo: el exceso es
+# tiempo en que el bucle estuvo bloqueado por código síncrono
+EVENT_LOOP_LAG_INTERVAL = float(os.getenv("EVENT_LOOP_LAG_INTERVAL", "0.1"))
+
+async def monitor_event_loop():
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        EVENT_LOOP_LAG.observe(max(0.0, time.perf_counter() - start - EVENT_LOOP_LAG_INTERVAL))
+
+# pymongo es síncrono: las operaciones se ejecutan en un pool de hilos acotado, del mismo tamaño
+# que el pool de conexiones del cliente, para no bloquear el bucle de eventos
+MONGO_POOL_SIZE = int(os.getenv("MONGO_POOL_SIZE", "16"))
+mongo_executor = ThreadPoolExecutor(max_workers=MONGO_POOL_SIZE, thread_name_prefix="mongo")
+
+async def run_db(fn, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(mongo_executor, functools.partial(fn, *args, **kwargs))
 
 # Configuración de MongoDB con reintentos
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://mongo:27017/friend_db")
 for attempt in range(10):
     try:
-        client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000)
+        client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000, maxPoolSize=MONGO_POOL_SIZE, event_listeners=[MongoCommandTimer()])
         client.server_info()
         print(f"Conexión a MongoDB establecida correctamente (intento {attempt + 1})")
         break
@@ -35,8 +113,18 @@ for attempt in range(10):
 db = client["friend_db"]
 friends_collection = db["friends"]
 
+# Índice para listar los seguidores de un usuario por páginas, ordenados por user_id
+friends_collection.create_index([("followed_id", ASCENDING), ("user_id", ASCENDING)])
+
+# Tamaño máximo de página del listado de seguidores
+FOLLOWERS_MAX_PAGE_SIZE = int(os.getenv("FOLLOWERS_MAX_PAGE_SIZE", "5000"))
+
 # URL del user-service para actualizar contadores
-USER_SERVICE_URL = "http://user-service:8000"
+USER_SERVICE_URL = os.getenv("USER_SERVICE_URL", "http://user-service:8000")
+# URL del post-service para mantener los timelines materializados
+POST_SERVICE_URL = os.getenv("POST_SERVICE_URL", "http://post-service:8000")
+# Token compartido que el post-service exige en sus rutas internas de timeline
+INTERNAL_API_TOKEN = os.getenv("INTERNAL_API_TOKEN", "")
 
 # Modelo Pydantic
 class FollowRequest(BaseModel):
@@ -83,9 +171,31 @@ async def update_follow_counts(user_id: str, follow_id: str, increment: bool, to
             logger.error(f"Error al conectar con user-service para actualizar contadores: {str(e)}")
             raise HTTPException(status_code=500, detail=f"Error al conectar con user-service: {str(e)}")
 
+# Avisar al post-service de un follow/unfollow para rellenar o limpiar el timeline del seguidor.
+# Se envía el número actual de seguidores para que decida si el autor se lee al vuelo
+async def sync_timeline(user_id: str, follow_id: str, follow: bool, token: str):
+    followers_count = await run_db(friends_collection.count_documents, {"followed_id": follow_id})
+    url = f"{POST_SERVICE_URL}/timeline/{user_id}/follow/{follow_id}"
+    async with httpx.AsyncClient() as client:
+        headers = {"Authorization": token, "X-Internal-Token": INTERNAL_API_TOKEN}
+        try:
+            if follow:
+                response = await client.post(url, json={"followers_count": followers_count}, headers=headers)
+            else:
+                response = await client.delete(url, params={"followers_count": followers_count}, headers=headers)
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            logger.error(f"Error al sincronizar el timeline de {user_id} con {follow_id}: {str(e)}")
+
+# El API Gateway envía X-User-Id con la identidad del token ya verificado
+def check_acting_user(user_id: str, x_user_id: str):
+    if x_user_id and x_user_id.lower().strip() != user_id:
+        logger.warning(f"El usuario autenticado {x_user_id} no coincide con {user_id}")
+        raise HTTPException(status_code=403, detail="No autorizado para actuar en nombre de otro usuario")
+
 # Rutas
 @app.post("/friends/follow/{follow_id}")
-async def follow_user(follow_id: str, user: dict = Body(...), authorization: str = Header(None)):
+async def follow_user(follow_id: str, background_tasks: BackgroundTasks, user: dict = Body(...), authorization: str = Header(None), x_user_id: str = Header(None)):
     try:
         logger.info(f"Header Authorization recibido: {authorization}")
         if not authorization:
@@ -103,14 +213,15 @@ async def follow_user(follow_id: str, user: dict = Body(...), authorization: str
         if user_id == follow_id:
             raise HTTPException(status_code=400, detail="No puedes seguirte a ti mismo")
 
-        # Verificar si ambos usuarios existen
-        if not await user_exists(user_id, authorization):
+        # Verificar si ambos usuarios existen; el usuario autenticado ya lo verificó el API Gateway
+        check_acting_user(user_id, x_user_id)
+        if not x_user_id and not await user_exists(user_id, authorization):
             raise HTTPException(status_code=404, detail=f"El usuario {user_id} no existe")
         if not await user_exists(follow_id, authorization):
             raise HTTPException(status_code=404, detail=f"El usuario {follow_id} no existe")
 
         # Verificar si ya sigue al usuario
-        existing_follow = friends_collection.find_one({"user_id": user_id, "followed_id": follow_id})
+        existing_follow = await run_db(friends_collection.find_one, {"user_id": user_id, "followed_id": follow_id})
         if existing_follow:
             logger.warning(f"Relación de seguimiento ya existe: user_id={user_id}, follow_id={follow_id}")
             raise HTTPException(status_code=400, detail="Ya sigues a este usuario")
@@ -121,11 +232,12 @@ async def follow_user(follow_id: str, user: dict = Body(...), authorization: str
             "followed_id": follow_id,
             "created_at": datetime.utcnow()
         }
-        result = friends_collection.insert_one(follow_data)
+        result = await run_db(friends_collection.insert_one, follow_data)
         logger.info(f"Relación de seguimiento creada: {result.inserted_id}")
 
         # Actualizar contadores de seguimiento usando la función correcta
         await update_follow_counts(user_id, follow_id, True, authorization)
+        background_tasks.add_task(sync_timeline, user_id, follow_id, True, authorization)
 
         return {"message": f"Ahora sigues a {follow_id}"}
     except HTTPException as e:
@@ -135,7 +247,7 @@ async def follow_user(follow_id: str, user: dict = Body(...), authorization: str
         raise HTTPException(status_code=500, detail=f"Error al seguir usuario: {str(e)}")
 
 @app.post("/friends/unfollow/{follow_id}")
-async def unfollow_user(follow_id: str, request: FollowRequest, background_tasks: BackgroundTasks, authorization: str = Header(None)):
+async def unfollow_user(follow_id: str, request: FollowRequest, background_tasks: BackgroundTasks, authorization: str = Header(None), x_user_id: str = Header(None)):
     try:
         logger.info(f"Header Authorization recibido: {authorization}")
         user_id = request.user_id.lower().strip()
@@ -147,24 +259,26 @@ async def unfollow_user(follow_id: str, request: FollowRequest, background_tasks
 
         if not authorization:
             raise HTTPException(status_code=401, detail="Token de autorización requerido")
-        if not await user_exists(user_id, authorization):
+        check_acting_user(user_id, x_user_id)
+        if not x_user_id and not await user_exists(user_id, authorization):
             raise HTTPException(status_code=404, detail=f"Usuario {user_id} no encontrado")
         if not await user_exists(follow_id, authorization):
             raise HTTPException(status_code=404, detail=f"Usuario {follow_id} no encontrado")
 
         # Verificar si sigue al usuario y loguear todas las relaciones
-        existing_follows = list(friends_collection.find({"user_id": user_id, "followed_id": follow_id}))
+        existing_follows = await run_db(lambda: list(friends_collection.find({"user_id": user_id, "followed_id": follow_id})))
         logger.info(f"Relaciones encontradas para user_id={user_id}, follow_id={follow_id}: {existing_follows}")
         if not existing_follows:
             logger.warning(f"No se encontró relación de seguimiento: user_id={user_id}, follow_id={follow_id}")
             raise HTTPException(status_code=400, detail="No sigues a este usuario")
 
         # Eliminar la relación de seguimiento (eliminará todas las coincidencias)
-        result = friends_collection.delete_many({"user_id": user_id, "followed_id": follow_id})
+        result = await run_db(friends_collection.delete_many, {"user_id": user_id, "followed_id": follow_id})
         logger.info(f"Relación de seguimiento eliminada: {result.deleted_count} documentos eliminados")
 
         # Actualizar contadores en user-service
         background_tasks.add_task(update_follow_counts, user_id, follow_id, False, authorization)
+        background_tasks.add_task(sync_timeline, user_id, follow_id, False, authorization)
 
         return {"message": f"Has dejado de seguir a {follow_id}"}
     except Exception as e:
@@ -182,7 +296,7 @@ async def get_following(user_id: str, authorization: str = Header(None)):
             return []
 
         # Obtener todas las relaciones y eliminar duplicados
-        following = list(friends_collection.find({"user_id": user_id}))
+        following = await run_db(lambda: list(friends_collection.find({"user_id": user_id})))
         logger.info(f"Usuarios seguidos por {user_id} (antes de eliminar duplicados): {[friend.get('followed_id') for friend in following]}")
         # Eliminar duplicados manteniendo el orden
         seen = set()
@@ -198,17 +312,26 @@ async def get_following(user_id: str, authorization: str = Header(None)):
         logger.error(f"Error al obtener usuarios seguidos: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error al obtener usuarios seguidos: {str(e)}")
 
+# Con limit se pagina por user_id: la página siguiente empieza después (after) del último follower_id.
+# Los servicios internos (fan-out del post-service) se identifican con X-User-Id, sin token de usuario
 @app.get("/friends/followers/{user_id}")
-async def get_followers(user_id: str, authorization: str = Header(None)):
+async def get_followers(user_id: str, limit: Optional[int] = None, after: Optional[str] = None, authorization: str = Header(None), x_user_id: str = Header(None)):
     try:
         logger.info(f"Header Authorization recibido: {authorization}")
         user_id = user_id.lower().strip()
-        if not authorization:
+        if not authorization and not x_user_id:
             raise HTTPException(status_code=401, detail="Token de autorización requerido")
-        if not await user_exists(user_id, authorization):
+        # La existencia del usuario solo se comprueba en la primera página y sin identidad ya verificada
+        if after is None and not x_user_id and not await user_exists(user_id, authorization):
             return []  # Devolver lista vacía si el usuario no existe
 
-        followers = list(friends_collection.find({"followed_id": user_id}))
+        query = {"followed_id": user_id}
+        if after is not None:
+            query["user_id"] = {"$gt": after}
+        cursor = friends_collection.find(query, {"user_id": 1, "_id": 0})
+        if limit is not None:
+            cursor = cursor.sort("user_id", ASCENDING).limit(max(1, min(limit, FOLLOWERS_MAX_PAGE_SIZE)))
+        followers = await run_db(list, cursor)
         return [{"follower_id": follower["user_id"]} for follower in followers]
     except Exception as e:
         logger.error(f"Error al obtener seguidores: {str(e)}")
@@ -224,10 +347,17 @@ async def get_friends(user_id: str, authorization: str = Header(None)):
         if not await user_exists(user_id, authorization):
             return []  # Devolver lista vacía si el usuario no existe
 
-        following = set(friend["followed_id"] for friend in friends_collection.find({"user_id": user_id}))
-        followers = set(follower["user_id"] for follower in friends_collection.find({"followed_id": user_id}))
+        following, followers = await asyncio.gather(
+            run_db(lambda: set(friend["followed_id"] for friend in friends_collection.find({"user_id": user_id}))),
+            run_db(lambda: set(follower["user_id"] for follower in friends_collection.find({"followed_id": user_id}))),
+        )
         friends = following.intersection(followers)
         return list(friends)
     except Exception as e:
         logger.error(f"Error al obtener amigos: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Error al obtener amigos: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Error al obtener amigos: {str(e)}")
+
+# Métricas en formato Prometheus
+@app.get("/metrics")
+async def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
\ No newline at end of file
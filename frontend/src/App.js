@@ -67,7 +67,7 @@ const App = () => {
       const response = await axios.get(`${API_URL}/posts`, {
         headers: { Authorization: `Bearer ${token}` },
       });
-      setPosts(response.data);
+      setPosts(response.data.posts);
     } catch (err) {
       console.error('Error fetching posts:', err);
     }
@@ -71,16 +71,32 @@ const Explore = ({ token, userId }) => {
     };
 
     const handleSearch = (e) => {
-        const query = e.target.value.toLowerCase();
-        setSearchQuery(query);
-        const filtered = users.filter(
-            (user) =>
-                user.name.toLowerCase().includes(query) ||
-                user.user_id.toLowerCase().includes(query)
-        );
-        setFilteredUsers(filtered);
+        setSearchQuery(e.target.value);
     };
 
+    // Autocompletado en el servidor mientras se escribe; sin texto se muestra la lista completa
+    useEffect(() => {
+        if (!searchQuery.trim()) {
+            setFilteredUsers(users);
+            return undefined;
+        }
+        const timer = setTimeout(async () => {
+            try {
+                const response = await axios.get(`${API_URL}/search/autocomplete`, {
+                    params: { q: searchQuery },
+                    headers: { Authorization: `Bearer ${token}` },
+                });
+                setFilteredUsers(response.data.map(user => ({
+                    ...user,
+                    user_id: user.user_id.toLowerCase().trim(),
+                })));
+            } catch (error) {
+                console.error('Error en la búsqueda:', error.response?.data || error);
+            }
+        }, 250);
+        return () => clearTimeout(timer);
+    }, [searchQuery, users, token]);
+
     const handleFollow = async (followId) => {
         const normalizedFollowId = followId.toLowerCase().trim();
         try {
@@ -209,7 +225,7 @@ const Explore = ({ token, userId }) => {
                         >
                             <ListItemAvatar>
                                 <Avatar
-                                    src={user.profile_image_url ? `${API_URL}${user.profile_image_url}` : undefined}
+                                    src={user.profile_image_url ? `${API_URL}${user.profile_image_url}?size=thumb` : undefined}
                                     sx={{ bgcolor: '#3a3b3c' }}
                                 />
                             </ListItemAvatar>
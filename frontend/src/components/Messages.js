@@ -162,7 +162,7 @@ const Messages = ({ token, userId, userName }) => {
                             >
                                 <ListItemAvatar>
                                     <Avatar
-                                        src={user.profile_image_url ? `${API_URL}${user.profile_image_url}` : undefined}
+                                        src={user.profile_image_url ? `${API_URL}${user.profile_image_url}?size=thumb` : undefined}
                                         sx={{ bgcolor: '#3a3b3c' }}
                                     />
                                 </ListItemAvatar>
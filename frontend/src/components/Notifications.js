@@ -27,6 +27,7 @@ const Notifications = ({ userId, token }) => {
     useEffect(() => {
         const websocket = new WebSocket(`ws://localhost:8000/ws/notifications/${userId}`);
         websocket.onopen = () => {
+            websocket.send(`Bearer ${token}`);
             console.log('WebSocket connected for notifications');
         };
         websocket.onmessage = (event) => {
@@ -44,7 +45,7 @@ const Notifications = ({ userId, token }) => {
         return () => {
             websocket.close();
         };
-    }, [userId]);
+    }, [userId, token]);
 
     return (
         <Paper sx={{ p: 2, bgcolor: '#3a3b3c', color: '#fff', maxWidth: 400, mx: 'auto', mt: 2 }}>
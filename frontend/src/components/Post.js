@@ -5,8 +5,12 @@ import axios from 'axios';
 
 const Post = ({ post, token, userId, userName, fetchPosts }) => {
     const [newComment, setNewComment] = useState('');
+    // Los listados traen un resumen (contadores y últimos comentarios); el resto de comentarios se pide por páginas
     const [comments, setComments] = useState(post.comments || []);
-    const [likes, setLikes] = useState(post.likes || []);
+    const [commentsCursor, setCommentsCursor] = useState(null);
+    const [commentCount, setCommentCount] = useState(post.comment_count ?? (post.comments || []).length);
+    const [liked, setLiked] = useState(post.liked_by_me ?? (post.likes || []).includes(userId));
+    const [likeCount, setLikeCount] = useState(post.like_count ?? (post.likes || []).length);
     const [isBookmarked, setIsBookmarked] = useState(false);
     const [message, setMessage] = useState('');
     const [loading, setLoading] = useState(false);
@@ -45,11 +49,8 @@ const Post = ({ post, token, userId, userName, fetchPosts }) => {
                     },
                 }
             );
-            if (response.data.action === 'added') {
-                setLikes([...likes, userId]);
-            } else {
-                setLikes(likes.filter((id) => id !== userId));
-            }
+            setLiked(response.data.action === 'added');
+            setLikeCount(response.data.like_count);
             fetchPosts();
         } catch (error) {
             const errorMessage = error.response?.data?.detail || error.message;
@@ -85,6 +86,7 @@ const Post = ({ post, token, userId, userName, fetchPosts }) => {
                 }
             );
             setComments([...comments, response.data]);
+            setCommentCount(commentCount + 1);
             setNewComment('');
             setMessage('Comentario añadido con éxito');
             fetchPosts();
@@ -95,14 +97,38 @@ const Post = ({ post, token, userId, userName, fetchPosts }) => {
         }
     };
 
+    // Load older comments page by page (the API returns them newest first)
+    const loadMoreComments = async () => {
+        setLoading(true);
+        setMessage('');
+
+        try {
+            const response = await axios.get(`${API_URL}/posts/${post._id}/comments`, {
+                params: { limit: 20, cursor: commentsCursor || undefined },
+                headers: { Authorization: `Bearer ${token}` },
+            });
+            const page = [...(response.data.comments || [])].reverse();
+            // La primera página ya incluye los comentarios del resumen
+            setComments(commentsCursor ? [...page, ...comments] : page);
+            setCommentsCursor(response.data.next_cursor);
+            if (!response.data.next_cursor) {
+                setCommentCount(commentsCursor ? page.length + comments.length : page.length);
+            }
+        } catch (error) {
+            setMessage('Error al cargar comentarios: ' + (error.response?.data?.detail || error.message));
+        } finally {
+            setLoading(false);
+        }
+    };
+
     // Handle comment like toggle
-    const handleCommentLike = async (commentIndex) => {
+    const handleCommentLike = async (position) => {
         setLoading(true);
         setMessage('');
 
         try {
             const response = await axios.post(
-                `${API_URL}/posts/${post._id}/comments/${commentIndex}/likes`,
+                `${API_URL}/posts/${post._id}/comments/${comments[position]._id}/likes`,
                 `user_id=${userId}`,
                 {
                     headers: {
@@ -112,12 +138,11 @@ const Post = ({ post, token, userId, userName, fetchPosts }) => {
                 }
             );
             const updatedComments = [...comments];
-            const commentLikes = updatedComments[commentIndex].likes || [];
-            if (response.data.action === 'added') {
-                updatedComments[commentIndex].likes = [...commentLikes, userId];
-            } else {
-                updatedComments[commentIndex].likes = commentLikes.filter((id) => id !== userId);
-            }
+            updatedComments[position] = {
+                ...updatedComments[position],
+                liked_by_me: response.data.action === 'added',
+                like_count: response.data.like_count,
+            };
             setComments(updatedComments);
             fetchPosts();
         } catch (error) {
@@ -166,7 +191,7 @@ const Post = ({ post, token, userId, userName, fetchPosts }) => {
             {post.image_url && (
                 <Box sx={{ mt: 1 }}>
                     <img
-                        src={`${API_URL}${post.image_url}`}
+                        src={`${API_URL}${post.image_url}?size=medium`}
                         alt="Post"
                         style={{ maxWidth: '100%', maxHeight: '300px', borderRadius: '8px' }}
                         onError={(e) => console.error('Error cargando imagen:', e)}
@@ -175,17 +200,17 @@ const Post = ({ post, token, userId, userName, fetchPosts }) => {
             )}
             <Box sx={{ display: 'flex', alignItems: 'center', mt: 1 }}>
                 <IconButton onClick={handleLike} disabled={loading}>
-                    {likes.includes(userId) ? (
+                    {liked ? (
                         <Favorite sx={{ color: '#f5a623' }} />
                     ) : (
                         <FavoriteBorder sx={{ color: '#fff' }} />
                     )}
                 </IconButton>
-                <Typography sx={{ mr: 2 }}>{likes.length}</Typography>
+                <Typography sx={{ mr: 2 }}>{likeCount}</Typography>
                 <IconButton disabled>
                     <Comment sx={{ color: '#fff' }} />
                 </IconButton>
-                <Typography sx={{ mr: 2 }}>{comments.length}</Typography>
+                <Typography sx={{ mr: 2 }}>{commentCount}</Typography>
                 <IconButton onClick={handleBookmark} disabled={loading}>
                     {isBookmarked ? (
                         <Bookmark sx={{ color: '#f5a623' }} />
@@ -195,8 +220,13 @@ const Post = ({ post, token, userId, userName, fetchPosts }) => {
                 </IconButton>
             </Box>
             <Box sx={{ mt: 2 }}>
+                {commentCount > comments.length && (
+                    <Button size="small" sx={{ color: '#aaa', ml: 1 }} onClick={loadMoreComments} disabled={loading}>
+                        Ver los {commentCount} comentarios
+                    </Button>
+                )}
                 {comments.map((comment, index) => (
-                    <Box key={index} sx={{ ml: 2, mb: 1 }}>
+                    <Box key={comment._id ?? index} sx={{ ml: 2, mb: 1 }}>
                         <Typography variant="subtitle2" sx={{ color: '#fff' }}>
                             {comment.user_name}
                         </Typography>
@@ -209,14 +239,14 @@ const Post = ({ post, token, userId, userName, fetchPosts }) => {
                                 disabled={loading}
                                 size="small"
                             >
-                                {comment.likes?.includes(userId) ? (
+                                {comment.liked_by_me ? (
                                     <Favorite sx={{ color: '#f5a623', fontSize: 16 }} />
                                 ) : (
                                     <FavoriteBorder sx={{ color: '#fff', fontSize: 16 }} />
                                 )}
                             </IconButton>
                             <Typography variant="caption" sx={{ color: '#fff' }}>
-                                {comment.likes?.length || 0}
+                                {comment.like_count || 0}
                             </Typography>
                         </Box>
                     </Box>
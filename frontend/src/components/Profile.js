@@ -42,10 +42,10 @@ const Profile = ({ token, userId, userName }) => {
             console.log('Fetching posts');
             const response = await axios.get(`${API_URL}/posts`, {
                 headers: { Authorization: `Bearer ${token}` },
+                params: { user_id: userId },
             });
             console.log('Posts data:', response.data);
-            const enrichedPosts = response.data
-                .filter((post) => post.user_id === userId)
+            const enrichedPosts = response.data.posts
                 .map((post) => ({
                     ...post,
                     userName,
@@ -213,7 +213,7 @@ const Profile = ({ token, userId, userName }) => {
                     <Box sx={{ position: 'relative', height: 150, bgcolor: '#1a1a1a', mb: 4 }}>
                         {profile?.cover_image_url || coverImagePreview ? (
                             <img
-                                src={coverImagePreview || `${API_URL}${profile.cover_image_url}`}
+                                src={coverImagePreview || `${API_URL}${profile.cover_image_url}?size=full`}
                                 alt="Portada"
                                 style={{ width: '100%', height: '100%', objectFit: 'cover' }}
                                 onError={() => console.error('Error loading cover image:', profile.cover_image_url)}
@@ -228,7 +228,7 @@ const Profile = ({ token, userId, userName }) => {
                     </Box>
                     <Box sx={{ display: 'flex', alignItems: 'center', mb: 2, mt: -8 }}>
                         <Avatar
-                            src={profile?.profile_image_url ? `${API_URL}${profile.profile_image_url}` : profileImagePreview}
+                            src={profile?.profile_image_url ? `${API_URL}${profile.profile_image_url}?size=medium` : profileImagePreview}
                             sx={{ width: 80, height: 80, border: '2px solid #292A2C', bgcolor: '#3a3b3c' }}
                             onError={() => console.error('Error loading profile image:', profile.profile_image_url)}
                         />
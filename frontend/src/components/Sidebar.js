@@ -89,7 +89,7 @@ const Sidebar = ({ handleLogout, userName, userId }) => {
             <Box sx={{ mb: 2 }}>
                 <Box sx={{ display: 'flex', alignItems: 'center', gap: 1, mb: 2 }}>
                     <Avatar
-                        src={profile?.profile_image_url ? `${API_URL}${profile.profile_image_url}` : undefined}
+                        src={profile?.profile_image_url ? `${API_URL}${profile.profile_image_url}?size=thumb` : undefined}
                         sx={{ width: 32, height: 32 }}
                     />
                     <Box>
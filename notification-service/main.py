@@ -1,14 +1,23 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
-from pymongo import MongoClient
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Request, Response
+from fastapi.responses import JSONResponse
+import orjson
+from pymongo import MongoClient, monitoring
+from prometheus_client import Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 from pydantic import BaseModel
 from datetime import datetime
 import os
 from dotenv import load_dotenv
 import logging
 import asyncio
+import json
 import time
 from typing import List, Dict
 from bson import ObjectId
+import functools
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from shared.mux import serve_mux
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
@@ -16,13 +25,85 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-app = FastAPI(title="Notification Service")
+# Respuestas JSON con orjson: ObjectId y datetime se codifican sin pasar por jsonable_encoder
+def orjson_default(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError(f"Tipo no serializable: {type(obj).__name__}")
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=orjson_default, option=orjson.OPT_NON_STR_KEYS)
+
+# Monitor del bucle de eventos y cierre del pool de hilos de MongoDB
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    monitor = asyncio.create_task(monitor_event_loop())
+    yield
+    monitor.cancel()
+    mongo_executor.shutdown(wait=False)
+
+app = FastAPI(title="Notification Service", lifespan=lifespan, default_response_class=FastJSONResponse)
+
+# Métricas Prometheus
+REQUEST_LATENCY = Histogram("http_request_duration_seconds", "Latencia de las peticiones HTTP", ["method", "route", "status"])
+REQUESTS_IN_FLIGHT = Gauge("http_requests_in_flight", "Peticiones HTTP en curso")
+MONGO_LATENCY = Histogram("mongo_command_duration_seconds", "Duración de los comandos de MongoDB", ["command", "status"])
+EVENT_LOOP_LAG = Histogram(
+    "event_loop_lag_seconds",
+    "Retraso del bucle de eventos al despertar una tarea periódica",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+WEBSOCKET_CONNECTIONS = Gauge("websocket_connections", "Conexiones WebSocket activas", ["transport"])
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    REQUESTS_IN_FLIGHT.inc()
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        REQUESTS_IN_FLIGHT.dec()
+        route = request.scope.get("route")
+        REQUEST_LATENCY.labels(request.method, route.path if route else "unmatched", str(status)).observe(time.perf_counter() - start)
+
+# Registrar la duración de cada comando enviado a MongoDB
+class MongoCommandTimer(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_LATENCY.labels(event.command_name, "ok").observe(event.duration_micros / 1_000_000)
+
+    def failed(self, event):
+        MONGO_LATENCY.labels(event.command_name, "error").observe(event.duration_micros / 1_000_000)
+
+# Mide cuánto tarda el bucle en despertar una tarea que duerme un intervalo fijo: el exceso es
+# tiempo en que el bucle estuvo bloqueado por código síncrono
+EVENT_LOOP_LAG_INTERVAL = float(os.getenv("EVENT_LOOP_LAG_INTERVAL", "0.1"))
+
+async def monitor_event_loop():
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        EVENT_LOOP_LAG.observe(max(0.0, time.perf_counter() - start - EVENT_LOOP_LAG_INTERVAL))
+
+# pymongo es síncrono: las operaciones se ejecutan en un pool de hilos acotado, del mismo tamaño
+# que el pool de conexiones del cliente, para no bloquear el bucle de eventos
+MONGO_POOL_SIZE = int(os.getenv("MONGO_POOL_SIZE", "16"))
+mongo_executor = ThreadPoolExecutor(max_workers=MONGO_POOL_SIZE, thread_name_prefix="mongo")
+
+async def run_db(fn, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(mongo_executor, functools.partial(fn, *args, **kwargs))
 
 # Configuración de MongoDB con reintentos
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://mongo:27017/notification_db")
 for attempt in range(10):
     try:
-        client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000)
+        client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000, maxPoolSize=MONGO_POOL_SIZE, event_listeners=[MongoCommandTimer()])
         client.server_info()
         logger.info("Conexión a MongoDB establecida correctamente")
         break
@@ -44,6 +125,16 @@ class Notification(BaseModel):
     related_post_id: str
     created_at: datetime = None
 
+# Misma notificación para muchos destinatarios (fan-out de un post nuevo)
+class BulkNotification(BaseModel):
+    user_ids: List[str]
+    message: str
+    type: str
+    related_post_id: str
+
+# Destinatarios máximos por petición bulk
+NOTIFICATION_BULK_MAX = int(os.getenv("NOTIFICATION_BULK_MAX", "1000"))
+
 # Almacenar conexiones WebSocket activas
 websocket_connections: Dict[str, List[WebSocket]] = {}
 
@@ -51,6 +142,18 @@ websocket_connections: Dict[str, List[WebSocket]] = {}
 @app.websocket("/ws/notifications/{user_id}")
 async def websocket_endpoint(websocket: WebSocket, user_id: str):
     await websocket.accept()
+    WEBSOCKET_CONNECTIONS.labels("direct").inc()
+    try:
+        await handle_notification_session(websocket, user_id)
+    finally:
+        WEBSOCKET_CONNECTIONS.labels("direct").dec()
+
+# Conexión multiplexada del API Gateway: transporta muchas suscripciones sobre un solo socket
+@app.websocket("/ws/mux")
+async def websocket_mux(websocket: WebSocket):
+    await serve_mux(websocket, handle_notification_session, WEBSOCKET_CONNECTIONS)
+
+async def handle_notification_session(websocket, user_id: str):
     if user_id not in websocket_connections:
         websocket_connections[user_id] = []
     websocket_connections[user_id].append(websocket)
@@ -59,22 +162,24 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
         while True:
             await websocket.receive_text()  # Mantener la conexión viva
     except WebSocketDisconnect:
+        logger.info(f"WebSocket desconectado para user_id: {user_id}")
+    finally:
         websocket_connections[user_id].remove(websocket)
         if not websocket_connections[user_id]:
             del websocket_connections[user_id]
-        logger.info(f"WebSocket desconectado para user_id: {user_id}")
 
 # Enviar notificación a un usuario
 async def send_notification(user_id: str, notification: Notification):
     notification_dict = notification.dict()
     notification_dict["created_at"] = datetime.utcnow()
-    notifications_collection.insert_one(notification_dict)
+    await run_db(notifications_collection.insert_one, notification_dict)
     logger.info(f"Notificación guardada para user_id: {user_id}, tipo: {notification.type}")
 
     if user_id in websocket_connections:
-        for ws in websocket_connections[user_id]:
+        payload = json.dumps(notification_dict, default=str)
+        for ws in list(websocket_connections[user_id]):
             try:
-                await ws.send_json(notification_dict)
+                await ws.send_text(payload)
                 logger.info(f"Notificación enviada a user_id: {user_id} via WebSocket")
             except Exception as e:
                 logger.error(f"Error enviando notificación a user_id: {user_id}: {str(e)}")
@@ -85,14 +190,45 @@ async def create_notification(notification: Notification):
     await send_notification(notification.user_id, notification)
     return {"message": "Notificación creada y enviada"}
 
+# Endpoint bulk: una sola escritura en MongoDB para todo el lote y envío a los sockets conectados
+@app.post("/notifications/bulk")
+async def create_notifications_bulk(bulk: BulkNotification):
+    if len(bulk.user_ids) > NOTIFICATION_BULK_MAX:
+        raise HTTPException(status_code=413, detail=f"Máximo {NOTIFICATION_BULK_MAX} destinatarios por petición")
+    user_ids = list(dict.fromkeys(bulk.user_ids))
+    if not user_ids:
+        return {"message": "Sin destinatarios", "count": 0}
+    created_at = datetime.utcnow()
+    notifications = [
+        {"user_id": user_id, "message": bulk.message, "type": bulk.type, "related_post_id": bulk.related_post_id, "created_at": created_at}
+        for user_id in user_ids
+    ]
+    await run_db(notifications_collection.insert_many, notifications, ordered=False)
+    logger.info(f"{len(notifications)} notificaciones guardadas, tipo: {bulk.type}")
+
+    for notification in notifications:
+        connections = websocket_connections.get(notification["user_id"])
+        if not connections:
+            continue
+        payload = json.dumps(notification, default=str)
+        for ws in list(connections):
+            try:
+                await ws.send_text(payload)
+            except Exception as e:
+                logger.error(f"Error enviando notificación a user_id: {notification['user_id']}: {str(e)}")
+    return {"message": "Notificaciones creadas y enviadas", "count": len(notifications)}
+
 # Endpoint para obtener notificaciones de un usuario
 @app.get("/notifications/{user_id}")
 async def get_notifications(user_id: str):
-    notifications = list(notifications_collection.find({"user_id": user_id}).sort("created_at", -1))
-    for notif in notifications:
-        notif["_id"] = str(notif["_id"])
+    notifications = await run_db(lambda: list(notifications_collection.find({"user_id": user_id}).sort("created_at", -1)))
     logger.info(f"Obtenidas {len(notifications)} notificaciones para user_id: {user_id}")
-    return notifications
+    return FastJSONResponse(notifications)
+
+# Métricas en formato Prometheus
+@app.get("/metrics")
+async def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 if __name__ == "__main__":
     import uvicorn
@@ -1,16 +1,31 @@
-from fastapi import FastAPI, HTTPException, Header, UploadFile, File, Form
-from pymongo import MongoClient
+from fastapi import FastAPI, HTTPException, Header, UploadFile, File, Form, Query, Request, Response
+import orjson
+from pymongo import MongoClient, monitoring, ASCENDING, DESCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 from pydantic import BaseModel
-from datetime import datetime
-from fastapi.staticfiles import StaticFiles
+from datetime import datetime, timedelta
+from fastapi.responses import JSONResponse
+import asyncio
+import base64
+import hashlib
+import heapq
+import hmac
+import math
 import os
+import re
+import unicodedata
 from dotenv import load_dotenv
+from contextlib import asynccontextmanager
 from bson import ObjectId
 import logging
-from typing import Optional, List
+from typing import Dict, Optional, List, Tuple
 import time
-import uuid
 import httpx
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from shared.uploads import UploadStore
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
@@ -18,16 +33,112 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-app = FastAPI(title="Post Service")
+# Respuestas JSON con orjson: ObjectId y datetime se codifican sin pasar por jsonable_encoder
+def orjson_default(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError(f"Tipo no serializable: {type(obj).__name__}")
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=orjson_default, option=orjson.OPT_NON_STR_KEYS)
+
+# Workers de fan-out, persistencia del trending, limpieza de imágenes sin referencias y monitor
+# del bucle en segundo plano; pool de procesos de las variantes de imagen y cierre del cliente
+# HTTP compartido y de los pools
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # La cola se crea dentro del bucle de eventos (en Python 3.9 se asocia al bucle al construirla)
+    global fanout_queue
+    fanout_queue = asyncio.Queue(maxsize=FANOUT_QUEUE_SIZE)
+    await upload_store.start_image_pool()
+    workers = [asyncio.create_task(fanout_worker()) for _ in range(FANOUT_WORKERS)]
+    await run_db(load_trending)
+    workers.append(asyncio.create_task(trending_persister()))
+    workers.append(asyncio.create_task(upload_store.sweeper()))
+    workers.append(asyncio.create_task(monitor_event_loop()))
+    yield
+    for worker in workers:
+        worker.cancel()
+    await persist_trending()
+    await http_client.aclose()
+    mongo_executor.shutdown(wait=False)
+    upload_store.shutdown()
+
+app = FastAPI(title="Post Service", lifespan=lifespan, default_response_class=FastJSONResponse)
+
+# Métricas Prometheus
+REQUEST_LATENCY = Histogram("http_request_duration_seconds", "Latencia de las peticiones HTTP", ["method", "route", "status"])
+REQUESTS_IN_FLIGHT = Gauge("http_requests_in_flight", "Peticiones HTTP en curso")
+MONGO_LATENCY = Histogram("mongo_command_duration_seconds", "Duración de los comandos de MongoDB", ["command", "status"])
+EVENT_LOOP_LAG = Histogram(
+    "event_loop_lag_seconds",
+    "Retraso del bucle de eventos al despertar una tarea periódica",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+IMAGE_PROCESSING = Histogram("image_variants_duration_seconds", "Duración de la generación de variantes de una imagen")
+FANOUT_LAG = Histogram(
+    "post_fanout_lag_seconds",
+    "Tiempo desde la creación de un post hasta notificar a todos sus seguidores",
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600),
+)
+FANOUT_QUEUE_DEPTH = Gauge("post_fanout_queue_depth", "Posts pendientes de fan-out")
+FANOUT_NOTIFICATIONS = Counter("post_fanout_notifications_total", "Notificaciones de fan-out por resultado", ["status"])
+FANOUT_DROPPED = Counter("post_fanout_dropped_total", "Posts sin fan-out por cola llena")
+TRENDING_TRACKED = Gauge("post_trending_tracked", "Posts seguidos en memoria por el trending")
+TRENDING_EVICTIONS = Counter("post_trending_evictions_total", "Posts expulsados del trending por falta de capacidad")
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    REQUESTS_IN_FLIGHT.inc()
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        REQUESTS_IN_FLIGHT.dec()
+        route = request.scope.get("route")
+        REQUEST_LATENCY.labels(request.method, route.path if route else "unmatched", str(status)).observe(time.perf_counter() - start)
+
+# Registrar la duración de cada comando enviado a MongoDB
+class MongoCommandTimer(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_LATENCY.labels(event.command_name, "ok").observe(event.duration_micros / 1_000_000)
+
+    def failed(self, event):
+        MONGO_LATENCY.labels(event.command_name, "error").observe(event.duration_micros / 1_000_000)
 
-# Montar el directorio de imágenes estáticas
-app.mount("/uploads", StaticFiles(directory="/app/uploads"), name="uploads")
+# Directorio de imágenes de los posts
+UPLOADS_DIR = os.getenv("UPLOADS_DIR", "/app/uploads")
+
+# Mide cuánto tarda el bucle en despertar una tarea que duerme un intervalo fijo: el exceso es
+# tiempo en que el bucle estuvo bloqueado por código síncrono
+EVENT_LOOP_LAG_INTERVAL = float(os.getenv("EVENT_LOOP_LAG_INTERVAL", "0.1"))
+
+async def monitor_event_loop():
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        EVENT_LOOP_LAG.observe(max(0.0, time.perf_counter() - start - EVENT_LOOP_LAG_INTERVAL))
+
+# pymongo es síncrono: las operaciones se ejecutan en un pool de hilos acotado, del mismo tamaño
+# que el pool de conexiones del cliente, para no bloquear el bucle de eventos
+MONGO_POOL_SIZE = int(os.getenv("MONGO_POOL_SIZE", "16"))
+mongo_executor = ThreadPoolExecutor(max_workers=MONGO_POOL_SIZE, thread_name_prefix="mongo")
+
+async def run_db(fn, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(mongo_executor, functools.partial(fn, *args, **kwargs))
 
 # Configuración de MongoDB con reintentos
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://mongo:27017/post_db")
 for attempt in range(10):
     try:
-        client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000)
+        client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000, maxPoolSize=MONGO_POOL_SIZE, event_listeners=[MongoCommandTimer()])
         client.server_info()
         logger.info("Conexión a MongoDB establecida correctamente")
         break
@@ -41,54 +152,646 @@ for attempt in range(10):
 db = client["post_db"]
 posts_collection = db["posts"]
 
+# Índices del listado paginado: global por fecha y por autor; _id desempata posts con la misma fecha
+posts_collection.create_index([("created_at", DESCENDING), ("_id", DESCENDING)])
+posts_collection.create_index([("user_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)])
+
+# Contadores desnormalizados de likes y comentarios; se rellenan en los posts que aún no los tienen
+posts_collection.update_many({"like_count": {"$exists": False}}, [{"$set": {"like_count": {"$size": {"$ifNull": ["$likes", []]}}}}])
+posts_collection.update_many({"comment_count": {"$exists": False}}, [{"$set": {"comment_count": {"$size": {"$ifNull": ["$comments", []]}}}}])
+
+# Likes en su propia colección, un documento por (post, usuario): el índice único impide likes
+# duplicados y sirve también para "qué posts de esta lista le gustan a un usuario". El post
+# solo guarda el contador like_count
+likes_collection = db["likes"]
+likes_collection.create_index([("post_id", ASCENDING), ("user_id", ASCENDING)], unique=True)
+LIKES_BATCH_MAX = int(os.getenv("LIKES_BATCH_MAX", "100"))
+LIKES_PAGE_SIZE = int(os.getenv("LIKES_PAGE_SIZE", "100"))
+LIKES_MAX_PAGE_SIZE = int(os.getenv("LIKES_MAX_PAGE_SIZE", "1000"))
+
+# Inserta documentos ignorando los que ya existen (migraciones repetidas tras una interrupción)
+def insert_missing(collection, docs: List[dict]):
+    if not docs:
+        return
+    try:
+        collection.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+            raise
+
+# Migración de los arrays de likes embebidos en los posts a la colección de likes
+def migrate_embedded_likes() -> int:
+    posts_collection.update_many({"likes": {"$size": 0}}, {"$unset": {"likes": ""}})
+    migrated = 0
+    for post in posts_collection.find({"likes.0": {"$exists": True}}, {"likes": 1}):
+        insert_missing(likes_collection, [{"post_id": post["_id"], "user_id": user_id} for user_id in dict.fromkeys(post["likes"])])
+        like_count = likes_collection.count_documents({"post_id": post["_id"]})
+        posts_collection.update_one({"_id": post["_id"]}, {"$unset": {"likes": ""}, "$set": {"like_count": like_count}})
+        migrated += 1
+    return migrated
+
+migrated_likes = migrate_embedded_likes()
+if migrated_likes:
+    logger.info(f"Likes de {migrated_likes} posts migrados a la colección de likes")
+
+# Tamaño de página del listado de posts
+POSTS_PAGE_SIZE = int(os.getenv("POSTS_PAGE_SIZE", "20"))
+POSTS_MAX_PAGE_SIZE = int(os.getenv("POSTS_MAX_PAGE_SIZE", "100"))
+# Comentarios más recientes incluidos en el resumen de cada post
+POST_SUMMARY_COMMENTS = int(os.getenv("POST_SUMMARY_COMMENTS", "3"))
+
+# Comentarios en su propia colección, con _id estable. El post solo guarda comment_count y los _id
+# de sus últimos comentarios para los resúmenes, así su tamaño no crece con cada comentario. Los
+# likes de comentarios van aparte, uno por (comentario, usuario) con índice único. Solo este
+# servicio las lee y escribe; el comment-service reenvía aquí sus rutas
+COMMENTS_PAGE_SIZE = int(os.getenv("COMMENTS_PAGE_SIZE", "20"))
+COMMENTS_MAX_PAGE_SIZE = int(os.getenv("COMMENTS_MAX_PAGE_SIZE", "100"))
+comments_collection = db["comments"]
+comments_collection.create_index([("post_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)])
+comment_likes_collection = db["comment_likes"]
+comment_likes_collection.create_index([("comment_id", ASCENDING), ("user_id", ASCENDING)], unique=True)
+
+# Migración de los arrays de comentarios embebidos: cada comentario pasa a la colección con un _id
+# derivado del post y de su posición, así repetir una migración interrumpida no lo duplica
+def migrate_embedded_comments() -> int:
+    posts_collection.update_many({"comments": {"$size": 0}}, {"$unset": {"comments": ""}})
+    migrated = 0
+    for post in posts_collection.find({"comments.0": {"$exists": True}}, {"comments": 1, "created_at": 1}):
+        comments, comment_likes = [], []
+        for position, embedded in enumerate(post["comments"]):
+            comment_id = ObjectId(hashlib.sha1(f"{post['_id']}:{position}".encode()).digest()[:12])
+            likes = list(dict.fromkeys(embedded.get("likes") or []))
+            comments.append({
+                "_id": comment_id,
+                "post_id": post["_id"],
+                "user_id": embedded.get("user_id"),
+                "user_name": embedded.get("user_name"),
+                "content": embedded.get("content"),
+                "created_at": embedded.get("created_at") or post.get("created_at") or datetime.utcnow(),
+                "like_count": len(likes),
+            })
+            comment_likes.extend({"comment_id": comment_id, "user_id": user_id} for user_id in likes)
+        insert_missing(comments_collection, comments)
+        insert_missing(comment_likes_collection, comment_likes)
+        recent = comments_collection.find({"post_id": post["_id"]}, {"_id": 1}).sort([("created_at", DESCENDING), ("_id", DESCENDING)]).limit(POST_SUMMARY_COMMENTS)
+        posts_collection.update_one({"_id": post["_id"]}, {
+            "$unset": {"comments": ""},
+            "$set": {
+                "comment_count": comments_collection.count_documents({"post_id": post["_id"]}),
+                "recent_comment_ids": [comment["_id"] for comment in recent][::-1],
+            },
+        })
+        migrated += 1
+    return migrated
+
+migrated_comments = migrate_embedded_comments()
+if migrated_comments:
+    logger.info(f"Comentarios de {migrated_comments} posts migrados a la colección de comentarios")
+
+# Timelines materializados (fan-out en escritura): una entrada por seguidor y post.
+# Los autores con muchos seguidores ("celebridades") no se copian: sus posts se leen al vuelo
+timelines_collection = db["timelines"]
+timeline_authors_collection = db["timeline_authors"]
+timelines_collection.create_index([("user_id", ASCENDING), ("created_at", DESCENDING), ("post_id", DESCENDING)])
+timelines_collection.create_index([("user_id", ASCENDING), ("post_id", ASCENDING)], unique=True)
+timelines_collection.create_index([("user_id", ASCENDING), ("author_id", ASCENDING)])
+TIMELINE_CELEBRITY_FOLLOWERS = int(os.getenv("TIMELINE_CELEBRITY_FOLLOWERS", "10000"))
+TIMELINE_BACKFILL_POSTS = int(os.getenv("TIMELINE_BACKFILL_POSTS", "50"))
+# Seguidos de cada usuario, mantenidos con los eventos de follow/unfollow del friend-service. Cada
+# relación lleva si el autor es celebridad, así leer un timeline solo toca las celebridades seguidas
+timeline_follows_collection = db["timeline_follows"]
+timeline_follows_collection.create_index([("user_id", ASCENDING), ("author_id", ASCENDING)], unique=True)
+timeline_follows_collection.create_index([("user_id", ASCENDING), ("celebrity", ASCENDING)])
+timeline_follows_collection.create_index([("author_id", ASCENDING)])
+# Última copia completa de los seguidos de cada usuario desde el friend-service. La primera lectura
+# del timeline la hace en línea; después se repite en segundo plano por si se perdió algún evento
+timeline_follow_sync_collection = db["timeline_follow_sync"]
+TIMELINE_FOLLOWING_RESYNC_HOURS = float(os.getenv("TIMELINE_FOLLOWING_RESYNC_HOURS", "24"))
+
+# Búsqueda: términos normalizados (minúsculas, sin acentos) del contenido en un array indexado
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "20"))
+SEARCH_MAX_PAGE_SIZE = int(os.getenv("SEARCH_MAX_PAGE_SIZE", "50"))
+# Candidatos (los más recientes) que se ordenan por relevancia en cada búsqueda
+SEARCH_MAX_CANDIDATES = int(os.getenv("SEARCH_MAX_CANDIDATES", "500"))
+
+def search_words(text: Optional[str]) -> List[str]:
+    if not text:
+        return []
+    normalized = unicodedata.normalize("NFKD", text.lower())
+    normalized = "".join(char for char in normalized if not unicodedata.combining(char))
+    return re.findall(r"\w+", normalized)
+
+def search_tokens(*texts: Optional[str]) -> List[str]:
+    return list(dict.fromkeys(word for text in texts for word in search_words(text)))
+
+# Frecuencia de los términos en el contenido, con bonus por likes y por antigüedad (semanas)
+def rank_post(post: dict, tokens: List[str], now: datetime) -> float:
+    words = search_words(post.get("content"))
+    score = sum(math.log1p(words.count(token)) for token in tokens)
+    age_weeks = max((now - post["created_at"]).total_seconds(), 0) / (7 * 24 * 3600)
+    return score + 0.3 * math.log1p(post.get("like_count", 0)) + 1.0 / (1.0 + age_weeks)
+
+posts_collection.create_index([("search_terms", ASCENDING), ("created_at", DESCENDING)])
+
+# Indexar los posts creados antes de la búsqueda
+def index_missing_posts(batch_size: int = 1000):
+    batch = []
+    indexed = 0
+    for post in posts_collection.find({"search_terms": {"$exists": False}}, {"content": 1}):
+        batch.append(UpdateOne({"_id": post["_id"]}, {"$set": {"search_terms": search_tokens(post.get("content"))}}))
+        if len(batch) >= batch_size:
+            posts_collection.bulk_write(batch, ordered=False)
+            indexed += len(batch)
+            batch = []
+    if batch:
+        posts_collection.bulk_write(batch, ordered=False)
+        indexed += len(batch)
+    if indexed:
+        logger.info(f"Índice de búsqueda: {indexed} posts indexados")
+
+index_missing_posts()
+
 # URL del notification-service
 NOTIFICATION_SERVICE_URL = os.getenv("NOTIFICATION_SERVICE_URL", "http://notification-service:8008")
 FRIEND_SERVICE_URL = os.getenv("FRIEND_SERVICE_URL", "http://friend-service:8006")
+# Las rutas /timeline/.../follow solo las llama el friend-service: piden en X-Internal-Token el
+# mismo INTERNAL_API_TOKEN que el gateway exige en /internal/ y, si no está configurado, no se sirven
+INTERNAL_API_TOKEN = os.getenv("INTERNAL_API_TOKEN", "")
+
+def check_internal_token(x_internal_token: Optional[str]):
+    if not INTERNAL_API_TOKEN or not hmac.compare_digest((x_internal_token or "").encode(), INTERNAL_API_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Endpoint interno")
+
+# Cliente HTTP compartido: reutiliza conexiones en lugar de abrir un cliente por llamada
+http_client = httpx.AsyncClient(timeout=10.0)
+
+# Fan-out de notificaciones de posts nuevos: cola en memoria consumida por workers en segundo plano,
+# seguidores por páginas y notificaciones por lotes al endpoint bulk del notification-service
+FANOUT_QUEUE_SIZE = int(os.getenv("FANOUT_QUEUE_SIZE", "10000"))
+FANOUT_WORKERS = int(os.getenv("FANOUT_WORKERS", "2"))
+FANOUT_PAGE_SIZE = int(os.getenv("FANOUT_PAGE_SIZE", "1000"))
+FANOUT_BATCH_SIZE = int(os.getenv("FANOUT_BATCH_SIZE", "500"))
+FANOUT_CONCURRENCY = int(os.getenv("FANOUT_CONCURRENCY", "4"))
 
 # Modelos Pydantic
 class Comment(BaseModel):
     user_id: str
     user_name: str
     content: str
-    created_at: Optional[datetime] = None
-    likes: Optional[List[str]] = []
 
 class Post(BaseModel):
     content: str
     user_id: str
     image_url: Optional[str] = None
-    comments: Optional[List[Comment]] = []
-    likes: Optional[List[str]] = []
+    like_count: int = 0
+    comment_count: int = 0
     created_at: Optional[datetime] = None
 
 # Enviar notificación asíncrona
 async def send_notification(user_id: str, message: str, type: str, post_id: str):
-    async with httpx.AsyncClient() as client:
+    try:
+        response = await http_client.post(
+            f"{NOTIFICATION_SERVICE_URL}/notifications",
+            json={
+                "user_id": user_id,
+                "message": message,
+                "type": type,
+                "related_post_id": post_id
+            }
+        )
+        response.raise_for_status()
+        logger.info(f"Notificación enviada a user_id: {user_id}, tipo: {type}")
+    except httpx.HTTPError as e:
+        logger.error(f"Error enviando notificación a user_id: {user_id}: {str(e)}")
+
+# Misma notificación para un lote de usuarios en una sola petición
+async def send_bulk_notification(user_ids: List[str], message: str, type: str, post_id: str) -> bool:
+    try:
+        response = await http_client.post(
+            f"{NOTIFICATION_SERVICE_URL}/notifications/bulk",
+            json={
+                "user_ids": user_ids,
+                "message": message,
+                "type": type,
+                "related_post_id": post_id
+            }
+        )
+        response.raise_for_status()
+        FANOUT_NOTIFICATIONS.labels("ok").inc(len(user_ids))
+        return True
+    except httpx.HTTPError as e:
+        FANOUT_NOTIFICATIONS.labels("error").inc(len(user_ids))
+        logger.error(f"Error enviando {len(user_ids)} notificaciones del post {post_id}: {str(e)}")
+        return False
+
+# Página de seguidores de un usuario, ordenada por follower_id
+# El fan-out puede ejecutarse mucho después de publicar: se identifica con X-User-Id (el autor), como
+# hace el gateway, y no con el token del usuario, que podría haber caducado
+async def get_followers_page(user_id: str, after: Optional[str] = None) -> List[str]:
+    params = {"limit": FANOUT_PAGE_SIZE}
+    if after is not None:
+        params["after"] = after
+    response = await http_client.get(
+        f"{FRIEND_SERVICE_URL}/friends/followers/{user_id}",
+        params=params,
+        headers={"X-User-Id": user_id}
+    )
+    response.raise_for_status()
+    return [follower["follower_id"] for follower in response.json()]
+
+# Los timelines se indexan por user_id normalizado, igual que las relaciones del friend-service
+def timeline_key(user_id: str) -> str:
+    return user_id.lower().strip()
+
+# Inserta entradas de timeline; las ya existentes (reintentos, backfill previo) se ignoran
+def insert_timeline_entries(entries: List[dict]):
+    if not entries:
+        return
+    try:
+        timelines_collection.insert_many(entries, ordered=False)
+    except BulkWriteError as e:
+        if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+            raise
+
+def timeline_entry(user_id: str, post_id: ObjectId, author_id: str, created_at: datetime) -> dict:
+    return {"user_id": timeline_key(user_id), "post_id": post_id, "author_id": timeline_key(author_id), "created_at": created_at}
+
+# Número de seguidores conocido de un autor; al superar el umbral pasa a celebridad y no vuelve
+# a copiarse en timelines (si dejara de serlo, sus posts antiguos desaparecerían de ellos)
+def update_timeline_author(author_id: str, followers_count: int, user_id: Optional[str] = None) -> dict:
+    update = {"followers_count": followers_count}
+    if user_id:
+        update["user_id"] = user_id
+    author = timeline_authors_collection.find_one_and_update(
+        {"_id": timeline_key(author_id)},
+        {"$set": update},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    if followers_count >= TIMELINE_CELEBRITY_FOLLOWERS and not author.get("celebrity"):
+        mark_celebrity(author["_id"])
+        author["celebrity"] = True
+    return author
+
+# Primero el autor y después sus relaciones: una relación creada a la vez ve al autor ya marcado
+# o es alcanzada por el update_many
+def mark_celebrity(author_key: str):
+    timeline_authors_collection.update_one({"_id": author_key}, {"$set": {"celebrity": True}})
+    timeline_follows_collection.update_many({"author_id": author_key, "celebrity": False}, {"$set": {"celebrity": True}})
+    logger.info(f"Autor {author_key} marcado como celebridad")
+
+# Se crea sin marcar y se marca después de leer al autor (ver mark_celebrity)
+def add_timeline_follow(user_id: str, author_id: str):
+    try:
+        timeline_follows_collection.update_one(
+            {"user_id": timeline_key(user_id), "author_id": timeline_key(author_id)},
+            {"$setOnInsert": {"celebrity": False}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        pass
+
+def set_follow_celebrity(user_id: str, author_ids: List[str]):
+    timeline_follows_collection.update_many(
+        {"user_id": timeline_key(user_id), "author_id": {"$in": [timeline_key(author_id) for author_id in author_ids]}},
+        {"$set": {"celebrity": True}}
+    )
+
+# Sustituye los seguidos del usuario por la lista completa del friend-service
+def replace_timeline_follows(user_id: str, following: List[str]):
+    key = timeline_key(user_id)
+    author_keys = list(dict.fromkeys(timeline_key(author_id) for author_id in following))
+    insert_missing(timeline_follows_collection, [{"user_id": key, "author_id": author_key, "celebrity": False} for author_key in author_keys])
+    timeline_follows_collection.delete_many({"user_id": key, "author_id": {"$nin": author_keys}})
+    celebrities = [author["_id"] for author in timeline_authors_collection.find({"_id": {"$in": author_keys}, "celebrity": True}, {"_id": 1})]
+    if celebrities:
+        set_follow_celebrity(user_id, celebrities)
+    timeline_follow_sync_collection.update_one({"_id": key}, {"$set": {"synced_at": datetime.utcnow()}}, upsert=True)
+
+# Celebridades seguidas por el usuario (claves de timeline_authors) y su última sincronización
+def followed_celebrities(user_id: str) -> Tuple[Optional[dict], List[str]]:
+    key = timeline_key(user_id)
+    sync = timeline_follow_sync_collection.find_one({"_id": key})
+    follows = timeline_follows_collection.find({"user_id": key, "celebrity": True}, {"author_id": 1})
+    return sync, [follow["author_id"] for follow in follows]
+
+def is_celebrity(author_id: str) -> bool:
+    author = timeline_authors_collection.find_one({"_id": timeline_key(author_id)}, {"celebrity": 1})
+    return bool(author and author.get("celebrity"))
+
+class FanoutJob:
+    def __init__(self, post_id: str, user_id: str, posted_at: datetime):
+        self.post_id = post_id
+        self.user_id = user_id
+        self.posted_at = posted_at
+        self.created_at = time.monotonic()
+
+fanout_queue: Optional[asyncio.Queue] = None
+fanout_stats = {"completed": 0, "failed": 0, "dropped": 0, "notified": 0, "last_lag_s": None, "max_lag_s": 0.0}
+
+def enqueue_fanout(job: FanoutJob):
+    try:
+        fanout_queue.put_nowait(job)
+    except asyncio.QueueFull:
+        FANOUT_DROPPED.inc()
+        fanout_stats["dropped"] += 1
+        logger.error(f"Cola de fan-out llena: el post {job.post_id} no notificará a sus seguidores")
+    FANOUT_QUEUE_DEPTH.set(fanout_queue.qsize())
+
+# Recorre los seguidores por páginas y envía los lotes con concurrencia acotada.
+# El semáforo se toma antes de crear cada envío, así la siguiente página se pide mientras salen los lotes
+async def fan_out_post(job: FanoutJob):
+    message = f"{job.user_id} ha publicado un nuevo post"
+    semaphore = asyncio.Semaphore(FANOUT_CONCURRENCY)
+    sends = []
+
+    async def send(batch: List[str]) -> bool:
         try:
-            response = await client.post(
-                f"{NOTIFICATION_SERVICE_URL}/notifications",
-                json={
-                    "user_id": user_id,
-                    "message": message,
-                    "type": type,
-                    "related_post_id": post_id
-                }
-            )
-            response.raise_for_status()
-            logger.info(f"Notificación enviada a user_id: {user_id}, tipo: {type}")
-        except httpx.HTTPError as e:
-            logger.error(f"Error enviando notificación a user_id: {user_id}: {str(e)}")
-
-# Obtener seguidores de un usuario
-async def get_followers(user_id: str):
-    async with httpx.AsyncClient() as client:
+            return await send_bulk_notification(batch, message, "new_post", job.post_id)
+        finally:
+            semaphore.release()
+
+    after = None
+    total = 0
+    try:
+        push_timelines = not await run_db(is_celebrity, job.user_id)
+        while True:
+            page = await get_followers_page(job.user_id, after)
+            follower_ids = list(dict.fromkeys(page))
+            if push_timelines:
+                post_id = ObjectId(job.post_id)
+                await run_db(insert_timeline_entries, [timeline_entry(follower_id, post_id, job.user_id, job.posted_at) for follower_id in follower_ids])
+            for start in range(0, len(follower_ids), FANOUT_BATCH_SIZE):
+                await semaphore.acquire()
+                sends.append(asyncio.create_task(send(follower_ids[start:start + FANOUT_BATCH_SIZE])))
+            total += len(follower_ids)
+            # Al cruzar el umbral el autor pasa a leerse al vuelo y se deja de copiar el post
+            if push_timelines and total >= TIMELINE_CELEBRITY_FOLLOWERS:
+                await run_db(update_timeline_author, job.user_id, total, job.user_id)
+                push_timelines = False
+            if len(page) < FANOUT_PAGE_SIZE:
+                break
+            after = page[-1]
+    except asyncio.CancelledError:
+        for task in sends:
+            task.cancel()
+        raise
+    finally:
+        # Si falla una página, los lotes ya lanzados se esperan igualmente (si no, nadie lo haría)
+        # y el autor queda registrado con los seguidores recorridos; el error sigue hasta el worker
+        results = await asyncio.gather(*sends, return_exceptions=True)
+        await run_db(update_timeline_author, job.user_id, total, job.user_id)
+
+    lag = time.monotonic() - job.created_at
+    FANOUT_LAG.observe(lag)
+    fanout_stats["notified"] += total
+    fanout_stats["last_lag_s"] = lag
+    fanout_stats["max_lag_s"] = max(fanout_stats["max_lag_s"], lag)
+    if all(result is True for result in results):
+        fanout_stats["completed"] += 1
+    else:
+        fanout_stats["failed"] += 1
+    logger.info(f"Fan-out del post {job.post_id}: {total} seguidores en {lag:.2f}s")
+
+async def fanout_worker():
+    while True:
+        job = await fanout_queue.get()
+        FANOUT_QUEUE_DEPTH.set(fanout_queue.qsize())
+        try:
+            await fan_out_post(job)
+        except Exception as e:
+            fanout_stats["failed"] += 1
+            logger.error(f"Error en el fan-out del post {job.post_id}: {str(e)}")
+        finally:
+            fanout_queue.task_done()
+
+# Cursor opaco del listado: fecha y _id del último post de la página
+def encode_cursor(post: dict) -> str:
+    raw = f"{post['created_at'].isoformat()}|{post['_id']}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[datetime, ObjectId]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+        created_at, post_id = raw.split("|", 1)
+        return datetime.fromisoformat(created_at), ObjectId(post_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+# Resumen de un post para listados: contadores y _id de los últimos comentarios. Los comentarios
+# y los likes del llamante se añaden después con complete_summaries
+def summary_projection() -> dict:
+    return {
+        "content": 1,
+        "user_id": 1,
+        "image_url": 1,
+        "image_variants": 1,
+        "created_at": 1,
+        "like_count": 1,
+        "comment_count": 1,
+        "recent_comment_ids": 1,
+    }
+
+# Posts de la lista a los que el usuario ha dado like: una sola consulta sobre el índice único
+def liked_post_ids(user_id: Optional[str], post_ids: List[ObjectId]) -> set:
+    if not user_id or not post_ids:
+        return set()
+    return {like["post_id"] for like in likes_collection.find({"post_id": {"$in": post_ids}, "user_id": user_id}, {"post_id": 1, "_id": 0})}
+
+# Comentarios de la lista a los que el usuario ha dado like, en una consulta sobre el índice único
+def liked_comment_ids(user_id: Optional[str], comment_ids: List[ObjectId]) -> set:
+    if not user_id or not comment_ids:
+        return set()
+    return {like["comment_id"] for like in comment_likes_collection.find({"comment_id": {"$in": comment_ids}, "user_id": user_id}, {"comment_id": 1, "_id": 0})}
+
+# Inserta el comentario y lo registra en el post (contador y últimos comentarios); si el post no
+# existe se deshace y devuelve None
+def insert_comment(post_id: ObjectId, comment: dict) -> Optional[dict]:
+    comment = {"_id": ObjectId(), "post_id": post_id, **comment, "created_at": datetime.utcnow(), "like_count": 0}
+    comments_collection.insert_one(comment)
+    post = posts_collection.find_one_and_update(
+        {"_id": post_id},
+        {"$inc": {"comment_count": 1}, "$push": {"recent_comment_ids": {"$each": [comment["_id"]], "$slice": -POST_SUMMARY_COMMENTS}}},
+        projection={"_id": 1},
+    )
+    if not post:
+        comments_collection.delete_one({"_id": comment["_id"]})
+        return None
+    return comment
+
+# Página de comentarios del más reciente al más antiguo, con cursor keyset sobre (created_at, _id)
+def find_comments(post_id: ObjectId, limit: int, position: Optional[Tuple[datetime, ObjectId]], viewer_id: Optional[str]) -> Tuple[List[dict], Optional[str]]:
+    query = {"post_id": post_id}
+    if position:
+        query.update(before_cursor(position))
+    comments = list(comments_collection.find(query).sort([("created_at", DESCENDING), ("_id", DESCENDING)]).limit(limit + 1))
+    next_cursor = encode_cursor(comments[limit - 1]) if len(comments) > limit else None
+    comments = comments[:limit]
+    liked = liked_comment_ids(viewer_id, [comment["_id"] for comment in comments])
+    for comment in comments:
+        comment["liked_by_me"] = comment["_id"] in liked
+    return comments, next_cursor
+
+# Like de un comentario: el índice único decide la rama (insertar o borrar) y like_count solo se
+# mueve si el like cambió. Devuelve la acción y el contador, o None si el comentario no existe
+def toggle_comment_like_doc(post_id: ObjectId, comment_id: ObjectId, user_id: str) -> Optional[Tuple[str, int]]:
+    like = {"comment_id": comment_id, "user_id": user_id}
+    try:
+        comment_likes_collection.insert_one({**like, "created_at": datetime.utcnow()})
+        action, delta = "added", 1
+    except DuplicateKeyError:
+        action, delta = "removed", -comment_likes_collection.delete_one(like).deleted_count
+    comment = comments_collection.find_one_and_update(
+        {"_id": comment_id, "post_id": post_id},
+        {"$inc": {"like_count": delta}},
+        projection={"like_count": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    if not comment:
+        comment_likes_collection.delete_one(like)
+        return None
+    return action, comment["like_count"]
+
+# Likes del llamante y últimos comentarios (con su like_count actual) de una página de posts:
+# una consulta por colección para toda la página
+def summary_details(posts: List[dict], viewer_id: Optional[str]) -> Tuple[set, Dict[ObjectId, dict], set]:
+    comment_ids = [comment_id for post in posts for comment_id in post.get("recent_comment_ids", [])]
+    comments = {comment["_id"]: comment for comment in comments_collection.find({"_id": {"$in": comment_ids}})} if comment_ids else {}
+    return liked_post_ids(viewer_id, [post["_id"] for post in posts]), comments, liked_comment_ids(viewer_id, comment_ids)
+
+async def complete_summaries(posts: List[dict], viewer_id: Optional[str]) -> List[dict]:
+    liked_posts, comments, liked_comments = await run_db(summary_details, posts, viewer_id)
+    for post in posts:
+        post["liked_by_me"] = post["_id"] in liked_posts
+        post["comments"] = [comments[comment_id] for comment_id in post.pop("recent_comment_ids", []) if comment_id in comments]
+        for comment in post["comments"]:
+            comment["liked_by_me"] = comment["_id"] in liked_comments
+    return posts
+
+# Condición keyset: elementos estrictamente anteriores a la posición (created_at, id) del cursor
+def before_cursor(position: Tuple[datetime, ObjectId], id_field: str = "_id") -> dict:
+    created_at, post_id = position
+    return {"$or": [
+        {"created_at": {"$lt": created_at}},
+        {"created_at": created_at, id_field: {"$lt": post_id}},
+    ]}
+
+# Trending: puntuación por post con decaimiento exponencial, actualizada con cada evento.
+# Se guarda en log2 respecto a una época fija, así sumar un evento no obliga a decaer el resto
+# y el orden entre posts no cambia con el paso del tiempo
+TRENDING_HALF_LIFE_HOURS = float(os.getenv("TRENDING_HALF_LIFE_HOURS", "6"))
+TRENDING_WEIGHTS = {"post": 1.0, "like": 1.0, "comment": 2.0}
+TRENDING_TOP_K = int(os.getenv("TRENDING_TOP_K", "100"))
+# Posts seguidos en memoria: varias veces K, para los que están a punto de entrar en el top
+TRENDING_CAPACITY = int(os.getenv("TRENDING_CAPACITY", str(TRENDING_TOP_K * 10)))
+# El ranking servido se recalcula como mucho una vez por intervalo
+TRENDING_REFRESH_SECONDS = float(os.getenv("TRENDING_REFRESH_SECONDS", "1"))
+TRENDING_PERSIST_INTERVAL = float(os.getenv("TRENDING_PERSIST_INTERVAL", "30"))
+TRENDING_EPOCH = datetime(2024, 1, 1)
+trending_collection = db["trending"]
+
+def trending_term(weight: float, at: datetime) -> float:
+    return math.log2(weight) + (at - TRENDING_EPOCH).total_seconds() / (TRENDING_HALF_LIFE_HOURS * 3600)
+
+# Top-K acotado (Space-Saving): como mucho `capacity` posts con su puntuación y un montículo
+# de mínimos con entradas perezosas (las que ya no coinciden con la puntuación se descartan)
+class TrendingTracker:
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.scores: Dict[str, float] = {}
+        self.heap: List[Tuple[float, str]] = []
+        self.ranking: List[Tuple[str, float]] = []
+        self.ranked_at = 0.0
+        self.dirty = False
+
+    def record(self, post_id: str, weight: float, at: datetime):
+        score = self.scores.get(post_id)
+        term = trending_term(abs(weight), at)
+        if weight < 0:
+            if score is None:
+                return
+            # Quitar un evento: si no queda puntuación el post deja de seguirse
+            if term >= score:
+                del self.scores[post_id]
+                self.dirty = True
+                return
+            score += math.log2(1 - 2 ** (term - score))
+        elif score is None:
+            # Sin sitio, el post nuevo sustituye al de menor puntuación y la hereda (cota superior)
+            score = self.evict_min() if len(self.scores) >= self.capacity else None
+            score = term if score is None else max(score, term) + math.log2(1 + 2 ** -abs(score - term))
+        else:
+            score = max(score, term) + math.log2(1 + 2 ** -abs(score - term))
+        self.scores[post_id] = score
+        heapq.heappush(self.heap, (score, post_id))
+        if len(self.heap) > self.capacity * 4:
+            self.heap = [(score, post_id) for post_id, score in self.scores.items()]
+            heapq.heapify(self.heap)
+        self.dirty = True
+        TRENDING_TRACKED.set(len(self.scores))
+
+    def evict_min(self) -> Optional[float]:
+        while self.heap:
+            score, post_id = heapq.heappop(self.heap)
+            if self.scores.get(post_id) == score:
+                del self.scores[post_id]
+                TRENDING_EVICTIONS.inc()
+                return score
+        return None
+
+    def top(self, k: int) -> List[Tuple[str, float]]:
+        if self.dirty and time.monotonic() - self.ranked_at >= TRENDING_REFRESH_SECONDS:
+            self.ranking = heapq.nlargest(TRENDING_TOP_K, self.scores.items(), key=lambda item: item[1])
+            self.ranked_at = time.monotonic()
+            self.dirty = False
+        return self.ranking[:k]
+
+trending = TrendingTracker(TRENDING_CAPACITY)
+trending_stats = {"persisted_at": None, "changed": False}
+
+# La instantánea se toma en el bucle (el tracker solo se modifica ahí) y se escribe en el pool
+async def persist_trending():
+    if not trending_stats["changed"]:
+        return
+    trending_stats["changed"] = False
+    entries = [{"post_id": post_id, "score": score} for post_id, score in trending.scores.items()]
+    await run_db(trending_collection.replace_one, {"_id": "posts"}, {"entries": entries, "updated_at": datetime.utcnow()}, upsert=True)
+    trending_stats["persisted_at"] = datetime.utcnow()
+    logger.info(f"Trending guardado: {len(entries)} posts")
+
+async def trending_persister():
+    while True:
+        await asyncio.sleep(TRENDING_PERSIST_INTERVAL)
         try:
-            response = await client.get(f"{FRIEND_SERVICE_URL}/friends/followers/{user_id}")
-            response.raise_for_status()
-            return response.json()
-        except httpx.HTTPError as e:
-            logger.error(f"Error obteniendo seguidores para user_id: {user_id}: {str(e)}")
-            return []
+            await persist_trending()
+        except Exception as e:
+            trending_stats["changed"] = True
+            logger.error(f"Error al guardar el trending: {str(e)}")
+
+def record_trending(post_id: str, event: str, at: Optional[datetime] = None, sign: int = 1):
+    trending.record(post_id, sign * TRENDING_WEIGHTS[event], at or datetime.utcnow())
+    trending_stats["changed"] = True
+
+# Al arrancar se recupera la última instantánea; sin ella se parte de los posts más recientes
+# (índice por fecha), contando sus likes y comentarios en la fecha de publicación
+def load_trending():
+    snapshot = trending_collection.find_one({"_id": "posts"})
+    if snapshot:
+        for entry in snapshot["entries"][-TRENDING_CAPACITY:]:
+            trending.scores[entry["post_id"]] = entry["score"]
+        trending.heap = [(score, post_id) for post_id, score in trending.scores.items()]
+        heapq.heapify(trending.heap)
+        trending.dirty = True
+        logger.info(f"Trending recuperado: {len(trending.scores)} posts")
+    else:
+        recent = posts_collection.find({}, {"created_at": 1, "like_count": 1, "comment_count": 1}).sort([("created_at", DESCENDING), ("_id", DESCENDING)]).limit(TRENDING_CAPACITY)
+        for post in recent:
+            weight = TRENDING_WEIGHTS["post"] + TRENDING_WEIGHTS["like"] * post.get("like_count", 0) + TRENDING_WEIGHTS["comment"] * post.get("comment_count", 0)
+            trending.record(str(post["_id"]), weight, post["created_at"])
+        trending_stats["changed"] = bool(trending.scores)
+        logger.info(f"Trending inicializado con {len(trending.scores)} posts recientes")
+    TRENDING_TRACKED.set(len(trending.scores))
+
 
 # Rutas
 @app.post("/posts")
@@ -99,146 +802,437 @@ async def create_post(content: str = Form(...), user_id: str = Form(...), image:
     post_dict = {
         "content": content,
         "user_id": user_id,
-        "likes": [],
-        "comments": [],
+        "like_count": 0,
+        "comment_count": 0,
+        "search_terms": search_tokens(content),
         "created_at": datetime.utcnow()
     }
     
-    if image:
-        image_filename = f"{uuid.uuid4()}_{image.filename}"
-        image_path = os.path.join("/app/uploads", image_filename)
-        with open(image_path, "wb") as f:
-            f.write(await image.read())
-        post_dict["image_url"] = f"/uploads/{image_filename}"
+    if image and image.filename:
+        post_dict["image_url"] = await upload_store.store(image, "post")
+        post_dict["image_variants"] = await upload_store.create_variants(post_dict["image_url"])
     
-    result = posts_collection.insert_one(post_dict)
+    try:
+        result = await run_db(posts_collection.insert_one, post_dict)
+    except Exception:
+        # Sin post la imagen no tiene quien la referencie
+        await upload_store.release(post_dict.get("image_url"))
+        raise
     post_id = str(result.inserted_id)
     logger.info(f"Post creado con ID: {post_id} para user_id: {user_id}")
 
-    # Notificar a los seguidores
-    followers = await get_followers(user_id)
-    for follower in followers:
-        await send_notification(
-            follower["user_id"],
-            f"{user_id} ha publicado un nuevo post",
-            "new_post",
-            post_id
-        )
+    record_trending(post_id, "post", post_dict["created_at"])
+    # Notificar a los seguidores en segundo plano, sin retrasar la respuesta
+    enqueue_fanout(FanoutJob(post_id, user_id, post_dict["created_at"]))
 
     return {"message": "Post created successfully", "post_id": post_id}
 
+# Búsqueda por palabras completas (todas deben aparecer) entre los posts más recientes,
+# ordenada por relevancia y paginada; devuelve resúmenes como el listado
+@app.get("/posts/search")
+async def search_posts(q: str, limit: int = SEARCH_PAGE_SIZE, offset: int = 0, x_user_id: Optional[str] = Header(None)):
+    limit = max(1, min(limit, SEARCH_MAX_PAGE_SIZE))
+    offset = max(0, offset)
+    tokens = search_tokens(q)
+    if not tokens:
+        return FastJSONResponse({"results": [], "next_offset": None})
+    candidates = await run_db(lambda: list(posts_collection.aggregate([
+        {"$match": {"search_terms": {"$all": tokens}}},
+        {"$sort": {"created_at": -1, "_id": -1}},
+        {"$limit": SEARCH_MAX_CANDIDATES},
+        {"$project": summary_projection()},
+    ])))
+    now = datetime.utcnow()
+    ranked = sorted(candidates, key=lambda post: rank_post(post, tokens, now), reverse=True)
+    page = await complete_summaries(ranked[offset:offset + limit], x_user_id)
+    logger.info(f"Búsqueda de posts '{q}': {len(ranked)} resultados")
+    return FastJSONResponse({
+        "results": page,
+        "next_offset": offset + limit if offset + limit < len(ranked) else None,
+    })
+
+# Posts en tendencia desde el top-K en memoria: sin recorrer la colección, solo se leen
+# por _id los resúmenes de los K posts del ranking
+@app.get("/posts/trending")
+async def get_trending_posts(limit: int = POSTS_PAGE_SIZE, x_user_id: Optional[str] = Header(None)):
+    ranking = trending.top(max(1, min(limit, TRENDING_TOP_K)))
+    summaries = await run_db(lambda: {str(post["_id"]): post for post in posts_collection.aggregate([
+        {"$match": {"_id": {"$in": [ObjectId(post_id) for post_id, _ in ranking]}}},
+        {"$project": summary_projection()},
+    ])})
+    # Puntuación actual equivalente a eventos de peso 1 ocurridos ahora
+    now = trending_term(1, datetime.utcnow())
+    posts = []
+    for post_id, score in ranking:
+        if post_id in summaries:
+            post = summaries[post_id]
+            post["trending_score"] = round(2 ** (score - now), 3)
+            posts.append(post)
+    return FastJSONResponse({"posts": await complete_summaries(posts, x_user_id)})
+
+# Post con sus últimos comentarios; el resto se pagina con GET /posts/{post_id}/comments.
+# liked_by_me es el del llamante (X-User-Id); el gateway cachea la respuesta por usuario
 @app.get("/posts/{post_id}")
-async def get_post(post_id: str):
+async def get_post(post_id: str, x_user_id: Optional[str] = Header(None)):
     try:
-        post = posts_collection.find_one({"_id": ObjectId(post_id)})
+        post = await run_db(posts_collection.find_one, {"_id": ObjectId(post_id)}, {"search_terms": 0})
         if not post:
             raise HTTPException(status_code=404, detail="Post not found")
-        post["_id"] = str(post["_id"])
         logger.info(f"Post obtenido con ID: {post_id}")
-        return post
+        return FastJSONResponse((await complete_summaries([post], x_user_id))[0])
+    except HTTPException as e:
+        raise e
     except Exception as e:
         logger.error(f"Error al obtener post con ID: {post_id}: {str(e)}")
         raise HTTPException(status_code=400, detail=f"Invalid post_id format: {str(e)}")
 
+# Datos que cuelgan de un post ya borrado. Las entradas de timeline y el trending no se tocan: se
+# leen cruzándolos con los posts y los que ya no existen se omiten
+def delete_post_data(post_id: ObjectId):
+    comment_ids = [comment["_id"] for comment in comments_collection.find({"post_id": post_id}, {"_id": 1})]
+    if comment_ids:
+        comment_likes_collection.delete_many({"comment_id": {"$in": comment_ids}})
+    comments_collection.delete_many({"post_id": post_id})
+    likes_collection.delete_many({"post_id": post_id})
+
+# Solo el autor borra su post; con él se van sus likes y comentarios y su imagen pierde la referencia
+@app.delete("/posts/{post_id}")
+async def delete_post(post_id: str, authorization: str = Header(...), x_user_id: Optional[str] = Header(None)):
+    if not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="Invalid token format")
+
+    try:
+        post = await run_db(posts_collection.find_one, {"_id": ObjectId(post_id)}, {"user_id": 1, "image_url": 1})
+        if not post:
+            raise HTTPException(status_code=404, detail="Post not found")
+        if x_user_id != post["user_id"]:
+            raise HTTPException(status_code=403, detail="No autorizado para borrar el post de otro usuario")
+        # Con dos borrados a la vez solo uno suelta la imagen
+        result = await run_db(posts_collection.delete_one, {"_id": post["_id"]})
+        if not result.deleted_count:
+            raise HTTPException(status_code=404, detail="Post not found")
+        await run_db(delete_post_data, post["_id"])
+        await upload_store.release(post.get("image_url"))
+        logger.info(f"Post {post_id} borrado por user_id: {x_user_id}")
+        return {"message": "Post deleted successfully", "post_id": post_id}
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        logger.error(f"Error al borrar post con ID: {post_id}: {str(e)}")
+        raise HTTPException(status_code=400, detail=f"Invalid post_id format: {str(e)}")
+
+# Listado paginado por cursor (keyset) sobre (created_at, _id), del más reciente al más antiguo.
+# Devuelve resúmenes; el post completo se pide aparte con GET /posts/{post_id}
 @app.get("/posts")
-async def get_all_posts():
-    posts = list(posts_collection.find())
-    for post in posts:
-        post["_id"] = str(post["_id"])
-    logger.info(f"Obtenidos {len(posts)} posts")
-    return posts
+async def get_all_posts(limit: int = POSTS_PAGE_SIZE, cursor: Optional[str] = None, user_id: Optional[str] = None, x_user_id: Optional[str] = Header(None)):
+    limit = max(1, min(limit, POSTS_MAX_PAGE_SIZE))
+    query = {}
+    if user_id:
+        query["user_id"] = user_id
+    if cursor:
+        query.update(before_cursor(decode_cursor(cursor)))
+    # Se pide un post de más para saber si hay página siguiente
+    posts = await run_db(lambda: list(posts_collection.aggregate([
+        {"$match": query},
+        {"$sort": {"created_at": -1, "_id": -1}},
+        {"$limit": limit + 1},
+        {"$project": summary_projection()},
+    ])))
+    next_cursor = encode_cursor(posts[limit - 1]) if len(posts) > limit else None
+    posts = await complete_summaries(posts[:limit], x_user_id)
+    logger.info(f"Obtenidos {len(posts)} posts (user_id={user_id}, cursor={cursor})")
+    return FastJSONResponse({"posts": posts, "next_cursor": next_cursor})
+
+# Lista completa de seguidos en el friend-service; None si no se pudo obtener
+async def get_following_ids(user_id: str, authorization: Optional[str]) -> Optional[List[str]]:
+    try:
+        response = await http_client.get(
+            f"{FRIEND_SERVICE_URL}/friends/following/{user_id}",
+            headers={"Authorization": authorization} if authorization else {}
+        )
+        response.raise_for_status()
+        return [friend["followed_id"] for friend in response.json()]
+    except httpx.HTTPError as e:
+        logger.warning(f"Error obteniendo los seguidos de {user_id}: {str(e)}")
+        return None
+
+following_syncs: set = set()
+# Referencias a las sincronizaciones en segundo plano para que no se recojan antes de acabar
+resync_tasks: set = set()
+
+# Copia los seguidos del friend-service en timeline_follows; una sola copia en curso por usuario
+async def sync_following(user_id: str, authorization: Optional[str]) -> bool:
+    key = timeline_key(user_id)
+    if key in following_syncs:
+        return False
+    following_syncs.add(key)
+    try:
+        following = await get_following_ids(user_id, authorization)
+        if following is None:
+            return False
+        await run_db(replace_timeline_follows, user_id, following)
+        logger.info(f"Seguidos de {user_id} sincronizados: {len(following)}")
+        return True
+    finally:
+        following_syncs.discard(key)
+
+# Timeline de inicio: entradas materializadas del usuario mezcladas con los posts propios y de
+# las celebridades que sigue. Cada fuente lee como mucho una página del índice, con el mismo cursor
+@app.get("/timeline/{user_id}")
+async def get_timeline(user_id: str, limit: int = POSTS_PAGE_SIZE, cursor: Optional[str] = None, authorization: str = Header(None), x_user_id: Optional[str] = Header(None)):
+    if x_user_id and timeline_key(x_user_id) != timeline_key(user_id):
+        raise HTTPException(status_code=403, detail="No autorizado para leer el timeline de otro usuario")
+    limit = max(1, min(limit, POSTS_MAX_PAGE_SIZE))
+    position = decode_cursor(cursor) if cursor else None
+
+    # Solo las celebridades seguidas, desde la copia local: la lectura no depende del número de seguidos
+    pulled_authors = {user_id}
+    sync, celebrity_keys = await run_db(followed_celebrities, user_id)
+    if sync is None:
+        if await sync_following(user_id, authorization):
+            _, celebrity_keys = await run_db(followed_celebrities, user_id)
+        else:
+            logger.warning(f"Timeline de {user_id} sin celebridades: seguidos sin sincronizar")
+    elif sync["synced_at"] < datetime.utcnow() - timedelta(hours=TIMELINE_FOLLOWING_RESYNC_HOURS):
+        task = asyncio.create_task(sync_following(user_id, authorization))
+        resync_tasks.add(task)
+        task.add_done_callback(resync_tasks.discard)
+    if celebrity_keys:
+        celebrities = await run_db(lambda: list(timeline_authors_collection.find({"_id": {"$in": celebrity_keys}}, {"user_id": 1})))
+        for author in celebrities:
+            pulled_authors.add(author.get("user_id", author["_id"]))
+
+    entry_query = {"user_id": timeline_key(user_id)}
+    post_query = {"user_id": {"$in": list(pulled_authors)}}
+    if position:
+        entry_query.update(before_cursor(position, "post_id"))
+        post_query.update(before_cursor(position))
+    # Las dos fuentes se leen en paralelo en el pool
+    entries, pulled = await asyncio.gather(
+        run_db(lambda: list(timelines_collection.find(entry_query, {"post_id": 1, "created_at": 1}).sort([("created_at", DESCENDING), ("post_id", DESCENDING)]).limit(limit + 1))),
+        run_db(lambda: list(posts_collection.find(post_query, {"created_at": 1}).sort([("created_at", DESCENDING), ("_id", DESCENDING)]).limit(limit + 1))),
+    )
+
+    candidates = {entry["post_id"]: entry["created_at"] for entry in entries}
+    for post in pulled:
+        candidates.setdefault(post["_id"], post["created_at"])
+    merged = sorted(((created_at, post_id) for post_id, created_at in candidates.items()), reverse=True)
+    page = merged[:limit]
+    next_cursor = encode_cursor({"created_at": page[-1][0], "_id": page[-1][1]}) if len(merged) > limit else None
+
+    # Resúmenes de la página en el orden del timeline; los posts borrados se omiten
+    ids = [post_id for _, post_id in page]
+    summaries = await run_db(lambda: {post["_id"]: post for post in posts_collection.aggregate([
+        {"$match": {"_id": {"$in": ids}}},
+        {"$project": summary_projection()},
+    ])})
+    posts = await complete_summaries([summaries[post_id] for post_id in ids if post_id in summaries], x_user_id or user_id)
+    logger.info(f"Timeline de {user_id}: {len(posts)} posts ({len(pulled_authors)} autores leídos al vuelo, cursor={cursor})")
+    return FastJSONResponse({"posts": posts, "next_cursor": next_cursor})
+
+class TimelineFollow(BaseModel):
+    followers_count: Optional[int] = None
+
+# Eventos del friend-service: al seguir se registra la relación y se copian los últimos posts del
+# autor al timeline del seguidor (salvo celebridades, que ya se leen al vuelo); al dejar de seguir
+# se eliminan
+@app.post("/timeline/{user_id}/follow/{author_id}")
+async def timeline_follow(user_id: str, author_id: str, event: TimelineFollow, x_internal_token: Optional[str] = Header(None)):
+    check_internal_token(x_internal_token)
+    await run_db(add_timeline_follow, user_id, author_id)
+    if event.followers_count is not None:
+        author = await run_db(update_timeline_author, author_id, event.followers_count)
+    else:
+        author = await run_db(timeline_authors_collection.find_one, {"_id": timeline_key(author_id)})
+    if author and author.get("celebrity"):
+        await run_db(set_follow_celebrity, user_id, [author_id])
+        return {"message": "Autor leído al vuelo", "backfilled": 0}
+    author_ids = list({author_id, author.get("user_id", author_id)} if author else {author_id})
+    recent = await run_db(lambda: list(posts_collection.find({"user_id": {"$in": author_ids}}, {"created_at": 1, "user_id": 1}).sort([("created_at", DESCENDING), ("_id", DESCENDING)]).limit(TIMELINE_BACKFILL_POSTS)))
+    entries = [timeline_entry(user_id, post["_id"], post["user_id"], post["created_at"]) for post in recent]
+    await run_db(insert_timeline_entries, entries)
+    logger.info(f"Timeline de {user_id}: {len(entries)} posts de {author_id} añadidos")
+    return {"message": "Timeline actualizado", "backfilled": len(entries)}
+
+@app.delete("/timeline/{user_id}/follow/{author_id}")
+async def timeline_unfollow(user_id: str, author_id: str, followers_count: Optional[int] = None, x_internal_token: Optional[str] = Header(None)):
+    check_internal_token(x_internal_token)
+    await run_db(timeline_follows_collection.delete_one, {"user_id": timeline_key(user_id), "author_id": timeline_key(author_id)})
+    if followers_count is not None:
+        await run_db(update_timeline_author, author_id, followers_count)
+    result = await run_db(timelines_collection.delete_many, {"user_id": timeline_key(user_id), "author_id": timeline_key(author_id)})
+    logger.info(f"Timeline de {user_id}: {result.deleted_count} posts de {author_id} eliminados")
+    return {"message": "Timeline actualizado", "removed": result.deleted_count}
+
+# El user_id del cuerpo es quien actúa: si llega la identidad verificada por el gateway (X-User-Id),
+# tienen que coincidir, para que nadie comente o dé like en nombre de otro
+def check_acting_user(user_id: str, x_user_id: Optional[str]):
+    if x_user_id and x_user_id != user_id:
+        raise HTTPException(status_code=403, detail="No autorizado para actuar en nombre de otro usuario")
 
 @app.post("/posts/{post_id}/comments")
-async def add_comment(post_id: str, comment: Comment, authorization: str = Header(...)):
+async def add_comment(post_id: str, comment: Comment, authorization: str = Header(...), x_user_id: Optional[str] = Header(None)):
     if not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Invalid token format")
+    check_acting_user(comment.user_id, x_user_id)
 
     try:
-        comment_dict = comment.dict()
-        comment_dict["created_at"] = datetime.utcnow()
-        result = posts_collection.update_one(
-            {"_id": ObjectId(post_id)},
-            {"$push": {"comments": comment_dict}}
-        )
-        if result.matched_count == 0:
+        comment_dict = await run_db(insert_comment, ObjectId(post_id), comment.dict())
+        if not comment_dict:
             raise HTTPException(status_code=404, detail="Post not found")
-        logger.info(f"Comentario añadido al post_id: {post_id} por user_id: {comment.user_id}")
-        return comment_dict
+        logger.info(f"Comentario {comment_dict['_id']} añadido al post_id: {post_id} por user_id: {comment.user_id}")
+        record_trending(post_id, "comment", comment_dict["created_at"])
+        comment_dict["liked_by_me"] = False
+        return FastJSONResponse(comment_dict)
+    except HTTPException as e:
+        raise e
     except Exception as e:
         logger.error(f"Error al añadir comentario al post_id: {post_id}: {str(e)}")
         raise HTTPException(status_code=400, detail=f"Invalid post_id format: {str(e)}")
 
+# Comentarios de un post paginados por cursor, del más reciente al más antiguo
+@app.get("/posts/{post_id}/comments")
+async def get_comments(post_id: str, limit: int = COMMENTS_PAGE_SIZE, cursor: Optional[str] = None, authorization: str = Header(...), x_user_id: Optional[str] = Header(None)):
+    if not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="Invalid token format")
+    if not ObjectId.is_valid(post_id):
+        raise HTTPException(status_code=400, detail="Invalid post_id format")
+    limit = max(1, min(limit, COMMENTS_MAX_PAGE_SIZE))
+    position = decode_cursor(cursor) if cursor else None
+
+    comments, next_cursor = await run_db(find_comments, ObjectId(post_id), limit, position, x_user_id)
+    logger.info(f"Obtenidos {len(comments)} comentarios del post_id: {post_id} (cursor={cursor})")
+    return FastJSONResponse({"post_id": post_id, "comments": comments, "next_cursor": next_cursor})
+
 @app.post("/posts/{post_id}/likes")
-async def toggle_like(post_id: str, user_id: str = Form(...), authorization: str = Header(...)):
+async def toggle_like(post_id: str, user_id: str = Form(...), authorization: str = Header(...), x_user_id: Optional[str] = Header(None)):
     if not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Invalid token format")
+    check_acting_user(user_id, x_user_id)
 
     try:
-        post = posts_collection.find_one({"_id": ObjectId(post_id)})
+        # El índice único decide la rama en una sola operación: se inserta el like o, si ya existía,
+        # se borra. like_count solo se mueve cuando una de las dos cambia algo, así toggles
+        # concurrentes del mismo usuario no lo descuadran
+        like = {"post_id": ObjectId(post_id), "user_id": user_id}
+        liked_at = datetime.utcnow()
+        try:
+            await run_db(likes_collection.insert_one, {**like, "created_at": liked_at})
+            action, delta = "added", 1
+        except DuplicateKeyError:
+            removed = await run_db(likes_collection.find_one_and_delete, like, projection={"created_at": 1})
+            action, delta = "removed", -1 if removed else 0
+            liked_at = removed.get("created_at") if removed else None
+        post = await run_db(
+            posts_collection.find_one_and_update,
+            {"_id": like["post_id"]},
+            {"$inc": {"like_count": delta}},
+            projection={"user_id": 1, "like_count": 1, "created_at": 1},
+            return_document=ReturnDocument.AFTER
+        )
         if not post:
+            await run_db(likes_collection.delete_one, like)
             raise HTTPException(status_code=404, detail="Post not found")
-        
-        likes = post.get("likes", [])
-        if user_id in likes:
-            posts_collection.update_one(
-                {"_id": ObjectId(post_id)},
-                {"$pull": {"likes": user_id}}
+        # Al quitar un like se resta el término con su fecha original, no con la actual. Los likes
+        # migrados no tienen fecha: cuentan en la del post, como al reconstruir el trending
+        if delta:
+            record_trending(post_id, "like", at=liked_at or post.get("created_at"), sign=delta)
+        # Notificar al dueño del post
+        if action == "added" and post["user_id"] != user_id:  # No notificar si el usuario se da like a sí mismo
+            await send_notification(
+                post["user_id"],
+                f"{user_id} ha dado like a tu post",
+                "like",
+                post_id
             )
-            action = "removed"
-        else:
-            posts_collection.update_one(
-                {"_id": ObjectId(post_id)},
-                {"$push": {"likes": user_id}}
-            )
-            action = "added"
-            # Notificar al dueño del post
-            if post["user_id"] != user_id:  # No notificar si el usuario se da like a sí mismo
-                await send_notification(
-                    post["user_id"],
-                    f"{user_id} ha dado like a tu post",
-                    "like",
-                    post_id
-                )
         logger.info(f"Like {action} para post_id: {post_id} por user_id: {user_id}")
-        return {"message": "Like toggled successfully", "action": action}
+        return {"message": "Like toggled successfully", "action": action, "like_count": post["like_count"]}
+    except HTTPException as e:
+        raise e
     except Exception as e:
         logger.error(f"Error al gestionar like para post_id: {post_id}: {str(e)}")
         raise HTTPException(status_code=400, detail=f"Invalid post_id format: {str(e)}")
 
-@app.post("/posts/{post_id}/comments/{comment_index}/likes")
-async def toggle_comment_like(post_id: str, comment_index: int, user_id: str = Form(...), authorization: str = Header(...)):
+# Usuarios que han dado like a un post, los más recientes primero
+@app.get("/posts/{post_id}/likes")
+async def get_likes(post_id: str, limit: int = LIKES_PAGE_SIZE, authorization: str = Header(...)):
     if not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Invalid token format")
+    limit = max(1, min(limit, LIKES_MAX_PAGE_SIZE))
 
     try:
-        post = posts_collection.find_one({"_id": ObjectId(post_id)})
+        post = await run_db(posts_collection.find_one, {"_id": ObjectId(post_id)}, {"like_count": 1})
         if not post:
             raise HTTPException(status_code=404, detail="Post not found")
+        likes = await run_db(lambda: [
+            like["user_id"]
+            for like in likes_collection.find({"post_id": post["_id"]}, {"user_id": 1, "_id": 0}).sort("_id", -1).limit(limit)
+        ])
+        return {"post_id": post_id, "likes": likes, "like_count": post.get("like_count", len(likes))}
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        logger.error(f"Error al obtener likes del post_id: {post_id}: {str(e)}")
+        raise HTTPException(status_code=400, detail=f"Invalid post_id format: {str(e)}")
 
-        comments = post.get("comments", [])
-        if comment_index < 0 or comment_index >= len(comments):
-            raise HTTPException(status_code=404, detail="Comment not found")
+# Qué posts de la lista le gustan al usuario, en una sola consulta indexada
+@app.get("/likes/check-batch")
+async def check_likes_batch(user_id: str, post_ids: str = Query(..., description="IDs de posts separados por comas"), authorization: str = Header(...)):
+    if not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="Invalid token format")
 
-        comment = comments[comment_index]
-        likes = comment.get("likes", [])
+    ids = list(dict.fromkeys(post_id.strip() for post_id in post_ids.split(",") if post_id.strip()))
+    if len(ids) > LIKES_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"Too many post_ids (max {LIKES_BATCH_MAX})")
+    invalid = [post_id for post_id in ids if not ObjectId.is_valid(post_id)]
+    if invalid:
+        raise HTTPException(status_code=400, detail=f"Invalid post_id format: {', '.join(invalid)}")
 
-        if user_id in likes:
-            likes.remove(user_id)
-            action = "removed"
-        else:
-            likes.append(user_id)
-            action = "added"
+    liked = await run_db(liked_post_ids, user_id, [ObjectId(post_id) for post_id in ids])
+    logger.info(f"Check de likes en lote para user_id: {user_id}: {len(liked)}/{len(ids)} con like")
+    return {"user_id": user_id, "likes": {post_id: ObjectId(post_id) in liked for post_id in ids}}
 
-        # Actualizar el comentario en la base de datos
-        posts_collection.update_one(
-            {"_id": ObjectId(post_id)},
-            {"$set": {f"comments.{comment_index}.likes": likes}}
-        )
-        logger.info(f"Like {action} para comentario {comment_index} en post_id: {post_id} por user_id: {user_id}")
-        return {"message": "Comment like toggled successfully", "action": action}
+@app.post("/posts/{post_id}/comments/{comment_id}/likes")
+async def toggle_comment_like(post_id: str, comment_id: str, user_id: str = Form(...), authorization: str = Header(...), x_user_id: Optional[str] = Header(None)):
+    if not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="Invalid token format")
+    check_acting_user(user_id, x_user_id)
+
+    try:
+        result = await run_db(toggle_comment_like_doc, ObjectId(post_id), ObjectId(comment_id), user_id)
+        if not result:
+            raise HTTPException(status_code=404, detail="Comment not found")
+        action, like_count = result
+        logger.info(f"Like {action} para comentario {comment_id} en post_id: {post_id} por user_id: {user_id}")
+        return {"message": "Comment like toggled successfully", "action": action, "like_count": like_count}
+    except HTTPException as e:
+        raise e
     except Exception as e:
-        logger.error(f"Error al gestionar like en comentario {comment_index} para post_id: {post_id}: {str(e)}")
-        raise HTTPException(status_code=400, detail=f"Invalid post_id or comment_index: {str(e)}")
+        logger.error(f"Error al gestionar like en comentario {comment_id} para post_id: {post_id}: {str(e)}")
+        raise HTTPException(status_code=400, detail=f"Invalid post_id or comment_id: {str(e)}")
+
+# Estado del fan-out de notificaciones
+@app.get("/internal/fanout")
+async def get_fanout_stats():
+    return {**fanout_stats, "queued": fanout_queue.qsize(), "workers": FANOUT_WORKERS}
+
+# Estado del trending en memoria
+@app.get("/internal/trending")
+async def get_trending_stats():
+    return {**trending_stats, "tracked": len(trending.scores), "capacity": TRENDING_CAPACITY, "top_k": TRENDING_TOP_K}
+
+# Imágenes de los posts, con el almacenamiento por contenido común a los servicios
+upload_store = UploadStore(UPLOADS_DIR, db["uploads"], run_db, IMAGE_PROCESSING)
+
+# Imágenes con ETag, respuestas 304 y peticiones Range, servidas por el almacenamiento común
+@app.get("/uploads/{filename}")
+async def serve_uploaded_file(filename: str, request: Request, size: Optional[str] = None):
+    return await upload_store.serve(filename, request, size)
+
+# Métricas en formato Prometheus
+@app.get("/metrics")
+async def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 if __name__ == "__main__":
     import uvicorn
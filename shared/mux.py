@@ -0,0 +1,118 @@
+# Conexión multiplexada del API Gateway (/ws/mux), común al chat-service y al notification-service:
+# un solo socket transporta muchas sesiones de clientes, cada una como un MuxWebSocket con la misma
+# interfaz que WebSocket para reutilizar la lógica de sesión de cada servicio
+import asyncio
+import json
+import logging
+import os
+from typing import Dict, Optional, Set
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+logger = logging.getLogger(__name__)
+
+# Tamaño de la cola de entrada de cada sesión multiplexada
+MUX_INBOX_SIZE = int(os.getenv("MUX_INBOX_SIZE", "64"))
+
+# Sesión virtual que llega por la conexión multiplexada
+class MuxWebSocket:
+    def __init__(self, conn_id: int, send_frame, verified_user_id: Optional[str] = None):
+        self.conn_id = conn_id
+        # user_id cuyo token ya verificó el API Gateway
+        self.verified_user_id = verified_user_id
+        self._send_frame = send_frame
+        self._inbox: asyncio.Queue = asyncio.Queue(maxsize=MUX_INBOX_SIZE)
+        self.closed = False
+
+    async def accept(self):
+        pass
+
+    def feed(self, data: str) -> bool:
+        try:
+            self._inbox.put_nowait(data)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    def feed_disconnect(self):
+        while self._inbox.full():
+            self._inbox.get_nowait()
+        self._inbox.put_nowait(None)
+
+    async def receive_text(self) -> str:
+        data = await self._inbox.get()
+        if data is None:
+            self.closed = True
+            raise WebSocketDisconnect(code=1000)
+        return data
+
+    async def send_text(self, data: str):
+        if self.closed:
+            raise RuntimeError("Sesión multiplexada cerrada")
+        await self._send_frame({"op": "data", "conn": self.conn_id, "data": data})
+
+    async def send_json(self, data: dict):
+        await self.send_text(json.dumps(data, default=str))
+
+    async def close(self, code: int = 1000, reason: str = ""):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            await self._send_frame({"op": "close", "conn": self.conn_id, "code": code, "reason": reason})
+        except Exception as e:
+            logger.warning(f"No se pudo enviar el cierre de la sesión {self.conn_id}: {str(e)}")
+
+# Atiende una conexión multiplexada hasta que se cierra. handle_session(session, user_id) es la
+# lógica de sesión del servicio y connections, su gauge de conexiones por transporte. Cada sesión
+# corre en su propia tarea, guardada hasta que termina para que no la recoja el recolector; al
+# cerrarse el socket se cancelan las que sigan abiertas
+async def serve_mux(websocket: WebSocket, handle_session, connections):
+    await websocket.accept()
+    send_lock = asyncio.Lock()
+    sessions: Dict[int, MuxWebSocket] = {}
+    tasks: Set[asyncio.Task] = set()
+
+    async def send_frame(frame: dict):
+        async with send_lock:
+            await websocket.send_text(json.dumps(frame, default=str))
+
+    async def run_session(session: MuxWebSocket, user_id: str):
+        connections.labels("mux_session").inc()
+        try:
+            await handle_session(session, user_id)
+        finally:
+            connections.labels("mux_session").dec()
+            sessions.pop(session.conn_id, None)
+            await session.close()
+
+    logger.info("Conexión multiplexada del API Gateway establecida")
+    connections.labels("mux_link").inc()
+    try:
+        while True:
+            frame = json.loads(await websocket.receive_text())
+            conn_id = frame.get("conn")
+            op = frame.get("op")
+            if op == "open":
+                session = MuxWebSocket(conn_id, send_frame, frame.get("verified_user_id"))
+                sessions[conn_id] = session
+                task = asyncio.create_task(run_session(session, frame.get("user_id", "")))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            elif op == "data" and conn_id in sessions:
+                if not sessions[conn_id].feed(frame.get("data", "")):
+                    logger.warning(f"Cola de entrada llena para la sesión {conn_id}; cerrando")
+                    sessions[conn_id].feed_disconnect()
+                    await sessions[conn_id].close(1013, "Cola de entrada llena")
+            elif op == "close" and conn_id in sessions:
+                sessions[conn_id].feed_disconnect()
+    except WebSocketDisconnect:
+        logger.info(f"Conexión multiplexada cerrada con {len(sessions)} sesiones activas")
+    finally:
+        connections.labels("mux_link").dec()
+        for session in list(sessions.values()):
+            session.closed = True
+        pending = list(tasks)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
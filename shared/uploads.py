@@ -0,0 +1,338 @@
+# Imágenes subidas, común al post-service y al user-service: almacenamiento por contenido con
+# recuento de referencias, variantes WebP, limpieza de ficheros sin referencias y servicio con
+# ETag, 304 y Range. Cada servicio crea su UploadStore con su directorio y su colección de MongoDB
+import asyncio
+import hashlib
+import logging
+import mimetypes
+import multiprocessing
+import os
+import re
+import signal
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Dict, Optional, Tuple
+
+from fastapi import HTTPException, Request, Response, UploadFile
+from fastapi.responses import FileResponse, StreamingResponse
+from pymongo import ASCENDING, ReturnDocument
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow es opcional: sin él no se generan variantes y se sirve el original
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Las imágenes llevan un UUID o el hash de su contenido en el nombre y nunca cambian: se pueden cachear sin caducidad
+UPLOAD_CACHE_CONTROL = "public, max-age=31536000, immutable"
+UPLOAD_CHUNK_SIZE = 64 * 1024
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(10 * 1024 * 1024)))
+
+# Variantes redimensionadas de cada imagen (lado mayor en píxeles), recodificadas en WebP. Se
+# generan al subirla en un pool de procesos: redimensionar es CPU puro y en un hilo competiría
+# por el GIL con el bucle de eventos. Con fork los procesos heredan el módulo ya importado
+IMAGE_VARIANTS = {"thumb": 160, "medium": 640, "full": 1600}
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "80"))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+
+# Los ficheros sin referencias se borran pasado un margen, por si se vuelve a subir el mismo contenido
+UPLOAD_RELEASE_GRACE = float(os.getenv("UPLOAD_RELEASE_GRACE", "3600"))
+UPLOAD_SWEEP_INTERVAL = float(os.getenv("UPLOAD_SWEEP_INTERVAL", "600"))
+
+def upload_extension(filename: Optional[str]) -> str:
+    extension = os.path.splitext(filename or "")[1].lower()
+    return extension if re.fullmatch(r"\.[a-z0-9]{1,8}", extension) else ""
+
+def write_chunk(f, digest, chunk: bytes):
+    digest.update(chunk)
+    f.write(chunk)
+
+def discard_file(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+# Los procesos del pool heredan del proceso principal el manejador de SIGTERM de uvicorn, que
+# no los pararía: se restaura el de por defecto, y terminan solos si el principal muere sin cerrarlos
+def init_image_worker(parent_pid: int):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    def watch():
+        while os.getppid() == parent_pid:
+            time.sleep(1)
+        os._exit(0)
+    threading.Thread(target=watch, daemon=True).start()
+
+def variant_filename(filename: str, size: str) -> str:
+    return f"{os.path.splitext(filename)[0]}_{size}.webp"
+
+# Se ejecuta en un proceso del pool. Una variante que no pesa menos que el original no se guarda
+# y su URL apunta al original; las imágenes animadas se sirven siempre tal cual
+def generate_variants(uploads_dir: str, filename: str) -> Dict[str, str]:
+    path = os.path.join(uploads_dir, filename)
+    targets = {size: variant_filename(filename, size) for size in IMAGE_VARIANTS}
+    if all(os.path.exists(os.path.join(uploads_dir, target)) for target in targets.values()):
+        return {size: f"/uploads/{target}" for size, target in targets.items()}
+    original_size = os.path.getsize(path)
+    variants = {}
+    with Image.open(path) as original:
+        if getattr(original, "is_animated", False):
+            return {}
+        # En JPEG decodifica directamente a una escala reducida cercana a la variante mayor
+        largest = max(IMAGE_VARIANTS.values())
+        original.draft("RGB", (largest, largest))
+        image = ImageOps.exif_transpose(original)
+        image = image.convert("RGBA" if image.has_transparency_data else "RGB")
+        for size, max_side in IMAGE_VARIANTS.items():
+            target_path = os.path.join(uploads_dir, targets[size])
+            if not os.path.exists(target_path):
+                resized = image.copy()
+                resized.thumbnail((max_side, max_side), Image.LANCZOS)
+                temp_path = os.path.join(uploads_dir, f".variant-{uuid.uuid4()}")
+                resized.save(temp_path, "WEBP", quality=IMAGE_QUALITY)
+                if os.path.getsize(temp_path) >= original_size:
+                    discard_file(temp_path)
+                    variants[size] = f"/uploads/{filename}"
+                    continue
+                os.replace(temp_path, target_path)
+            variants[size] = f"/uploads/{targets[size]}"
+    return variants
+
+def upload_etag(filename: str, stat: os.stat_result) -> str:
+    digest = hashlib.sha1(f"{filename}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()
+    return f'"{digest}"'
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+# Interpreta un único rango "bytes=inicio-fin"; devuelve None si la cabecera no es válida
+def parse_range(range_header: str, size: int) -> Optional[Tuple[int, int]]:
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    start, _, end = spec.strip().partition("-")
+    try:
+        if start:
+            first = int(start)
+            last = int(end) if end else size - 1
+        else:
+            suffix = int(end)
+            if suffix <= 0:
+                return None
+            first = max(size - suffix, 0)
+            last = size - 1
+    except ValueError:
+        return None
+    if first < 0 or (start and end and last < first):
+        return None
+    return first, min(last, size - 1)
+
+def iter_file_range(file_path: str, start: int, end: int):
+    with open(file_path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(UPLOAD_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+# Almacenamiento por contenido: la subida se copia por trozos a un temporal fuera del bucle de
+# eventos mientras se calcula su SHA-256, y el nombre final es el hash. Las copias idénticas
+# comparten fichero y la colección cuenta sus referencias. run_db es el ejecutor de MongoDB del
+# servicio y processing_time, el histograma de la generación de variantes
+class UploadStore:
+    def __init__(self, uploads_dir: str, collection, run_db, processing_time):
+        self.uploads_dir = uploads_dir
+        self.collection = collection
+        self.run_db = run_db
+        self.processing_time = processing_time
+        self.image_executor: Optional[ProcessPoolExecutor] = None
+        os.makedirs(uploads_dir, exist_ok=True)
+        collection.create_index([("refs", ASCENDING), ("released_at", ASCENDING)])
+
+    # Con fork el primer trabajo arranca todos los procesos: se llama desde el lifespan, antes de
+    # que uvicorn abra el socket, para que no lo hereden
+    async def start_image_pool(self):
+        if Image is None:
+            return
+        self.image_executor = ProcessPoolExecutor(
+            max_workers=IMAGE_WORKERS,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=init_image_worker,
+            initargs=(os.getpid(),),
+        )
+        await asyncio.get_running_loop().run_in_executor(self.image_executor, os.getpid)
+
+    def shutdown(self):
+        if self.image_executor is not None:
+            self.image_executor.shutdown(wait=False)
+
+    async def store(self, upload: UploadFile, prefix: str) -> str:
+        loop = asyncio.get_running_loop()
+        digest = hashlib.sha256()
+        size = 0
+        temp_path = os.path.join(self.uploads_dir, f".upload-{uuid.uuid4()}")
+        f = await loop.run_in_executor(None, open, temp_path, "wb")
+        try:
+            while True:
+                chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > UPLOAD_MAX_BYTES:
+                    raise HTTPException(status_code=413, detail=f"La imagen supera el tamaño máximo ({UPLOAD_MAX_BYTES} bytes)")
+                await loop.run_in_executor(None, write_chunk, f, digest, chunk)
+        except BaseException:
+            await loop.run_in_executor(None, f.close)
+            await loop.run_in_executor(None, discard_file, temp_path)
+            raise
+        await loop.run_in_executor(None, f.close)
+
+        filename = f"{prefix}-{digest.hexdigest()}{upload_extension(upload.filename)}"
+        record = await self.run_db(
+            self.collection.find_one_and_update,
+            {"_id": filename},
+            {"$inc": {"refs": 1}, "$unset": {"released_at": ""}, "$setOnInsert": {"size": size, "created_at": datetime.utcnow()}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        # Con una sola referencia el registro es nuevo (o se había liberado): se escribe siempre el fichero
+        final_path = os.path.join(self.uploads_dir, filename)
+        if record["refs"] > 1 and await loop.run_in_executor(None, os.path.exists, final_path):
+            await loop.run_in_executor(None, discard_file, temp_path)
+            logger.info(f"Imagen {filename} ya almacenada: {record['refs']} referencias")
+        else:
+            await loop.run_in_executor(None, os.replace, temp_path, final_path)
+            logger.info(f"Imagen {filename} almacenada ({size} bytes)")
+        return f"/uploads/{filename}"
+
+    async def create_variants(self, url: str) -> Dict[str, str]:
+        if self.image_executor is None:
+            return {}
+        filename = url[len("/uploads/"):]
+        start = time.perf_counter()
+        try:
+            variants = await asyncio.get_running_loop().run_in_executor(self.image_executor, generate_variants, self.uploads_dir, filename)
+        except Exception as e:
+            logger.warning(f"No se pudieron generar las variantes de {filename}: {str(e)}")
+            return {}
+        self.processing_time.observe(time.perf_counter() - start)
+        return variants
+
+    # Suelta una referencia; las imágenes antiguas (nombre con UUID) no tienen registro y se conservan
+    async def release(self, url: Optional[str]):
+        if not url or not url.startswith("/uploads/"):
+            return
+        record = await self.run_db(
+            self.collection.find_one_and_update,
+            {"_id": url[len("/uploads/"):], "refs": {"$gt": 0}},
+            {"$inc": {"refs": -1}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if record and record["refs"] == 0:
+            await self.run_db(self.collection.update_one, {"_id": record["_id"], "refs": 0}, {"$set": {"released_at": datetime.utcnow()}})
+            logger.info(f"Imagen {record['_id']} sin referencias")
+
+    # Los ficheros de la imagen se apartan antes de borrar el registro y solo se eliminan si el borrado
+    # condicional lo consigue. Si entretanto se volvió a subir el mismo contenido, se devuelven a su
+    # sitio; lo que haya escrito esa subida es idéntico porque el nombre es el hash. Borrar el fichero
+    # después del registro podría llevarse el que acaba de escribir una subida nueva
+    def sweep_upload(self, filename: str, cutoff: datetime) -> bool:
+        trash = f".sweep-{uuid.uuid4()}"
+        moved = []
+        for name in [filename] + [variant_filename(filename, size) for size in IMAGE_VARIANTS]:
+            try:
+                os.rename(os.path.join(self.uploads_dir, name), os.path.join(self.uploads_dir, f"{trash}-{name}"))
+                moved.append(name)
+            except FileNotFoundError:
+                pass
+        if self.collection.delete_one({"_id": filename, "refs": {"$lte": 0}, "released_at": {"$lt": cutoff}}).deleted_count:
+            for name in moved:
+                discard_file(os.path.join(self.uploads_dir, f"{trash}-{name}"))
+            return True
+        for name in moved:
+            os.replace(os.path.join(self.uploads_dir, f"{trash}-{name}"), os.path.join(self.uploads_dir, name))
+        logger.info(f"Imagen {filename} subida de nuevo durante la limpieza: se conserva")
+        return False
+
+    def sweep(self) -> int:
+        cutoff = datetime.utcnow() - timedelta(seconds=UPLOAD_RELEASE_GRACE)
+        removed = 0
+        for record in self.collection.find({"refs": {"$lte": 0}, "released_at": {"$lt": cutoff}}, {"_id": 1}):
+            if self.sweep_upload(record["_id"], cutoff):
+                removed += 1
+        return removed
+
+    async def sweeper(self):
+        while True:
+            await asyncio.sleep(UPLOAD_SWEEP_INTERVAL)
+            try:
+                removed = await self.run_db(self.sweep)
+                if removed:
+                    logger.info(f"{removed} imágenes sin referencias eliminadas")
+            except Exception as e:
+                logger.error(f"Error al eliminar imágenes sin referencias: {str(e)}")
+
+    # Servir imágenes con validadores fuertes, respuestas 304 y peticiones Range
+    async def serve(self, filename: str, request: Request, size: Optional[str] = None) -> Response:
+        if os.path.basename(filename) != filename:
+            raise HTTPException(status_code=404, detail="Imagen no encontrada")
+        # La variante pedida si existe; si no (imágenes anteriores a las variantes o variantes que no
+        # reducían el original) se sirve el original
+        media_type = None
+        if size in IMAGE_VARIANTS and os.path.exists(os.path.join(self.uploads_dir, variant_filename(filename, size))):
+            filename, media_type = variant_filename(filename, size), "image/webp"
+        file_path = os.path.join(self.uploads_dir, filename)
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Imagen no encontrada")
+
+        etag = upload_etag(filename, stat)
+        headers = {
+            "ETag": etag,
+            "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+            "Cache-Control": UPLOAD_CACHE_CONTROL,
+            "Accept-Ranges": "bytes",
+        }
+
+        if_none_match = request.headers.get("If-None-Match")
+        if if_none_match is not None:
+            if etag_matches(if_none_match, etag):
+                return Response(status_code=304, headers=headers)
+        elif request.headers.get("If-Modified-Since"):
+            try:
+                since = parsedate_to_datetime(request.headers["If-Modified-Since"]).timestamp()
+            except (TypeError, ValueError):
+                since = None
+            if since is not None and int(stat.st_mtime) <= since:
+                return Response(status_code=304, headers=headers)
+
+        range_header = request.headers.get("Range")
+        if_range = request.headers.get("If-Range")
+        if range_header and (if_range is None or if_range.strip() == etag):
+            if stat.st_size == 0:
+                return Response(status_code=416, headers={**headers, "Content-Range": "bytes */0"})
+            byte_range = parse_range(range_header, stat.st_size)
+            if byte_range is not None:
+                start, end = byte_range
+                if start >= stat.st_size:
+                    return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{stat.st_size}"})
+                return StreamingResponse(
+                    iter_file_range(file_path, start, end),
+                    status_code=206,
+                    media_type=media_type or mimetypes.guess_type(filename)[0] or "application/octet-stream",
+                    headers={**headers, "Content-Range": f"bytes {start}-{end}/{stat.st_size}", "Content-Length": str(end - start + 1)},
+                )
+
+        return FileResponse(file_path, media_type=media_type, headers=headers)
@@ -1,15 +1,26 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form
-from typing import Optional
-import uuid
-from pymongo import MongoClient
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Request, Response
+from bson import ObjectId
+import orjson
+from typing import List, Optional
+from pymongo import MongoClient, monitoring, ASCENDING, DESCENDING, UpdateOne
+from prometheus_client import Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 from pydantic import BaseModel
 import os
 from dotenv import load_dotenv
 import time
 import logging
 import bcrypt
-from fastapi.responses import FileResponse
+from fastapi.responses import JSONResponse
+import math
+import re
+import unicodedata
 from datetime import datetime
+import asyncio
+import functools
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from shared.uploads import UploadStore
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
@@ -17,13 +28,89 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-app = FastAPI(title="User Service")
+# Respuestas JSON con orjson: ObjectId y datetime se codifican sin pasar por jsonable_encoder
+def orjson_default(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError(f"Tipo no serializable: {type(obj).__name__}")
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=orjson_default, option=orjson.OPT_NON_STR_KEYS)
+
+# Monitor del bucle de eventos, limpieza de imágenes sin referencias, pool de procesos de las
+# variantes de imagen y cierre de los pools
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await upload_store.start_image_pool()
+    tasks = [asyncio.create_task(monitor_event_loop()), asyncio.create_task(upload_store.sweeper())]
+    yield
+    for task in tasks:
+        task.cancel()
+    mongo_executor.shutdown(wait=False)
+    upload_store.shutdown()
+
+app = FastAPI(title="User Service", lifespan=lifespan, default_response_class=FastJSONResponse)
+
+# Métricas Prometheus
+REQUEST_LATENCY = Histogram("http_request_duration_seconds", "Latencia de las peticiones HTTP", ["method", "route", "status"])
+REQUESTS_IN_FLIGHT = Gauge("http_requests_in_flight", "Peticiones HTTP en curso")
+MONGO_LATENCY = Histogram("mongo_command_duration_seconds", "Duración de los comandos de MongoDB", ["command", "status"])
+IMAGE_PROCESSING = Histogram("image_variants_duration_seconds", "Duración de la generación de variantes de una imagen")
+EVENT_LOOP_LAG = Histogram(
+    "event_loop_lag_seconds",
+    "Retraso del bucle de eventos al despertar una tarea periódica",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    REQUESTS_IN_FLIGHT.inc()
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        REQUESTS_IN_FLIGHT.dec()
+        route = request.scope.get("route")
+        REQUEST_LATENCY.labels(request.method, route.path if route else "unmatched", str(status)).observe(time.perf_counter() - start)
+
+# Registrar la duración de cada comando enviado a MongoDB
+class MongoCommandTimer(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_LATENCY.labels(event.command_name, "ok").observe(event.duration_micros / 1_000_000)
+
+    def failed(self, event):
+        MONGO_LATENCY.labels(event.command_name, "error").observe(event.duration_micros / 1_000_000)
+
+# Mide cuánto tarda el bucle en despertar una tarea que duerme un intervalo fijo: el exceso es
+# tiempo en que el bucle estuvo bloqueado por código síncrono
+EVENT_LOOP_LAG_INTERVAL = float(os.getenv("EVENT_LOOP_LAG_INTERVAL", "0.1"))
+
+async def monitor_event_loop():
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        EVENT_LOOP_LAG.observe(max(0.0, time.perf_counter() - start - EVENT_LOOP_LAG_INTERVAL))
+
+# pymongo es síncrono: las operaciones se ejecutan en un pool de hilos acotado, del mismo tamaño
+# que el pool de conexiones del cliente, para no bloquear el bucle de eventos
+MONGO_POOL_SIZE = int(os.getenv("MONGO_POOL_SIZE", "16"))
+mongo_executor = ThreadPoolExecutor(max_workers=MONGO_POOL_SIZE, thread_name_prefix="mongo")
+
+async def run_db(fn, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(mongo_executor, functools.partial(fn, *args, **kwargs))
 
 # Conexión a MongoDB con reintentos
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://mongo:27017/user_db")
 for attempt in range(10):
     try:
-        client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000)
+        client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000, maxPoolSize=MONGO_POOL_SIZE, event_listeners=[MongoCommandTimer()])
         client.server_info()  # Verifica la conexión
         logger.info(f"Conexión a MongoDB establecida correctamente (intento {attempt + 1})")
         break
@@ -37,6 +124,59 @@ for attempt in range(10):
 db = client["user_db"]
 users_collection = db["users"]
 
+# Búsqueda: términos normalizados (minúsculas, sin acentos) de user_id, nombre y bio en un array
+# indexado. Sirve para buscar por palabras completas y para autocompletar por prefijo
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "20"))
+SEARCH_MAX_PAGE_SIZE = int(os.getenv("SEARCH_MAX_PAGE_SIZE", "50"))
+# Candidatos (los más seguidos) que se ordenan por relevancia en cada búsqueda
+SEARCH_MAX_CANDIDATES = int(os.getenv("SEARCH_MAX_CANDIDATES", "500"))
+AUTOCOMPLETE_LIMIT = int(os.getenv("AUTOCOMPLETE_LIMIT", "10"))
+# Peso de cada campo en la relevancia
+SEARCH_FIELD_WEIGHTS = (("user_id", 3.0), ("name", 2.0), ("bio", 1.0))
+
+def search_words(text: Optional[str]) -> List[str]:
+    if not text:
+        return []
+    normalized = unicodedata.normalize("NFKD", text.lower())
+    normalized = "".join(char for char in normalized if not unicodedata.combining(char))
+    return re.findall(r"\w+", normalized)
+
+def search_tokens(*texts: Optional[str]) -> List[str]:
+    return list(dict.fromkeys(word for text in texts for word in search_words(text)))
+
+def user_search_terms(user: dict) -> List[str]:
+    return search_tokens(*(user.get(field) for field, _ in SEARCH_FIELD_WEIGHTS))
+
+# Coincidencias por campo ponderadas, con bonus por user_id exacto y por popularidad
+def rank_user(user: dict, tokens: List[str]) -> float:
+    score = 0.0
+    for field, weight in SEARCH_FIELD_WEIGHTS:
+        words = set(search_words(user.get(field)))
+        score += weight * sum(1 for token in tokens if token in words)
+    if search_tokens(user.get("user_id")) == tokens:
+        score += 5.0
+    return score + 0.5 * math.log1p(user.get("followers_count", 0))
+
+users_collection.create_index([("search_terms", ASCENDING), ("followers_count", DESCENDING)])
+
+# Indexar los usuarios creados antes de la búsqueda
+def index_missing_users(batch_size: int = 1000):
+    batch = []
+    indexed = 0
+    for user in users_collection.find({"search_terms": {"$exists": False}}, {"user_id": 1, "name": 1, "bio": 1}):
+        batch.append(UpdateOne({"_id": user["_id"]}, {"$set": {"search_terms": user_search_terms(user)}}))
+        if len(batch) >= batch_size:
+            users_collection.bulk_write(batch, ordered=False)
+            indexed += len(batch)
+            batch = []
+    if batch:
+        users_collection.bulk_write(batch, ordered=False)
+        indexed += len(batch)
+    if indexed:
+        logger.info(f"Índice de búsqueda: {indexed} usuarios indexados")
+
+index_missing_users()
+
 # Modelo Pydantic para validación
 class User(BaseModel):
     email: str
@@ -53,43 +193,79 @@ class UpdateCountRequest(BaseModel):
 def hash_password(password: str) -> str:
     return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
 
-# Crear directorio uploads si no existe
-os.makedirs("/app/uploads", exist_ok=True)
+# Imágenes de perfil y portada, con el almacenamiento por contenido común a los servicios
+UPLOADS_DIR = os.getenv("UPLOADS_DIR", "/app/uploads")
+upload_store = UploadStore(UPLOADS_DIR, db["uploads"], run_db, IMAGE_PROCESSING)
 
 # Ruta para crear usuario
 @app.post("/users")
 async def create_user(user: User):
     user_dict = user.dict()
-    if users_collection.find_one({"email": user.email}):
+    if await run_db(users_collection.find_one, {"email": user.email}):
         raise HTTPException(status_code=400, detail="Email already exists")
-    user_dict["password"] = hash_password(user.password)
+    # bcrypt es costoso en CPU: también fuera del bucle de eventos
+    user_dict["password"] = await asyncio.get_running_loop().run_in_executor(None, hash_password, user.password)
     user_dict["created_at"] = datetime.utcnow().isoformat()
-    result = users_collection.insert_one(user_dict)
+    user_dict["search_terms"] = user_search_terms(user_dict)
+    result = await run_db(users_collection.insert_one, user_dict)
     return {"message": "User created successfully", "user_id": user.user_id}
 
 @app.get("/users")
 async def get_all_users():
     try:
-        users = list(users_collection.find())
+        # La proyección excluye la contraseña; ObjectId lo serializa FastJSONResponse
+        users = await run_db(lambda: list(users_collection.find({}, {"password": 0, "search_terms": 0})))
         if not users:
             raise HTTPException(status_code=404, detail="No users found")
-        for user in users:
-            user["_id"] = str(user["_id"])  # Convertir ObjectId a string
-            user.pop("password", None)  # Eliminar la contraseña por seguridad
-        return users
+        return FastJSONResponse(users)
     except Exception as e:
         logger.error(f"Error al obtener usuarios: {str(e)}")
         raise HTTPException(status_code=500, detail="Error al obtener usuarios")
 
+# Búsqueda por palabras completas (todas deben aparecer), ordenada por relevancia y paginada
+@app.get("/users/search")
+async def search_users(q: str, limit: int = SEARCH_PAGE_SIZE, offset: int = 0):
+    limit = max(1, min(limit, SEARCH_MAX_PAGE_SIZE))
+    offset = max(0, offset)
+    tokens = search_tokens(q)
+    if not tokens:
+        return FastJSONResponse({"results": [], "next_offset": None})
+    candidates = await run_db(lambda: list(
+        users_collection.find({"search_terms": {"$all": tokens}}, {"password": 0, "search_terms": 0})
+        .sort("followers_count", DESCENDING)
+        .limit(SEARCH_MAX_CANDIDATES)
+    ))
+    ranked = sorted(candidates, key=lambda user: rank_user(user, tokens), reverse=True)
+    logger.info(f"Búsqueda de usuarios '{q}': {len(ranked)} resultados")
+    return FastJSONResponse({
+        "results": ranked[offset:offset + limit],
+        "next_offset": offset + limit if offset + limit < len(ranked) else None,
+    })
+
+# Autocompletado: la última palabra es un prefijo (rango en el índice), las anteriores completas
+@app.get("/users/autocomplete")
+async def autocomplete_users(q: str, limit: int = AUTOCOMPLETE_LIMIT):
+    tokens = search_tokens(q)
+    if not tokens:
+        return FastJSONResponse([])
+    *words, prefix = tokens
+    conditions = [{"search_terms": {"$regex": f"^{re.escape(prefix)}"}}]
+    if words:
+        conditions.append({"search_terms": {"$all": words}})
+    users = await run_db(lambda: list(
+        users_collection.find({"$and": conditions}, {"_id": 0, "user_id": 1, "name": 1, "profile_image_url": 1, "followers_count": 1})
+        .sort("followers_count", DESCENDING)
+        .limit(max(1, min(limit, SEARCH_MAX_PAGE_SIZE)))
+    ))
+    return FastJSONResponse(users)
+
 @app.get("/users/{user_id}")
 async def get_user(user_id: str):
     try:
-        user = users_collection.find_one({"user_id": user_id})
+        user = await run_db(users_collection.find_one, {"user_id": user_id}, {"password": 0, "search_terms": 0})
         if not user:
             raise HTTPException(status_code=404, detail="Usuario no encontrado")
-        user["_id"] = str(user["_id"])
-        user.pop("password", None)  # Eliminar la contraseña por seguridad
-        return user
+        return FastJSONResponse(user)
     except Exception as e:
         logger.error(f"Error al obtener usuario: {str(e)}")
         raise HTTPException(status_code=500, detail="Error al obtener usuario")
@@ -103,18 +279,6 @@ async def update_user(
     name: Optional[str] = Form(None)
 ):
     update_data = {}
-    if profile_image:
-        profile_image_filename = f"{uuid.uuid4()}_{profile_image.filename}"
-        profile_image_path = os.path.join("/app/uploads", profile_image_filename)
-        with open(profile_image_path, "wb") as f:
-            f.write(await profile_image.read())
-        update_data["profile_image_url"] = f"/uploads/{profile_image_filename}"
-    if cover_image:
-        cover_image_filename = f"{uuid.uuid4()}_{cover_image.filename}"
-        cover_image_path = os.path.join("/app/uploads", cover_image_filename)
-        with open(cover_image_path, "wb") as f:
-            f.write(await cover_image.read())
-        update_data["cover_image_url"] = f"/uploads/{cover_image_filename}"
     if bio is not None:
         if len(bio) > 160:  # Validación de longitud máxima
             raise HTTPException(status_code=400, detail="La biografía no puede exceder los 160 caracteres")
@@ -126,21 +290,34 @@ async def update_user(
             raise HTTPException(status_code=400, detail="El nombre no puede estar vacío")
         update_data["name"] = name
 
+    # Las imágenes se guardan después de validar el resto de campos
+    images = {"profile_image_url": profile_image, "cover_image_url": cover_image}
+    for field, upload in images.items():
+        if upload and upload.filename:
+            update_data[field] = await upload_store.store(upload, "user")
+            update_data[field.replace("_url", "_variants")] = await upload_store.create_variants(update_data[field])
+
     if update_data:
-        result = users_collection.update_one({"user_id": user_id}, {"$set": update_data})
-        if result.modified_count:
-            return {"message": "Perfil actualizado con éxito"}
-        else:
+        current = await run_db(users_collection.find_one, {"user_id": user_id}, {"user_id": 1, "name": 1, "bio": 1, **{field: 1 for field in images}})
+        if not current:
+            for field in images:
+                await upload_store.release(update_data.get(field))
             raise HTTPException(status_code=404, detail="Usuario no encontrado")
+        # Reindexar para la búsqueda si cambia un campo indexado
+        if "name" in update_data or "bio" in update_data:
+            update_data["search_terms"] = user_search_terms({**current, **update_data})
+        await run_db(users_collection.update_one, {"user_id": user_id}, {"$set": update_data})
+        # Las imágenes sustituidas pierden una referencia (la misma imagen suma una y resta otra)
+        for field in images:
+            if field in update_data:
+                await upload_store.release(current.get(field))
+        return {"message": "Perfil actualizado con éxito"}
     raise HTTPException(status_code=400, detail="No se proporcionaron datos para actualizar")
 
+# Imágenes con ETag, respuestas 304 y peticiones Range, servidas por el almacenamiento común
 @app.get("/uploads/{filename}")
-async def serve_uploaded_file(filename: str):
-    file_path = os.path.join("/app/uploads", filename)
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail="Imagen no encontrada")
-    return FileResponse(file_path)
-
+async def serve_uploaded_file(filename: str, request: Request, size: Optional[str] = None):
+    return await upload_store.serve(filename, request, size)
 
 @app.put("/users/{user_id}/update-follow-count")
 async def update_follow_count(user_id: str, request: UpdateCountRequest):
@@ -149,7 +326,7 @@ async def update_follow_count(user_id: str, request: UpdateCountRequest):
             raise HTTPException(status_code=400, detail="Campo inválido")
         
         # Verificar si el usuario existe
-        user = users_collection.find_one({"user_id": user_id})
+        user = await run_db(users_collection.find_one, {"user_id": user_id})
         if not user:
             raise HTTPException(status_code=404, detail="Usuario no encontrado")
 
@@ -158,7 +335,8 @@ async def update_follow_count(user_id: str, request: UpdateCountRequest):
         new_count = max(0, current_count + request.value)
 
         # Actualizar el contador
-        users_collection.update_one(
+        await run_db(
+            users_collection.update_one,
             {"user_id": user_id},
             {"$set": {request.field: new_count}}
         )
@@ -168,6 +346,11 @@ async def update_follow_count(user_id: str, request: UpdateCountRequest):
         raise HTTPException(status_code=500, detail="Error al actualizar contador")
 
 
+# Métricas en formato Prometheus
+@app.get("/metrics")
+async def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file